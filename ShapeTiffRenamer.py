@@ -3,471 +3,4470 @@ Rename shape and image files to match for ERDAS Imagine processing
 Ross Wardrup
 """
 
-# TODO: Add lowercase "pan" and "psh" to the search lists.
+import sys
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+from hashlib import sha1, sha256, blake2b
+from fnmatch import fnmatch
+from os import fsync, makedirs, path, scandir, stat, link, symlink, rename, replace, remove
+from os.path import join, splitext, exists
+from sys import exit, argv
+import argparse
+from array import array
+import collections
+import contextlib
+import cProfile
+import csv
+import json
+import multiprocessing
+import queue
+import re
+from raster_header import read_raster_header
+from spatial_index import STRTree, best_match
+from tree_watch import POLL_INTERVAL, open_watcher
+import logging
+import datetime
+import gc
+import heapq
+import io
+import itertools
+import pstats
+from struct import unpack
+import signal
+import time
+import zlib
+
+try:
+    import fcntl  # reflinks, Linux only
+except ImportError:
+    fcntl = None
+
+try:
+    from osgeo import gdal  # optional, reads footprints of rasters the header reader can't
+except ImportError:
+    gdal = None
+
+try:
+    import xxhash  # optional, fastest checksum when installed
+except ImportError:
+    xxhash = None
+
+TEST = True
+COPY_WORKERS = 4  # files copied at once
+VOLUME_COPY_LIMIT = 2  # copies allowed at once on any one source or destination volume
+COPY_BUFFER_SIZE = 8 * 1024 * 1024  # bytes read and written per chunk
+CHECKSUM_ALGORITHM = 'sha1'
+COPY_RETRIES = 3  # copy attempts before a checksum mismatch is an error
+OUTPUT_MODES = ('copy', 'hardlink', 'reflink', 'symlink', 'move')
+OUTPUT_MODE = 'copy'
+MANIFEST_VERBS = {'copy': 'copied', 'hardlink': 'hardlinked', 'reflink': 'reflinked',
+                  'symlink': 'symlinked', 'move': 'moved', 'dedup': 'deduplicated'}
+PAN = 'PAN'  # image types. Shared constants, so every file of a type holds one string
+PSH = 'PSH'
+UNCATEGORIZED = 'Uncategorized'
+IMAGE_TYPES = (PAN, PSH)  # types sorted into their own output directories
+MATCH_MODES = ('name', 'spatial', 'both')  # how shapefiles are matched to images
+MATCH_MODE = 'name'
+SHP_EXTENSIONS = ('.shp', '.dbf', '.shx', '.prj')
+SHP_REQUIRED = ('.shp', '.shx', '.dbf')  # a shapefile can't be read without these
+IMAGE_SIDECARS = {'.img': ('.ige', '.rrd', '.rde')}  # files that travel with an image
+SHP_FILE_CODE = 9994  # first four bytes of every .shp file
+SHP_HEADER_SIZE = 100
+SHP_POLYGON_TYPES = (5, 15, 25)  # polygon, polygonZ, polygonM
+PARTIAL_SUFFIX = '.part'  # copies are written under this suffix, then renamed into place
+JOURNAL_BATCH_SIZE = 50  # journal updates held before they are committed
+MANIFEST_FORMATS = ('txt', 'csv', 'jsonl')
+MANIFEST_FORMAT = 'txt'
+MANIFEST_FIELDS = ('time', 'method', 'source', 'destination', 'size', 'checksum',
+                   'elapsed_seconds')
+MANIFEST_BATCH_SIZE = 100  # records held before the manifest is written
+MANIFEST_INTERVAL = 5.0  # seconds a record may be held before the manifest is written
+EXCLUDE_DIRS = ('output*', )  # directory name globs the scan never descends into
+EXIT_OK = 0
+EXIT_ERRORS = 1  # the run finished, but some files failed to copy or match
+EXIT_USAGE = 2  # bad arguments, same code argparse uses
+EXIT_CANCELLED = 3
+PIPELINE_QUEUE_SIZE = 1000  # files held between the streaming stages
+PIPELINE_POLL = 0.1  # seconds a blocked streaming stage waits before checking for a cancel
+WATCH_SETTLE = 2.0  # seconds a new file's size and mtime must hold before it is processed
+WATCH_CHECK = 0.5  # seconds between checks of the files that are still settling
+WATCH_INCOMPLETE = 300.0  # seconds a dataset missing a required file is held for
+THROUGHPUT_WINDOW = 30.0  # seconds of copying the throughput and ETA are averaged over
+PLAN_FIELDS = ('step', 'action', 'source', 'destination', 'id', 'image_type', 'size')
+REPORT_STAGES = ('walk', 'catalog', 'parse', 'match', 'plan', 'copy', 'verify')
+LATENCY_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0)  # upper bounds in seconds
+REPORT_FILE = 'run_report'  # .json and .txt, next to renamer.log
+PROFILE_FILE = 'profile.pstats'
+PROFILE_ROWS = 25  # functions listed in the report when profiling
+DEDUP_MODES = ('hardlink', 'symlink')  # how a file identical to an earlier copy is linked
+CONTENT_SAMPLE = 64 * 1024  # bytes hashed at each end of a file for the content index
+CONTENT_MIN_SIZE = 1024 * 1024  # smaller files are always copied and never indexed
+CONTENT_INDEX_SIZE = 100000  # entries the content index keeps
+CONTENT_INDEX_AGE = 180  # days an unused content index entry is kept
+NAMING_RULES_FILE = 'naming_rules.json'  # vendor naming rules, next to the application
+SCAN_CACHE_WORKERS = 2  # roots a ScanCache walks at once
+SCAN_PROCESSES = 1  # processes scanning and parsing; 1 scans in this process
+SCAN_SUBTREES_PER_PROCESS = 4  # subtrees a root is split into for each scan process
+SCAN_SPLIT_DEPTH = 3  # directory levels a root may be split down to
+# queue file option -> RenameJob argument
+QUEUE_OPTIONS = {'image_type': 'image_extension', 'mode': 'output_mode', 'match': 'match_mode',
+                 'checksum': 'algorithm', 'verify': 'verify', 'stream': 'stream',
+                 'dedup': 'dedup', 'dry_run': 'dry_run', 'manifest_format': 'manifest_format',
+                 'exclude': 'exclude_dirs', 'scan_processes': 'scan_processes',
+                 'naming_rules': 'naming_rules'}
+QUEUE_REPORT_SUFFIX = '_report'  # .json and .txt, next to the queue file
+FICLONE = 0x40049409  # ioctl request for a copy-on-write clone of a whole file
+
+
+class RenameJob:
+    """
+    One run of the renamer: scans the image and shape roots, matches shapefiles to
+    images and sorts both into the output directory. Has no Qt dependency, so it is
+    shared by the GUI and the command line.
+    """
+
+    def __init__(self, image_path, shp_path, working_directory, image_extension='.img',
+                 output_mode=OUTPUT_MODE, workers=COPY_WORKERS,
+                 volume_limit=VOLUME_COPY_LIMIT, algorithm=CHECKSUM_ALGORITHM, verify=True,
+                 exclude_dirs=EXCLUDE_DIRS, db_io=None, use_catalog=True, progress=None,
+                 dry_run=False, plan_file=None, manifest_format=MANIFEST_FORMAT,
+                 match_mode=MATCH_MODE, profile=False, stream=False, bandwidth_limit=None,
+                 bandwidth_hours=None, dedup=None, executor=None, limiter=None,
+                 scan_cache=None, scan_processes=SCAN_PROCESSES, naming_rules=None,
+                 watch=False, watch_interval=None, watch_settle=WATCH_SETTLE):
+        """
+        Initialize the job
+        :param image_path: string. image root directory
+        :param shp_path: string. shapefile root directory
+        :param working_directory: string. output directory
+        :param image_extension: string. .img or .tif
+        :param output_mode: string. one of OUTPUT_MODES
+        :param workers: int. number of copies to run at once
+        :param volume_limit: int. maximum concurrent copies per volume
+        :param algorithm: string. checksum algorithm, key of CHECKSUM_ALGORITHMS
+        :param verify: bool. re-read each copy to check it against the source checksum
+        :param exclude_dirs: iterable of directory name globs the scan skips
+        :param db_io: DatabaseIo holding the scan catalog, shared between runs
+        :param use_catalog: bool. read and update the scan catalog
+        :param progress: callable taking JobProgress snapshots, or None
+        :param dry_run: bool. plan the renames without copying anything
+        :param plan_file: string. where the plan is written, defaults to plan.csv in the
+        output directory
+        :param manifest_format: string. one of MANIFEST_FORMATS
+        :param match_mode: string. one of MATCH_MODES. spatial matching reads image
+        footprints from GeoTIFF and Imagine headers, see raster_header; GDAL is only
+        needed for other raster formats
+        :param profile: bool. run under cProfile and add the slowest functions to the
+        run report
+        :param stream: bool. copy files while the roots are still being scanned, see
+        FilePipeline. Only used with name matching, and not for dry runs.
+        :param bandwidth_limit: float. bytes per second all copies together may read, or
+        None for no cap
+        :param bandwidth_hours: tuple (start hour, end hour) the cap applies in, or None
+        for all day
+        :param dedup: string. one of DEDUP_MODES to link files identical to ones earlier
+        runs placed instead of copying them, see ContentIndex. None always copies.
+        Needs the catalog database.
+        :param executor: ThreadPoolExecutor the copies run on, shared by the jobs of a
+        JobQueue. None starts a pool of workers threads for this job.
+        :param limiter: VolumeLimiter shared by the jobs of a JobQueue, or None for one of
+        this job's own
+        :param scan_cache: ScanCache to take the scans of the roots from, or None to walk
+        them here
+        :param scan_processes: int. processes that scan and parse the roots when
+        planning, see scan_roots_parallel. 1 scans in this process. Streaming always
+        scans in this process.
+        :param naming_rules: NamingRules the file names are parsed with, or None for
+        default_naming_rules()
+        :param watch: bool. stream the roots, then keep processing files as they land
+        under them until stop_watching is called, see ArrivalWatcher. Needs name
+        matching and a real run.
+        :param watch_interval: float. seconds between walks when watching by polling
+        instead of inotify, or None to only poll network mounts
+        :param watch_settle: float. seconds a new file's size and mtime must hold before
+        it is processed
+        """
+
+        # Scanned paths key the catalog and the journal across runs, so they can't
+        # depend on the directory the job was started from
+        self.image_path = path.abspath(image_path)
+        self.shp_path = path.abspath(shp_path)
+        self.working_directory = path.abspath(working_directory)
+        self.image_extension = image_extension
+        self.output_mode = output_mode
+        self.copy_workers = workers
+        self.volume_copy_limit = volume_limit
+        self.checksum_algorithm = algorithm
+        self.verify_copies = verify
+        self.exclude_dirs = exclude_dirs
+        self.db_io = db_io if db_io is not None else DatabaseIo()
+        self.use_catalog = use_catalog
+        self.dry_run = dry_run
+        self.plan_file = plan_file
+        self.manifest_format = manifest_format
+        self.match_mode = match_mode
+        self.profile = profile
+        self.stream = stream
+        self.dedup = dedup
+        self.content_index = None
+        self.executor = executor
+        self.limiter = limiter if limiter is not None else VolumeLimiter(volume_limit)
+        self.scan_cache = scan_cache
+        self.scan_processes = scan_processes
+        self.naming_rules = naming_rules if naming_rules is not None \
+            else default_naming_rules()
+        self.watch = watch
+        self.watch_interval = watch_interval
+        self.watch_settle = watch_settle
+        self.watch_stopped = threading.Event()
+
+        self.progress = JobProgress(progress)
+        self.report = RunReport()
+        self.throttle = BandwidthLimiter(bandwidth_limit, bandwidth_hours,
+                                         self.progress.add_transferred)
+        self.cancel_event = threading.Event()
+
+        self.stats = {'files_scanned': 0,
+                      'files_processed': 0,
+                      'datasets': 0,
+                      'unmatched_shapes': 0,
+                      'spatial_matches': 0,
+                      'ambiguous_ids': [],
+                      'planned': 0,
+                      'collisions': 0,
+                      'existing': 0,
+                      'copied': 0,
+                      'deduplicated': 0,
+                      'bytes_saved': 0,
+                      'skipped': 0,
+                      'resumed': 0,
+                      'failed': 0,
+                      'cancelled': 0,
+                      'errors': []}
+
+    def cancel(self):
+        """
+        Asks the job to stop. Safe to call from any thread; the job stops between datasets,
+        so nothing is left half copied.
+        """
+
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        """
+        Checks whether the job has been asked to stop
+        :return: bool
+        """
+
+        return self.cancel_event.is_set()
+
+    def stop_watching(self):
+        """
+        Asks a watching job to stop watching. Unlike cancel, copies already queued are
+        finished. Safe to call from any thread.
+        """
+
+        self.watch_stopped.set()
+
+    def create_new_filenames(self, paths, destination, image_extension):
+        """
+        rename image and shape files. Only plans the renames; nothing is copied here.
+        :param paths: tuple. first is image path, second is shp path
+        :return: list of (step, step destination, files) with one entry per root. files
+        is a list of PlannedFile
+        """
+
+        plan = []
+        image_index = ImageIndex()
+        footprints = []  # (bounds, (ID, type)) of each image, for spatial matching
+        footprint_index = None
+        spatial_matches = {}  # shapefile path without extension -> (ID, type)
+        match_by_name = self.match_mode in ('name', 'both')
+        match_spatially = self.match_mode in ('spatial', 'both')
+        index_counter = 0
+        step = None
+        extra_extensions = IMAGE_SIDECARS.get(image_extension, ())
+        image_extensions = (image_extension, ) + extra_extensions
+
+        if exists(destination):  # only run if the destination exists
+
+            # Walk both roots at once. The output directory is never descended into,
+            # even if it lives under one of the roots.
+            print("\n* Scanning {}...".format(', '.join(paths)))
+            self.progress.set_stage('scanning')
+            started = time.perf_counter()
+            roots = zip(paths, (image_extensions, SHP_EXTENSIONS))
+
+            # Either way, each root gives its datasets paired with their parsed name, or
+            # with None where the name is parsed below
+            if self.scan_processes > 1:
+                scans = scan_roots_parallel(((root, extensions, shapes) for (root, extensions),
+                                             shapes in zip(roots, (False, True))),
+                                            self.scan_processes, self.exclude_dirs,
+                                            (destination, ), self.naming_rules)
+                self.stats['files_scanned'] = sum(len(dataset.files) for scan in scans
+                                                  for dataset, parsed in scan)
+            else:
+                scans = scan_roots(roots, self.exclude_dirs, (destination, ), self.scan_cache)
+                self.stats['files_scanned'] = sum(len(scan) for scan in scans)
+                scans = [((dataset, None) for dataset in group_datasets(scan))
+                         for scan in scans]
+
+            self.report.add_time('walk', time.perf_counter() - started,
+                                 self.stats['files_scanned'])
+            self.progress.add_scanned(self.stats['files_scanned'])
+
+            for path in paths:  # for image and shape path...
+
+                files = []
+
+                if self.is_cancelled():
+                    break
+
+                if index_counter == 0:  # image files
+                    step = "imagery"
+
+                if index_counter == 1:  # shapefiles
+                    step = 'shape data'
+
+                    destination = join(destination, 'shp')  # set shp dest path
+
+                print("\n* Parsing {}...".format(step))
+
+                # Names are always parsed with the current naming rules. Shapefiles that
+                # don't match by name and haven't changed since the last run reuse the
+                # match stored in the catalog, which keeps earlier spatial matches.
+                started = time.perf_counter()
+                catalog = self.db_io.load_catalog(step)
+                seen = set()
+                self.report.add_time('catalog', time.perf_counter() - started)
+
+                self.progress.set_stage('parsing {}'.format(step))
+                started = time.perf_counter()
+
+                # Sidecars share their dataset's name, so each set is parsed and
+                # matched once, and its files are planned together
+                for dataset, parsed in scans[index_counter]:
+                    if self.is_cancelled():
+                        break
+
+                    sid = None  # sid is the ID value that the files will be named
+                    image_type = None  # pan or psh
+                    file = dataset.name
+                    self.stats['datasets'] += 1
+
+                    for scanned in dataset.files:
+                        if scanned.extension in extra_extensions:
+                            print("Found extra file {}".format(scanned.name))
+                            logging.info("Found extra file {}".format(scanned.name))
+                        seen.add(scanned.path)
+
+                    original_file_path = dataset.files[0].path
+
+                    if index_counter == 0:  # Imagery step
+                        if parsed is not None:  # parsed by a scan process
+                            sid, image_type = intern_id(*parsed)
+                        else:
+                            sid, image_type = parse_image_filename(file, self.naming_rules)
+
+                        if image_type is UNCATEGORIZED:
+                            text = "- WARNING: Could not categorize image {}" \
+                                .format(original_file_path)
+                            logging.warning(text)
+
+                        image_index.add(sid, image_type)
+
+                        if match_spatially:
+                            for scanned in dataset.files:
+                                if scanned.extension == image_extension:
+                                    bounds = ImageReader(scanned.path).image_bounds()
+                                    if bounds is not None:
+                                        footprints.append((bounds, (sid, image_type)))
+
+                    if index_counter == 1:  # shape
+                        if match_by_name and parsed is not None:
+                            sid, image_type = match_candidate_ids(parsed, image_index)
+                        elif match_by_name:
+                            sid, image_type = parse_shape_filename(file, image_index,
+                                                                   self.naming_rules)
+
+                        if not sid:
+                            sid, image_type = stored_shape_match(catalog, dataset,
+                                                                 image_index)
+
+                            if not sid and match_spatially:
+                                if footprint_index is None:
+                                    footprint_index = STRTree(footprints)
+                                sid, image_type = self.match_spatially(
+                                    original_file_path, image_index, footprint_index,
+                                    spatial_matches)
+
+                    self.db_io.update_dataset(step, catalog, dataset, sid, image_type)
+
+                    if sid:
+                        files.extend(plan_dataset(destination, dataset, sid, image_type,
+                                                  index_counter == 1))
+
+                    else:
+                        for scanned in dataset.files:
+                            if scanned.extension == '.shp':
+                                text = ("- ERROR: could not match image with "
+                                        "filename {}"
+                                        .format(scanned.path))
+                                logging.error(text)
+                                self.stats['unmatched_shapes'] += 1
+
+                    self.stats['files_processed'] += len(dataset.files)
+
+                self.report.add_time('parse' if index_counter == 0 else 'match',
+                                     time.perf_counter() - started, len(seen))
+
+                if index_counter == 0:
+                    self.stats['ambiguous_ids'] = sorted(image_index.ambiguous)
+
+                started = time.perf_counter()
+                if not self.is_cancelled():  # a partial scan would prune files it never reached
+                    self.db_io.prune_catalog(step, catalog, path, seen)
+                self.db_io.commit()
+                self.report.add_time('catalog', time.perf_counter() - started)
+
+                plan.append((step, destination, files))
+
+                index_counter += 1  # increment the counter to begin copying shp
+
+        else:
+            text = ("- WARNING: destination directory {} does not exist and I "
+                    "couldn't create it for you. "
+                    "Did you enter a valid path?".format(destination))
+
+            logging.warning(text)
+            self.stats['errors'].append(text)
+
+        return plan
+
+    def match_spatially(self, file_path, image_index, footprint_index, matches):
+        """
+        Matches a shapefile component to the image whose footprint it lies in. The .shp
+        of the set is read once and the result shared by its .dbf, .shx and .prj.
+        :param file_path: string. path to a shapefile component
+        :param image_index: ImageIndex built from the image files
+        :param footprint_index: STRTree of image footprints
+        :param matches: dict. cache of shapefile path without extension -> (ID, type)
+        :return: matched id (string) and image type
+        """
+
+        base = splitext(file_path)[0]
+
+        if base not in matches:
+            matches[base] = (None, None)
+            shape = ShapeReader(base + '.shp')
+
+            if exists(shape.shape_path) and shape.shapefile_bounds() is not None:
+                value, score = best_match(footprint_index, shape.shapefile_bounds(),
+                                          shape.shapefile_centroid())
+
+                # An ID that became ambiguous can't be matched spatially either
+                if value is not None and image_index.lookup(value[0]) == value:
+                    matches[base] = value
+                    self.stats['spatial_matches'] += 1
+                    logging.info("- INFO: matched {0} to image {1} by location (overlap {2:.2f})"
+                                 .format(shape.shape_path, value[0], score))
+
+        return matches[base]
+
+    def check_plan(self, plan):
+        """
+        Drops planned files that would overwrite another planned file, and counts the
+        ones already in the output directory. A collision drops the whole dataset, so a
+        shapefile or image is never placed without some of its files.
+        :param plan: list returned by create_new_filenames
+        :return: tuple. the plan without the duplicates, and a dict of orig path ->
+        planned action for write_plan
+        """
+
+        duplicates = check_for_duplicates([file for step, destination, files in plan
+                                           for file in files])
+        dropped = {file.dataset for file in duplicates}
+        duplicates = {file.source for step, destination, files in plan for file in files
+                      if file.dataset in dropped}
+        self.stats['collisions'] = len(duplicates)
+
+        checked = [(step, destination,
+                    [file for file in files if file.source not in duplicates])
+                   for step, destination, files in plan]
+
+        existing = find_existing(file.destination for step, destination, files in checked
+                                 for file in files)
+        self.stats['planned'] = sum(len(files) for step, destination, files in checked)
+        self.stats['existing'] = len(existing)
+
+        actions = {}
+        for step, destination, files in plan:
+            for file in files:
+                if file.source in duplicates:
+                    actions[file.source] = 'collision'
+                elif file.destination in existing:
+                    actions[file.source] = 'exists'
+                else:
+                    actions[file.source] = self.output_mode
+
+        return checked, actions
+
+    def job_key(self):
+        """
+        Identifies the job in the copy journal. Running the same roots into the same
+        output directory again resumes the same job.
+        :return: string
+        """
+
+        roots = (self.image_path, self.shp_path, self.working_directory)
+        return sha1('|'.join(path.normcase(path.abspath(root)) for root in roots)
+                    .encode('utf-8')).hexdigest()
+
+    def prefetch_scans(self, cache):
+        """
+        Starts the scans of the job's roots in a ScanCache, keyed the same way the job
+        will ask for them
+        :param cache: ScanCache
+        """
+
+        if self.scan_processes > 1 and not self.stream:  # scanned by its own processes
+            return
+
+        image_extensions = (self.image_extension, ) + \
+            IMAGE_SIDECARS.get(self.image_extension, ())
+
+        for root, extensions in ((self.image_path, image_extensions),
+                                 (self.shp_path, SHP_EXTENSIONS)):
+            cache.scan(root, extensions, self.exclude_dirs, (self.working_directory, ))
+
+    def execute_plan(self, plan):
+        """
+        Copies the planned files, one root at a time
+        :param plan: list returned by create_new_filenames
+        """
+
+        manifests = {}  # one open manifest per output directory for the whole run
+        journal = None
+
+        if self.db_io.session is not None:
+            journal = CopyJournal(self.db_io, self.job_key())
+            for step, destination, files in plan:
+                for file in files:
+                    if journal.state(file) is None:
+                        journal.mark(file, 'planned')
+            journal.commit()
+
+        try:
+            for step, destination, files in plan:
+                text = "\t - Copying {}".format(step)
+
+                if len(files) > 0 and not self.is_cancelled():
+                    self.progress.set_stage('copying {}'.format(step))
+
+                    if destination not in manifests:
+                        manifests[destination] = ManifestWriter(destination,
+                                                                self.manifest_format)
+
+                    copied = file_copier(files, destination, self.copy_workers,
+                                         self.volume_copy_limit, self.checksum_algorithm,
+                                         self.verify_copies, self.output_mode, self.progress,
+                                         self.cancel_event, manifests[destination],
+                                         journal, self.report, self.throttle,
+                                         self.content_index, self.executor,
+                                         self.limiter)  # copy the files
+
+                    for key, count in copied.items():
+                        self.stats[key] += count
+
+        finally:
+            for manifest in manifests.values():
+                manifest.close()
+
+    def run(self):
+        """
+        Runs the entire thing, logging to renamer.log in the output directory
+        :return: dict of run statistics
+        """
+
+        text = "--Process began at {} --".format(get_datetime())
+
+        # set up logfile
+        logfile = join(self.working_directory, 'renamer.log')
+        text = "\n* Setting up logfile: {}".format(logfile)
+
+        print("* Creating directories...")
+        directory_creator(self.working_directory)
+
+        with job_log(logfile):
+            return self.process()
+
+    def process(self):
+        """
+        Scans, plans and copies. Called by run once the log is set up.
+        :return: dict of run statistics
+        """
+
+        started = time.time()
+        image_path = self.image_path
+        shp_path = self.shp_path
+        working_directory = self.working_directory
+
+        logging.info("- INFO: image path: {0}, shp path: {1}, working directory: "
+                     "{2}".format(image_path, shp_path, working_directory))
+
+        paths = (image_path, shp_path)
+
+        profiler = cProfile.Profile() if self.profile else None
+        if profiler is not None:
+            profiler.enable()
+
+        if self.use_catalog and self.db_io.session is None:
+            with self.report.stage('catalog'):
+                self.db_io.init_db()
+
+        if self.dedup and not self.dry_run:
+            if self.db_io.session is not None:
+                with self.report.stage('catalog'):
+                    self.content_index = ContentIndex(self.db_io, self.checksum_algorithm,
+                                                      self.dedup)
+            else:
+                text = ("- ERROR: deduplication needs the database {}, which isn't open. "
+                        "Copying every file.".format(self.db_io.db_path))
+                logging.error(text)
+                self.stats['errors'].append(text)
+
+        if self.db_io.session is None and not self.dry_run:
+            logging.warning("- WARNING: copy journal disabled, so an interrupted run can't "
+                            "be resumed. Files already in the output are skipped unchecked.")
+
+        streaming = (self.stream or self.watch) and not self.dry_run and \
+            self.match_mode == 'name'
+        if self.stream and not streaming:
+            logging.warning("- WARNING: streaming needs name matching and a real run. "
+                            "Planning everything before copying instead.")
+        if self.watch and not streaming:
+            logging.warning("- WARNING: watching needs name matching and a real run. "
+                            "Running once instead.")
+            self.watch = False
+
+        if streaming:
+            self.create_directories()
+
+            print("\n* Scanning, matching and copying {}...".format(', '.join(paths)))
+            if self.watch:
+                print("* Then watching them for new files. Press Ctrl+C to stop.")
+            streamed = time.perf_counter()
+            FilePipeline(self, paths, working_directory).run()
+            self.report.add_time('copy', time.perf_counter() - streamed, self.stats['planned'])
+
+        else:
+            # Planning allocates a few records per file and none of them form cycles, so
+            # the cyclic GC would only rescan them over and over
+            with gc_paused():
+                plan = self.create_new_filenames(paths, working_directory,
+                                                 self.image_extension)
+
+                self.progress.set_stage('planning')
+                with self.report.stage('plan', sum(len(files) for step, destination, files
+                                                   in plan)):
+                    checked_plan, actions = self.check_plan(plan)
+
+                    plan_file = self.plan_file or join(working_directory, 'plan.csv')
+                    write_plan(plan, actions, plan_file)
+
+            print("\n* Wrote plan for {0} files to {1}".format(self.stats['planned'],
+                                                                 plan_file))
+            logging.info("- INFO: Wrote plan for {0} files to {1}"
+                         .format(self.stats['planned'], plan_file))
+
+            if not self.dry_run:
+                self.create_directories()
+
+                with self.report.stage('copy', self.stats['planned']):
+                    self.execute_plan(checked_plan)
+
+        if self.content_index is not None:
+            with self.report.stage('catalog'):
+                self.content_index.commit()
+            self.stats['bytes_saved'] = self.report.bytes_saved
+
+        logging.info("- INFO: Finished at {})".format(get_datetime()))
+        text = "\n-- Image/Shp processing complete at {} --".format(get_datetime())
+
+        if self.is_cancelled():
+            logging.warning("- WARNING: Cancelled at {}".format(get_datetime()))
+            self.stats['cancelled_by_user'] = True
+
+        print("\n** Finished at {} **".format(get_datetime()))
+        self.progress.set_stage('cancelled' if self.is_cancelled() else 'finished')
+
+        self.stats['elapsed_seconds'] = round(time.time() - started, 3)
+
+        if profiler is not None:
+            profiler.disable()
+            profile_file = join(working_directory, PROFILE_FILE)
+            profiler.dump_stats(profile_file)
+            self.report.add_profile(profiler)
+            logging.info("- INFO: Wrote profile to {}".format(profile_file))
+
+        self.report.finish(self.stats['elapsed_seconds'])
+        self.stats['stage_seconds'] = {stage: round(seconds, 3) for stage, (seconds, items)
+                                       in self.report.ordered_stages()}
+        try:
+            report_file = self.report.write(join(working_directory, REPORT_FILE))
+            logging.info("- INFO: Wrote run report to {}".format(report_file))
+        except (IOError, OSError) as e:
+            logging.error("- ERROR: could not write the run report: {}".format(e))
+
+        return self.stats
+
+    def create_directories(self):
+        """
+        Creates the output directories
+        """
+
+        # Create the directories relative to user's working directory
+        for directory in (join(self.working_directory, PSH),
+                          join(self.working_directory, PAN),
+                          join(self.working_directory, 'uncategorized_images'),
+                          join(self.working_directory, 'shp')):
+            directory_creator(directory)
+
+    def exit_code(self):
+        """
+        Gets the process exit code for the finished job
+        :return: int. EXIT_OK, EXIT_CANCELLED, or EXIT_ERRORS if anything failed to copy
+        or match
+        """
+
+        if self.is_cancelled():
+            return EXIT_CANCELLED
+
+        if self.stats['failed'] or self.stats['unmatched_shapes'] or \
+                self.stats['ambiguous_ids'] or self.stats['collisions'] or self.stats['errors']:
+            return EXIT_ERRORS
+
+        return EXIT_OK
+
+
+class FilePipeline:
+    """
+    Streams a job instead of planning it all first. Each root is walked on its own
+    thread into a bounded queue; the job's thread parses and matches each file as it
+    arrives and hands it straight to the copy workers, so copies start while the walk
+    is still going. When the queue or the copy slots are full the walk waits, which
+    keeps memory flat however big the tree is.
+
+    Shapefiles whose image hasn't been found yet wait in a pending set until
+    it is, and are only counted as unmatched once the image walk has finished. Copies
+    can't wait for the whole tree, so an image ID that only turns out to be ambiguous
+    after shapefiles were matched to it is logged as an error instead.
+
+    When the job watches its roots, an ArrivalWatcher keeps feeding the pipeline after
+    the walk, until the watch is stopped. New and changed datasets go through the same
+    matching, and a shapefile that lands later is matched against every image seen
+    since the pipeline started. Shapefiles wait for their image until the watch ends.
+    """
+
+    def __init__(self, job, paths, destination):
+        """
+        Sets up the pipeline
+        :param job: RenameJob. options, stats, progress and report
+        :param paths: tuple. image root and shape root
+        :param destination: string. output directory
+        """
+
+        self.job = job
+        self.paths = paths
+        self.destinations = {'imagery': destination, 'shape data': join(destination, 'shp')}
+        self.extensions = {'imagery': (job.image_extension, ) +
+                           IMAGE_SIDECARS.get(job.image_extension, ()),
+                           'shape data': SHP_EXTENSIONS}
+        self.exclude_paths = (destination, )
+        self.plan_file = job.plan_file or join(destination, 'plan.csv')
+
+        self.discovered = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.finished = queue.Queue()  # copies done, recorded on the job's thread
+        self.ready = []  # heap of datasets waiting for a worker, largest first
+        self.sequence = itertools.count()  # keeps the heap first come first served on ties
+        self.workers = max(1, job.copy_workers)
+        self.in_flight = 0
+        self.stop = threading.Event()  # tells the scanners to stop early
+        self.watch_stop = threading.Event()  # tells the arrival watcher to stop
+        self.images_walked = False
+        self.arrivals = None  # ArrivalWatcher while watching
+        self.versions = {} if job.watch else None  # path -> (size, mtime) processed
+        self.rechecked = set()  # paths handed back to the arrival watcher to settle
+        self.dirty = False  # records made since the last checkpoint
+
+        self.image_index = ImageIndex()
+        self.pending = {}  # 12-digit ID -> shapefiles waiting for its image
+        self.waiting = set()  # base paths of the shapefiles in pending
+        self.matched_ids = set()  # image IDs shapefiles have been matched to
+        self.claimed = {}  # new path -> orig path that claimed it
+        self.queued = set()  # new paths handed to the copy workers
+        self.counts = {'copied': 0, 'deduplicated': 0, 'skipped': 0, 'resumed': 0,
+                       'failed': 0, 'cancelled': 0}
+
+        self.catalogs = {}
+        self.seen = {}
+        self.journal = None
+        self.manifests = {}
+        self.executor = None
+        self.plan_writer = None
+        self.limiter = job.limiter
+        self.task = partial(copy_task, partial(place_dataset, mode=job.output_mode,
+                                               algorithm=job.checksum_algorithm,
+                                               verify=job.verify_copies, report=job.report,
+                                               throttle=job.throttle,
+                                               content=job.content_index),
+                            job.cancel_event)
+
+    def run(self):
+        """
+        Runs the pipeline until both roots are walked and every copy is done, or the
+        job is cancelled
+        """
+
+        job = self.job
+        db_io = job.db_io
+
+        with job.report.stage('catalog'):
+            for step in self.destinations:
+                self.catalogs[step] = db_io.load_catalog(step)
+                self.seen[step] = set()
+
+        if db_io.session is not None:
+            self.journal = CopyJournal(db_io, job.job_key())
+
+        scanning = set(self.destinations)
+        scanners = [threading.Thread(target=scan_into,
+                                     args=(self.discovered, step, root, self.extensions[step],
+                                           job.exclude_dirs, self.exclude_paths, self.stop,
+                                           job.report, self.cached_scan(root, step)),
+                                     name='scan {}'.format(step), daemon=True)
+                    for step, root in zip(('imagery', 'shape data'), self.paths)]
+
+        watcher = None
+        if job.watch:  # started before the scan, so nothing landing during it is missed
+            required = {'imagery': (job.image_extension, ), 'shape data': SHP_REQUIRED}
+            self.arrivals = ArrivalWatcher(((step, root, self.extensions[step], required[step])
+                                            for step, root
+                                            in zip(('imagery', 'shape data'), self.paths)),
+                                           job.exclude_dirs, self.exclude_paths,
+                                           self.versions.get, job.watch_interval,
+                                           job.watch_settle)
+            watcher = threading.Thread(target=self.arrivals.run,
+                                       args=(self.discovered, self.watch_stop),
+                                       name='watch', daemon=True)
+            scanners.append(watcher)
+
+        job.progress.set_stage('streaming')
+
+        try:
+            with open(self.plan_file, 'w', newline='') as plan, \
+                    shared_pool(job.executor, self.workers) as executor:
+                self.plan_writer = csv.writer(plan)
+                self.plan_writer.writerow(PLAN_FIELDS)
+                self.executor = executor
+
+                for scanner in scanners:
+                    scanner.start()
+
+                while (scanning or self.arrivals is not None) and not job.is_cancelled():
+                    if self.arrivals is not None and (job.watch_stopped.is_set() or
+                                                      not watcher.is_alive()):
+                        self.stop_watching(scanning)
+
+                    try:
+                        step, dataset = self.discovered.get(timeout=PIPELINE_POLL)
+                    except queue.Empty:
+                        self.record_finished()
+                        if self.arrivals is not None:
+                            self.checkpoint(plan)
+                        continue
+
+                    if dataset is None:  # that root has been walked
+                        scanning.discard(step)
+                        if step == 'imagery' and self.arrivals is None:
+                            self.images_done()
+                    else:
+                        self.add_dataset(step, dataset)
+
+                    self.record_finished()
+
+                while self.in_flight or self.ready:
+                    self.record_finished(block=True)
+
+        finally:
+            self.stop.set()
+            self.watch_stop.set()
+            for scanner in scanners:
+                if scanner.is_alive():
+                    scanner.join()
+
+            for manifest in self.manifests.values():
+                manifest.close()
+
+            if self.journal is not None:
+                self.journal.commit()
+
+        job.stats['ambiguous_ids'] = sorted(self.image_index.ambiguous)
+        for key, count in self.counts.items():
+            job.stats[key] += count
+
+        if self.counts['cancelled']:
+            logging.warning("- WARNING: cancelled, {} files were not copied"
+                            .format(self.counts['cancelled']))
+
+        with job.report.stage('catalog'):
+            if not job.is_cancelled():  # a partial scan would prune files it never reached
+                for step, root in zip(('imagery', 'shape data'), self.paths):
+                    db_io.prune_catalog(step, self.catalogs[step], root, self.seen[step])
+            db_io.commit()
+
+    def stop_watching(self, scanning):
+        """
+        Ends the watch. Shapefiles still waiting for an image are unmatched once the
+        image root has been walked too.
+        :param scanning: set of the steps whose roots are still being walked
+        """
+
+        self.arrivals = None
+        self.watch_stop.set()
+        logging.info("- INFO: stopped watching for new files at {}".format(get_datetime()))
+
+        if 'imagery' not in scanning:
+            self.images_done()
+
+    def checkpoint(self, plan):
+        """
+        Writes out the plan, manifests, journal and catalog while the pipeline waits for
+        files to land, so they are current however long the watch goes on
+        :param plan: open plan file
+        """
+
+        if not self.dirty:
+            return
+
+        plan.flush()
+        for manifest in self.manifests.values():
+            manifest.flush()
+        if self.journal is not None:
+            self.journal.commit()
+        self.job.db_io.commit()
+        self.dirty = False
+
+    def cached_scan(self, root, step):
+        """
+        Gets the scan of a root from the job's scan cache
+        :return: callable returning the scanned files, or None to walk the root
+        """
+
+        if self.job.scan_cache is None:
+            return None
+
+        return partial(self.job.scan_cache.result, root, self.extensions[step],
+                       self.job.exclude_dirs, self.exclude_paths)
+
+    def add_dataset(self, step, dataset):
+        """
+        Parses and matches a dataset found by a scanner, and queues it for copying
+        :param step: string. "imagery" or "shape data"
+        :param dataset: Dataset
+        """
+
+        job = self.job
+        started = time.perf_counter()
+
+        if self.versions is not None:
+            dataset = self.new_files(dataset)
+            if dataset is None:
+                return
+
+        count = len(dataset.files)
+        job.stats['files_scanned'] += count
+        job.stats['files_processed'] += count
+        job.stats['datasets'] += 1
+        job.progress.add_scanned(count)
+        self.seen[step].update(scanned.path for scanned in dataset.files)
+
+        if step == 'imagery':
+            sid, image_type = parse_image_filename(dataset.name, job.naming_rules)
+
+            if image_type is UNCATEGORIZED:
+                logging.warning("- WARNING: Could not categorize image {}"
+                                .format(dataset.files[0].path))
+
+            if not self.image_index.add(sid, image_type) and sid in self.matched_ids:
+                text = ("- ERROR: image ID {0} turned out to be ambiguous after shapefiles "
+                        "were matched to it. Check the shapefiles in {1}"
+                        .format(sid, self.destinations['shape data']))
+                logging.error(text)
+                job.stats['errors'].append(text)
+
+            self.record(step, dataset, sid, image_type)
+
+            # Shapefiles that were waiting for this image can go now
+            for waiting in self.pending.pop(sid, ()):
+                if waiting.base in self.waiting:
+                    self.waiting.discard(waiting.base)
+                    self.add_shape(waiting)
+
+        else:
+            self.add_shape(dataset)
+
+        job.report.add_time('parse' if step == 'imagery' else 'match',
+                            time.perf_counter() - started, count)
+
+    def new_files(self, dataset):
+        """
+        Leaves out the files of a dataset that were already processed as they are now.
+        A dataset the scan found with a file changed less than the settle time ago may
+        still be being written, so it is handed to the arrival watcher to wait until it
+        holds still. That happens once per file, so a clock that is off can't keep a
+        dataset going round.
+        :param dataset: Dataset
+        :return: Dataset of the files to process, or None if there are none
+        """
+
+        versions = self.versions
+        files = [scanned for scanned in dataset.files
+                 if versions.get(scanned.path) != (scanned.size, scanned.mtime)]
+
+        if not files:
+            return None
+
+        if self.arrivals is not None:
+            fresh = time.time() - self.job.watch_settle
+            if any(scanned.mtime > fresh and scanned.path not in self.rechecked
+                   for scanned in files):
+                for scanned in files:
+                    self.rechecked.add(scanned.path)
+                    self.arrivals.recheck(scanned.path)
+                return None
+
+        versions.update((scanned.path, (scanned.size, scanned.mtime)) for scanned in files)
+        self.dirty = True
+        return dataset if len(files) == len(dataset.files) else Dataset(dataset.base, files)
+
+    def add_shape(self, dataset):
+        """
+        Matches a shapefile, or leaves it waiting for its image
+        :param dataset: Dataset
+        """
+
+        rules = self.job.naming_rules
+        sid, image_type = parse_shape_filename(dataset.name, self.image_index, rules)
+
+        if not sid:
+            sid, image_type = stored_shape_match(self.catalogs['shape data'], dataset,
+                                                 self.image_index)
+
+        if not sid and not self.images_walked:
+            candidates = shape_candidate_ids(dataset.name, rules)
+            if candidates:
+                self.waiting.add(dataset.base)
+                for candidate in candidates:
+                    self.pending.setdefault(candidate, []).append(dataset)
+                return
+
+        if sid:
+            self.matched_ids.add(sid)
+
+        self.record('shape data', dataset, sid, image_type)
+
+    def images_done(self):
+        """
+        Called once the image root has been walked. Shapefiles still waiting have no
+        image and are unmatched.
+        """
+
+        self.images_walked = True
+
+        leftovers = {dataset.base: dataset for waiting in self.pending.values()
+                     for dataset in waiting if dataset.base in self.waiting}
+        self.pending.clear()
+        self.waiting.clear()
+
+        for base in sorted(leftovers):
+            self.add_shape(leftovers[base])
+
+    def record(self, step, dataset, sid, image_type):
+        """
+        Updates the catalog with a parsed dataset, then plans it if it was matched
+        :param step: string. "imagery" or "shape data"
+        :param dataset: Dataset
+        :param sid: string. image ID, or None if unmatched
+        :param image_type: string. PAN, PSH or UNCATEGORIZED
+        """
+
+        self.job.db_io.update_dataset(step, self.catalogs[step], dataset, sid, image_type)
+
+        if sid:
+            self.plan(step, plan_dataset(self.destinations[step], dataset, sid, image_type,
+                                         step == 'shape data'))
+            return
+
+        for scanned in dataset.files:
+            if scanned.extension == '.shp':
+                logging.error("- ERROR: could not match image with filename {}"
+                              .format(scanned.path))
+                self.job.stats['unmatched_shapes'] += 1
+
+    def plan(self, step, files):
+        """
+        Writes a matched dataset to the plan and queues it for copying, unless another
+        file already claimed one of its new paths. Files an earlier run already placed
+        are left out of the copy.
+        :param step: string. "imagery" or "shape data"
+        :param files: list of PlannedFile, the files of one dataset
+        """
+
+        job = self.job
+        rows = [(file.source, file.destination, file.scene_id, file.image_type, file.size)
+                for file in files]
+
+        collisions = [file for file in files
+                      if self.claimed.get(file.destination, file.source) != file.source]
+        if collisions:
+            for file in collisions:
+                logging.error("- ERROR: Duplicate filename {0}: {1} and {2} would both be "
+                              "written there. Not copying {2}"
+                              .format(file.destination, self.claimed[file.destination],
+                                      file.source))
+            job.stats['collisions'] += len(files)
+            self.plan_writer.writerows((step, 'collision') + row for row in rows)
+            return
+
+        journal = self.journal
+        to_copy = []
+
+        for file, row in zip(files, rows):
+            self.claimed[file.destination] = file.source
+            job.stats['planned'] += 1
+
+            action = job.output_mode
+            if exists(file.destination):
+                action = 'exists'
+                job.stats['existing'] += 1
+            self.plan_writer.writerow((step, action) + row)
+
+            if journal is not None and journal.state(file) is None:
+                journal.mark(file, 'planned')
+
+            if triage_copy(file, journal, job.output_mode, self.queued, self.counts):
+                if journal is not None:
+                    journal.mark(file, 'in_progress')
+                to_copy.append(file)
+
+        if to_copy:
+            job.progress.add_copies(len(to_copy), dataset_size(to_copy))
+            self.queue_copy(step, to_copy)
+
+    def queue_copy(self, step, files):
+        """
+        Queues a dataset for the copy workers. Workers are only given a dataset once
+        they're free, and always the largest one waiting, so big images found late
+        don't end up copying on their own after everything else. While the queue is
+        full this waits for copies to finish.
+        :param step: string. "imagery" or "shape data"
+        :param files: list of PlannedFile
+        """
+
+        while len(self.ready) >= PIPELINE_QUEUE_SIZE:
+            self.record_finished(block=True)
+
+        heapq.heappush(self.ready, (-dataset_size(files), next(self.sequence), step, files))
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Hands the largest waiting datasets to the copy workers that are free
+        """
+
+        while self.ready and self.in_flight < self.workers:
+            size, sequence, step, files = heapq.heappop(self.ready)
+
+            if step not in self.manifests:
+                self.manifests[step] = ManifestWriter(self.destinations[step],
+                                                      self.job.manifest_format)
+
+            future = self.executor.submit(self.limiter.run, files[0].source,
+                                          files[0].destination, self.task, files)
+            self.in_flight += 1
+            future.add_done_callback(partial(self.copy_finished, step, files))
+
+    def copy_finished(self, step, files, future):
+        """
+        Passes a finished copy back to the job's thread. Runs on the copy worker.
+        """
+
+        self.finished.put((step, files, future))
+
+    def record_finished(self, block=False):
+        """
+        Records the copies that have finished
+        :param block: bool. wait up to PIPELINE_POLL seconds for one
+        """
+
+        while True:
+            try:
+                step, files, future = self.finished.get(block, PIPELINE_POLL)
+            except queue.Empty:
+                self.dispatch()
+                return
+
+            block = False
+            self.in_flight -= 1
+            self.dirty = True
+            if finish_copy(files, future, self.counts, self.manifests[step], self.journal,
+                           self.job.progress, self.job.report, self.job.content_index):
+                print(" - Copied file {0}, {1}".format(
+                    self.counts['copied'] + self.counts['deduplicated'],
+                    self.job.progress.remaining()))
+
+
+class ArrivalWatcher:
+    """
+    Watches the roots of a FilePipeline for files that land after it started, see
+    tree_watch. A new or changed file is only passed on once its size and mtime have
+    held for the settle time, and the files of a dataset are held until all of them
+    have settled and the dataset's required files (the image itself, or a shapefile's
+    .shp, .shx and .dbf) are all there, so it is copied as one unit. A dataset still
+    missing a required file after incomplete_wait seconds is passed on as it is, with
+    a warning, like the scan does with an incomplete dataset.
+    """
+
+    def __init__(self, roots, exclude_dirs=EXCLUDE_DIRS, exclude_paths=(), known=None,
+                 poll_interval=None, settle=WATCH_SETTLE, incomplete_wait=WATCH_INCOMPLETE):
+        """
+        Starts watching. Call before the roots are scanned, so nothing landing during
+        the scan is missed.
+        :param roots: iterable of (step, root, extensions, required extensions)
+        :param exclude_dirs: iterable of directory name globs to skip
+        :param exclude_paths: iterable of directory paths to skip
+        :param known: callable taking a path and giving the (size, mtime) it was
+        already processed with, or None. Files that haven't changed since are dropped.
+        :param poll_interval: float. poll the roots this many seconds apart instead of
+        using inotify, or None to only poll network mounts
+        :param settle: float. seconds a file has to hold still
+        :param incomplete_wait: float. seconds a dataset missing a required file is held
+        """
+
+        roots = list(roots)
+        self.roots = [(step, root, frozenset(extensions))
+                      for step, root, extensions, required in roots]
+        self.required = {step: tuple(required) for step, root, extensions, required in roots}
+        self.exclude_dirs = tuple(exclude_dirs)
+        self.exclude_paths = frozenset(path.normcase(path.abspath(directory))
+                                       for directory in exclude_paths)
+        self.known = known if known is not None else lambda file_path: None
+        self.settle = settle
+        self.incomplete_wait = incomplete_wait
+        self.extensions = frozenset().union(*(extensions for step, root, extensions
+                                              in self.roots))
+        self.candidates = {}  # path -> [step, size, mtime, time it last changed]
+        self.rechecks = queue.SimpleQueue()  # paths handed back by the pipeline
+        self.incomplete = {}  # base path -> time it was first held for a missing file
+
+        self.watcher = open_watcher((root for step, root, extensions in self.roots),
+                                    self.skip_directory, self.wanted_file, poll_interval)
+
+    def skip_directory(self, directory):
+        """
+        Checks whether a directory is excluded, like iter_tree does
+        :return: bool
+        """
+
+        return any(fnmatch(path.basename(directory), pattern) for pattern in self.exclude_dirs) \
+            or path.normcase(path.abspath(directory)) in self.exclude_paths
+
+    def wanted_file(self, name):
+        """
+        Checks whether a file has one of the extensions of a root
+        :return: bool
+        """
+
+        return splitext(name)[1] in self.extensions
+
+    def step_of(self, file_path):
+        """
+        Finds the root a file belongs to
+        :return: string. "imagery" or "shape data", or None if no root takes the file
+        """
+
+        extension = splitext(file_path)[1]
+        for step, root, extensions in self.roots:
+            if extension in extensions and file_path.startswith(join(root, '')):
+                return step
+
+        return None
+
+    def run(self, found, stop):
+        """
+        Puts (step, Dataset) on a queue for each dataset that lands, until told to
+        stop. Runs on its own thread.
+        :param found: queue.Queue, bounded
+        :param stop: threading.Event
+        """
+
+        try:
+            while not stop.is_set():
+                changes = self.watcher.changes(WATCH_CHECK)
+                while not self.rechecks.empty():
+                    changes.setdefault(self.rechecks.get(), None)
+
+                now = time.monotonic()
+                for file_path, version in changes.items():
+                    self.changed(file_path, version, now)
+
+                for item in self.settled(time.monotonic()):
+                    if not put_until_stopped(found, item, stop):
+                        return
+
+        except (IOError, OSError) as e:
+            logging.error("- ERROR: stopped watching for new files: {}".format(e))
+
+        finally:
+            self.watcher.close()
+
+    def recheck(self, file_path):
+        """
+        Has a file the scan found while it may still have been written watched until it
+        settles. Safe to call from any thread.
+        :param file_path: string
+        """
+
+        self.rechecks.put(file_path)
+
+    def changed(self, file_path, version, now):
+        """
+        Notes a file that may be new or changed
+        :param file_path: string
+        :param version: tuple (size, mtime) if the watcher knows it, or None
+        :param now: float. time.monotonic()
+        """
+
+        step = self.step_of(file_path)
+        if step is None or (version is not None and version == self.known(file_path)):
+            return
+
+        if file_path not in self.candidates:
+            self.candidates[file_path] = [step, None, None, now]
+
+    def settled(self, now):
+        """
+        Checks the files that are settling
+        :param now: float. time.monotonic()
+        :return: list of (step, Dataset) whose files have all held still
+        """
+
+        ready = {}  # base path -> (step, settled files)
+        unsettled = set()  # base paths with a file still changing
+
+        for file_path, candidate in list(self.candidates.items()):
+            step, size, mtime, since = candidate
+            base = splitext(file_path)[0]
+
+            try:
+                file_stat = stat(file_path)
+            except OSError:  # removed or moved away before it settled
+                del self.candidates[file_path]
+                continue
+
+            if (file_stat.st_size, file_stat.st_mtime) != (size, mtime):
+                candidate[1:] = [file_stat.st_size, file_stat.st_mtime, now]
+                unsettled.add(base)
+
+            elif now - since < self.settle:
+                unsettled.add(base)
+
+            elif (size, mtime) == self.known(file_path):  # changed back, or seen by the scan
+                del self.candidates[file_path]
+
+            else:
+                name = path.basename(file_path)
+                ready.setdefault(base, (step, []))[1].append(
+                    ScannedFile(file_path, name, splitext(name)[1], size, mtime))
+
+        datasets = []
+        for base in sorted(ready):
+            if base in unsettled:
+                continue
+
+            step, files = ready[base]
+            missing = [extension for extension in self.required[step]
+                       if not exists(base + extension)]
+            if missing:
+                held = now - self.incomplete.setdefault(base, now)
+                if held < self.incomplete_wait:
+                    continue
+                logging.warning("- WARNING: {0} is still missing {1} after {2:.0f} seconds, "
+                                "processing the files that arrived".format(
+                                    base, ', '.join(missing), held))
+
+            self.incomplete.pop(base, None)
+            for scanned in files:
+                del self.candidates[scanned.path]
+            files.sort(key=lambda scanned: scanned.name)
+            datasets.append((step, Dataset(base, files)))
+
+        for base in [base for base in self.incomplete if base not in ready and
+                     base not in unsettled]:  # its files were removed
+            del self.incomplete[base]
+
+        return datasets
+
+
+class QueueEntry:
+    """
+    A job waiting in a JobQueue
+    """
+
+    __slots__ = ('name', 'priority', 'sequence', 'image_path', 'shp_path',
+                 'working_directory', 'options')
+
+    def __init__(self, name, priority, sequence, image_path, shp_path, working_directory,
+                 options):
+        """
+        :param name: string. shown in the summary
+        :param priority: int. higher runs first
+        :param sequence: int. order added, breaks priority ties
+        :param options: dict of RenameJob keyword arguments for this job only
+        """
+
+        self.name = name
+        self.priority = priority
+        self.sequence = sequence
+        self.image_path = image_path
+        self.shp_path = shp_path
+        self.working_directory = working_directory
+        self.options = options
+
+
+class JobQueue:
+    """
+    Runs several deliveries in one go, highest priority first. The jobs share one copy
+    pool, one volume limiter, the catalog database and a ScanCache: the next job's roots
+    are walked while the current job copies, so the pool moves from one job's copies to
+    the next's without waiting on a scan. Jobs run one after another rather than side by
+    side because the catalog session isn't thread safe.
+
+    Each job logs to the renamer.log in its own output directory. The queue keeps a
+    summary of every job's throughput, see format_table.
+    """
+
+    def __init__(self, workers=COPY_WORKERS, volume_limit=VOLUME_COPY_LIMIT, db_io=None,
+                 progress=None, **options):
+        """
+        Initialize the queue
+        :param workers: int. size of the shared copy pool
+        :param volume_limit: int. maximum concurrent copies per volume, across all jobs
+        :param db_io: DatabaseIo shared by the jobs, or None for a new one
+        :param progress: callable taking JobProgress snapshots, or None. Snapshots also
+        hold job, jobs and job_name.
+        :param options: RenameJob keyword arguments used by every job unless its entry
+        overrides them
+        """
+
+        self.workers = workers
+        self.volume_limit = volume_limit
+        self.db_io = db_io if db_io is not None else DatabaseIo()
+        self.progress = progress
+        self.options = options
+        self.entries = []
+        self.results = []
+        self.elapsed = None
+        self.current = None
+        self.cancel_event = threading.Event()
+
+    def add(self, image_path, shp_path, working_directory, priority=0, name=None, **options):
+        """
+        Adds a job to the queue
+        :param image_path: string. image root directory
+        :param shp_path: string. shapefile root directory
+        :param working_directory: string. output directory
+        :param priority: int. higher runs first; jobs of equal priority run in the order
+        they were added
+        :param name: string. shown in the summary, defaults to the output directory name
+        :param options: RenameJob keyword arguments for this job
+        :return: QueueEntry
+        """
+
+        entry = QueueEntry(name or path.basename(path.normpath(working_directory)),
+                           priority, len(self.entries), image_path, shp_path,
+                           working_directory, options)
+        self.entries.append(entry)
+        return entry
+
+    def load(self, queue_file):
+        """
+        Adds the jobs listed in a queue file. The file is JSON: a list of jobs, or an
+        object with the list under "jobs". Each job needs image_root, shape_root and
+        output_dir, and may set name, priority and the options in QUEUE_OPTIONS.
+        :param queue_file: string
+        :return: int. jobs added
+        """
+
+        with open(queue_file) as f:
+            jobs = json.load(f)
+
+        if isinstance(jobs, dict):
+            jobs = jobs.get('jobs')
+        if not isinstance(jobs, list):
+            raise ValueError("{} holds no list of jobs".format(queue_file))
+
+        entries = [queue_entry(job, number) for number, job in enumerate(jobs, 1)]
+        for image_path, shp_path, working_directory, priority, name, options in entries:
+            self.add(image_path, shp_path, working_directory, priority, name, **options)
+
+        return len(entries)
+
+    def ordered(self):
+        """
+        Gets the entries in the order they run
+        :return: list of QueueEntry
+        """
+
+        return sorted(self.entries, key=lambda entry: (-entry.priority, entry.sequence))
+
+    def cancel(self):
+        """
+        Stops the running job between datasets and skips the rest. Safe to call from any
+        thread.
+        """
+
+        self.cancel_event.set()
+        job = self.current
+        if job is not None:
+            job.cancel()
+
+    def is_cancelled(self):
+        """
+        Checks whether the queue has been asked to stop
+        :return: bool
+        """
+
+        return self.cancel_event.is_set()
+
+    def make_job(self, entry, index, total, executor, limiter, cache):
+        """
+        Builds the RenameJob for an entry on the shared pool, limiter and cache
+        :return: RenameJob
+        """
+
+        options = dict(self.options, **entry.options)
+        progress = None
+        if self.progress is not None:
+            progress = partial(self.job_progress, index + 1, total, entry.name)
+
+        return RenameJob(entry.image_path, entry.shp_path, entry.working_directory,
+                         workers=self.workers, volume_limit=self.volume_limit,
+                         db_io=self.db_io, progress=progress, executor=executor,
+                         limiter=limiter, scan_cache=cache, **options)
+
+    def job_progress(self, number, total, name, snapshot):
+        """
+        Passes a job's progress on, saying which job it is
+        """
+
+        snapshot.update(job=number, jobs=total, job_name=name)
+        self.progress(snapshot)
+
+    def run(self):
+        """
+        Runs every job in priority order. A job that fails is recorded and the queue
+        moves on to the next.
+        :return: list of dicts, the summary of each job in the order they ran
+        """
+
+        started = time.time()
+        entries = self.ordered()
+        total = len(entries)
+        self.results = []
+
+        cache = ScanCache()
+        limiter = VolumeLimiter(self.volume_limit)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+                jobs = [self.make_job(entry, index, total, executor, limiter, cache)
+                        for index, entry in enumerate(entries)]
+
+                for index, (entry, job) in enumerate(zip(entries, jobs)):
+                    if self.is_cancelled():
+                        self.results.append(job_summary(entry, job, 'not run'))
+                        continue
+
+                    self.current = job
+                    job.prefetch_scans(cache)
+                    if index + 1 < total and not overlaps_job(jobs[index + 1], job):
+                        jobs[index + 1].prefetch_scans(cache)
+
+                    print("\n*** Job {0} of {1}: {2} ***".format(index + 1, total,
+                                                                   entry.name))
+                    try:
+                        job.run()
+                        status = 'cancelled' if job.is_cancelled() else 'finished'
+                    except Exception as e:  # one broken delivery shouldn't stop the rest
+                        print("- ERROR: job {0} failed: {1}".format(entry.name, e),
+                              file=sys.stderr)
+                        job.stats['errors'].append(str(e))
+                        status = 'failed'
+
+                    self.results.append(job_summary(entry, job, status))
+                    release_scans(cache, job, jobs[index + 1:])
+
+        finally:
+            self.current = None
+            cache.close()
+
+        self.elapsed = round(time.time() - started, 3)
+        return self.results
+
+    def exit_code(self):
+        """
+        Gets the process exit code for the finished queue
+        :return: int. EXIT_CANCELLED, EXIT_ERRORS if any job had errors, or EXIT_OK
+        """
+
+        if self.is_cancelled():
+            return EXIT_CANCELLED
+
+        if any(result['exit_code'] != EXIT_OK for result in self.results):
+            return EXIT_ERRORS
+
+        return EXIT_OK
+
+    def as_dict(self):
+        """
+        Gets the summary as plain data for JSON
+        :return: dict
+        """
+
+        placed = sum(result['files'] for result in self.results)
+        copied = sum(result['bytes_copied'] for result in self.results)
+
+        return {'jobs': self.results,
+                'elapsed_seconds': self.elapsed,
+                'files': placed,
+                'bytes_copied': copied,
+                'bytes_per_second': round(copied / self.elapsed, 1) if self.elapsed else None,
+                'exit_code': self.exit_code()}
+
+    def format_table(self):
+        """
+        Gets the summary as a table for people
+        :return: string
+        """
+
+        summary = self.as_dict()
+        row = "{0:<24} {1:>8} {2:>10} {3:>8} {4:>10} {5:>12} {6:>10}"
+        lines = [row.format('job', 'priority', 'status', 'files', 'copied', 'time', 'MB/s')]
+
+        for result in summary['jobs']:
+            lines.append(row.format(
+                result['name'][:24], result['priority'], result['status'], result['files'],
+                format_size(result['bytes_copied']),
+                format_duration(result['elapsed_seconds']),
+                '-' if result['bytes_per_second'] is None
+                else '{:.1f}'.format(result['bytes_per_second'] / 1048576.0)))
+
+        lines += ["",
+                  "{0} jobs, {1} files, {2} copied in {3}{4}".format(
+                      len(summary['jobs']), summary['files'],
+                      format_size(summary['bytes_copied']),
+                      format_duration(summary['elapsed_seconds']),
+                      '' if summary['bytes_per_second'] is None
+                      else ' at {:.1f} MB/s'.format(summary['bytes_per_second'] / 1048576.0))]
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, base_path):
+        """
+        Writes the summary as JSON and as a table
+        :param base_path: string. path without extension
+        :return: string. path of the table
+        """
+
+        with open(base_path + '.json', 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+        with open(base_path + '.txt', 'w') as f:
+            f.write(self.format_table())
+
+        return base_path + '.txt'
+
+
+def queue_entry(job, number):
+    """
+    Checks one job of a queue file
+    :param job: dict read from the file
+    :param number: int. position in the file, for error messages
+    :return: tuple (image root, shape root, output dir, priority, name, RenameJob options)
+    """
+
+    if not isinstance(job, dict):
+        raise ValueError("job {} is not an object".format(number))
+
+    missing = [key for key in ('image_root', 'shape_root', 'output_dir') if not job.get(key)]
+    if missing:
+        raise ValueError("job {0} has no {1}".format(number, ', '.join(missing)))
+
+    unknown = set(job) - set(QUEUE_OPTIONS) - {'image_root', 'shape_root', 'output_dir',
+                                               'priority', 'name'}
+    if unknown:
+        raise ValueError("job {0} has unknown options: {1}".format(
+            number, ', '.join(sorted(unknown))))
+
+    for key in ('image_root', 'shape_root'):
+        if not path.isdir(job[key]):
+            raise ValueError("job {0}: {1} is not a directory".format(number, job[key]))
+
+    choices = {'image_type': ('.img', '.tif'), 'mode': OUTPUT_MODES, 'match': MATCH_MODES,
+               'checksum': tuple(CHECKSUM_ALGORITHMS), 'dedup': DEDUP_MODES + (None, ),
+               'manifest_format': MANIFEST_FORMATS}
+    for key, allowed in choices.items():
+        if key in job and job[key] not in allowed:
+            raise ValueError("job {0}: {1} must be one of {2}".format(
+                number, key, ', '.join(str(choice) for choice in allowed)))
+
+    try:
+        priority = int(job.get('priority', 0))
+    except (TypeError, ValueError):
+        raise ValueError("job {}: priority must be a whole number".format(number))
+
+    options = {QUEUE_OPTIONS[key]: value for key, value in job.items() if key in QUEUE_OPTIONS}
+    if 'exclude_dirs' in options:
+        options['exclude_dirs'] = tuple(options['exclude_dirs'])
+    if 'naming_rules' in options:
+        try:
+            options['naming_rules'] = NamingRules.load(options['naming_rules'])
+        except (IOError, OSError, ValueError) as e:
+            raise ValueError("job {0}: could not load naming rules: {1}".format(number, e))
+
+    return (job['image_root'], job['shape_root'], job['output_dir'], priority,
+            job.get('name'), options)
+
+
+def job_summary(entry, job, status):
+    """
+    Summarizes how a queued job went
+    :param entry: QueueEntry
+    :param job: RenameJob, after running or not
+    :param status: string. finished, cancelled, failed or not run
+    :return: dict
+    """
+
+    stats = job.stats
+    elapsed = stats.get('elapsed_seconds')
+    copy_seconds = job.report.stages.get('copy', [0.0])[0]
+
+    return {'name': entry.name,
+            'priority': entry.priority,
+            'image_root': entry.image_path,
+            'shape_root': entry.shp_path,
+            'output_dir': entry.working_directory,
+            'status': status,
+            'exit_code': EXIT_ERRORS if status == 'failed' else
+            EXIT_CANCELLED if status == 'not run' else job.exit_code(),
+            'files': stats['copied'] + stats['deduplicated'],
+            'failed': stats['failed'],
+            'unmatched_shapes': stats['unmatched_shapes'],
+            'bytes_copied': job.report.bytes_copied,
+            'elapsed_seconds': elapsed,
+            'bytes_per_second': round(job.report.bytes_copied / elapsed, 1)
+            if elapsed else None,
+            'copy_bytes_per_second': round(job.report.bytes_copied / copy_seconds, 1)
+            if copy_seconds else None}
+
+
+def overlaps_job(job, running):
+    """
+    Checks whether a job reads a directory another job changes, so its scan has to wait
+    until that job is done
+    :param job: RenameJob to be scanned
+    :param running: RenameJob running now
+    :return: bool
+    """
+
+    changed = [running.working_directory]
+    if running.output_mode == 'move':
+        changed += [running.image_path, running.shp_path]
+
+    return any(paths_overlap(root, directory) for root in (job.image_path, job.shp_path)
+               for directory in changed)
+
+
+def release_scans(cache, job, remaining):
+    """
+    Drops the cached scans a finished job leaves behind: those no later job reads, and
+    those of directories the job changed
+    :param cache: ScanCache
+    :param job: RenameJob, finished
+    :param remaining: list of RenameJob still to run
+    """
+
+    for root in (job.image_path, job.shp_path):
+        if all(root not in (later.image_path, later.shp_path) for later in remaining):
+            cache.discard(root)
+
+    for later in remaining:
+        if overlaps_job(later, job):
+            cache.discard(later.image_path)
+            cache.discard(later.shp_path)
+
+
+def paths_overlap(first, second):
+    """
+    Checks whether two directories are the same or one holds the other
+    :return: bool
+    """
+
+    first = join(path.normcase(path.abspath(first)), '')
+    second = join(path.normcase(path.abspath(second)), '')
+    return first.startswith(second) or second.startswith(first)
+
+
+class ScannedFile:
+    """
+    A file found by the scan, with the stat results it was found with
+    """
+
+    __slots__ = ('path', 'name', 'extension', 'size', 'mtime')
+
+    def __init__(self, path, name, extension, size, mtime):
+        self.path = path
+        self.name = name
+        self.extension = extension
+        self.size = size
+        self.mtime = mtime
+
+    def __reduce__(self):
+        # Rebuilt through __init__, about twice as fast to unpickle as the default for
+        # slots. Scan processes send back a lot of these.
+        return ScannedFile, (self.path, self.name, self.extension, self.size, self.mtime)
+
+    def __repr__(self):
+        return 'ScannedFile({!r})'.format(self.path)
+
+
+class Dataset:
+    """
+    The files of one dataset, found together in a directory under the same base name:
+    an image and its .ige/.rrd/.rde sidecars, or the .shp/.dbf/.shx/.prj of a
+    shapefile. A dataset is matched once and copied as one unit.
+    """
+
+    __slots__ = ('base', 'files', 'size')
+
+    def __init__(self, base, files):
+        """
+        :param base: string. path of the files without their extension
+        :param files: list of ScannedFile
+        """
+
+        self.base = base
+        self.files = files
+        self.size = sum(scanned.size for scanned in files)
+
+    @property
+    def name(self):
+        """
+        Name of the first file, which is what the dataset is parsed and matched by.
+        Every file of the set gives the same result, since only the extension differs.
+        """
+
+        return self.files[0].name
+
+    def __reduce__(self):
+        return Dataset, (self.base, self.files)
+
+    def __repr__(self):
+        return 'Dataset({0!r}, {1} files)'.format(self.base, len(self.files))
+
+
+class PlannedFile:
+    """
+    A file the plan will place, shared by planning, copying, the journal and the
+    manifest
+    """
+
+    __slots__ = ('source', 'destination', 'scene_id', 'image_type', 'size', 'dataset')
+
+    def __init__(self, source, destination, scene_id, image_type, size, dataset=None):
+        """
+        :param source: string. path of the file found by the scan
+        :param destination: string. path it will be placed at
+        :param scene_id: string. interned image ID
+        :param image_type: string. PAN, PSH or UNCATEGORIZED
+        :param size: int. bytes
+        :param dataset: string. base path of the Dataset the file belongs to, shared by
+        the files of the set. None places the file on its own.
+        """
+
+        self.source = source
+        self.destination = destination
+        self.scene_id = scene_id
+        self.image_type = image_type
+        self.size = size
+        self.dataset = dataset if dataset is not None else source
+
+    def __repr__(self):
+        return 'PlannedFile({0!r} -> {1!r})'.format(self.source, self.destination)
+
+
+def scan_tree(root, extensions, exclude_dirs=EXCLUDE_DIRS, exclude_paths=(),
+              warn=logging.warning):
+    """
+    Finds files with the given extensions under a directory. Excluded directories are
+    pruned before they are descended into, and each file is stat'd only once.
+    :param root: string. directory to scan
+    :param extensions: iterable of extensions to keep, e.g. ('.shp', '.dbf')
+    :param exclude_dirs: iterable of directory name globs to skip
+    :param exclude_paths: iterable of directory paths to skip
+    :param warn: callable taking the warning for a directory or file that can't be read
+    :return: list of ScannedFile
+    """
+
+    return list(iter_tree(root, extensions, exclude_dirs, exclude_paths, warn))
+
+
+def iter_tree(root, extensions, exclude_dirs=EXCLUDE_DIRS, exclude_paths=(),
+              warn=logging.warning, subdirectories=None):
+    """
+    Like scan_tree, but yields each file as soon as it is found
+    :param subdirectories: list. if given, only the root's own files are yielded and
+    its subdirectories are appended here instead of walked
+    :return: generator of ScannedFile
+    """
+
+    extensions = frozenset(extensions)
+    exclude_dirs = tuple(exclude_dirs)
+    exclude_paths = frozenset(path.normcase(path.abspath(p)) for p in exclude_paths)
+
+    directories = [root]
+
+    while directories:
+        directory = directories.pop()
+
+        try:
+            entries = scandir(directory)
+        except OSError as e:
+            warn("- WARNING: could not scan {0}: {1}".format(directory, e))
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not any(fnmatch(entry.name, pattern) for pattern in exclude_dirs) and \
+                            path.normcase(path.abspath(entry.path)) not in exclude_paths:
+                        (directories if subdirectories is None else
+                         subdirectories).append(entry.path)
+                    continue
+
+                extension = splitext(entry.name)[1]
+                if extension in extensions:
+                    try:
+                        entry_stat = entry.stat()  # free on Windows, one call elsewhere
+                    except OSError as e:
+                        warn("- WARNING: could not stat {0}: {1}".format(entry.path, e))
+                        continue
+
+                    yield ScannedFile(entry.path, entry.name, extension,
+                                      entry_stat.st_size, entry_stat.st_mtime)
+
+
+def group_datasets(scanned_files):
+    """
+    Groups scanned files into datasets by base name. The scan lists a directory's files
+    together, so a group is complete as soon as the scan moves on to another
+    directory and only one directory is ever held.
+    :param scanned_files: iterable of ScannedFile, such as from iter_tree
+    :return: generator of Dataset
+    """
+
+    directory = None
+    groups = {}  # base path -> files
+
+    for scanned in scanned_files:
+        # The scan already split the name, so slicing the path is enough
+        base = scanned.path[:len(scanned.path) - len(scanned.extension)]
+        parent = scanned.path[:len(scanned.path) - len(scanned.name)]
+
+        if parent != directory:
+            for group_base, files in groups.items():
+                yield Dataset(group_base, files)
+            groups = {}
+            directory = parent
+
+        groups.setdefault(base, []).append(scanned)
+
+    for group_base, files in groups.items():
+        yield Dataset(group_base, files)
+
+
+def plan_dataset(destination, dataset, sid, image_type, shape=False):
+    """
+    Plans the files of a matched dataset
+    :param destination: string. output directory of the step
+    :param dataset: Dataset
+    :param sid: string. image ID
+    :param image_type: string. PAN, PSH or UNCATEGORIZED
+    :param shape: bool. the dataset is a shapefile
+    :return: list of PlannedFile
+    """
+
+    return [PlannedFile(scanned.path, planned_path(destination, scanned, sid, image_type,
+                                                   shape),
+                        sid, image_type, scanned.size, dataset.base)
+            for scanned in dataset.files]
+
+
+def stored_match(catalog, dataset):
+    """
+    Gets what earlier runs recorded for a dataset, as long as none of its files has
+    changed since and they all agree
+    :param catalog: dict returned by DatabaseIo.load_catalog
+    :param dataset: Dataset
+    :return: tuple (ID, type) as stored, or None if the dataset has to be parsed
+    """
+
+    stored = None
+
+    for scanned in dataset.files:
+        entry = catalog.get(scanned.path)
+        if entry is None or entry.size != scanned.size or entry.mtime != scanned.mtime:
+            return None
+
+        if stored is None:
+            stored = (entry.scene_id, entry.image_type)
+        elif stored != (entry.scene_id, entry.image_type):
+            return None
+
+    return stored
+
+
+def stored_shape_match(catalog, dataset, image_index):
+    """
+    Gets the image an earlier run matched a shapefile to, as long as the shapefile
+    hasn't changed and the image is still in this run's index
+    :param catalog: dict returned by DatabaseIo.load_catalog
+    :param dataset: Dataset
+    :param image_index: ImageIndex built from the image files
+    :return: tuple (ID, type), or (None, None)
+    """
+
+    stored = stored_match(catalog, dataset)
+
+    if stored is not None and stored[0] and image_index.lookup(stored[0]) == stored:
+        return image_index.lookup(stored[0])
+
+    return None, None
+
+
+def scan_roots(roots, exclude_dirs=EXCLUDE_DIRS, exclude_paths=(), cache=None):
+    """
+    Scans several roots at the same time. Scanning is mostly waiting on the
+    filesystem, so this overlaps the round trips to each share.
+    :param roots: iterable of (root, extensions) pairs
+    :param exclude_dirs: iterable of directory name globs to skip
+    :param exclude_paths: iterable of directory paths to skip
+    :param cache: ScanCache to take the scans from, or None
+    :return: list holding the scan_tree result for each root, in order
+    """
+
+    roots = list(roots)
+
+    if cache is not None:
+        for root, extensions in roots:  # start them all before waiting on any
+            cache.scan(root, extensions, exclude_dirs, exclude_paths)
+        return [cache.result(root, extensions, exclude_dirs, exclude_paths)
+                for root, extensions in roots]
+
+    with ThreadPoolExecutor(max_workers=max(1, len(roots))) as executor:
+        futures = [executor.submit(scan_tree, root, extensions, exclude_dirs, exclude_paths)
+                   for root, extensions in roots]
+
+        return [future.result() for future in futures]
+
+
+def scan_roots_parallel(roots, processes=SCAN_PROCESSES, exclude_dirs=EXCLUDE_DIRS,
+                        exclude_paths=(), rules=None):
+    """
+    Scans and parses several roots on a pool of processes. Each root is split into
+    subtrees (see split_tree) that the processes walk, group into datasets and parse,
+    and the results are merged back in subtree order. On archive-sized trees most of
+    the time goes into building file records and splitting names, which threads can't
+    spread over more than one core.
+    :param roots: iterable of (root, extensions, shapes). shapes is a bool: parse the
+    names as shapefiles rather than images
+    :param processes: int. size of the pool
+    :param exclude_dirs: iterable of directory name globs to skip
+    :param exclude_paths: iterable of directory paths to skip
+    :param rules: NamingRules to parse the names with, or None for the default rule
+    :return: list holding each root's list of (Dataset, parsed), in order. parsed is
+    what parse_image_filename gives for images and shape_candidate_ids for shapes.
+    """
+
+    roots = list(roots)
+    scans = []
+
+    with ProcessPoolExecutor(max_workers=max(1, processes)) as executor:
+        futures = []
+        for root, extensions, shapes in roots:
+            files, subtrees = split_tree(root, extensions, exclude_dirs, exclude_paths,
+                                         processes * SCAN_SUBTREES_PER_PROCESS)
+            scans.append(parse_datasets(group_datasets(files), shapes, rules))
+            futures.append([executor.submit(scan_subtree, subtree, extensions, exclude_dirs,
+                                            exclude_paths, shapes, rules)
+                            for subtree in subtrees])
+
+        for scan, root_futures in zip(scans, futures):
+            for future in root_futures:
+                datasets, warnings = future.result()
+                for warning in warnings:
+                    logging.warning(warning)
+                scan.extend(datasets)
+
+    return scans
+
+
+def split_tree(root, extensions, exclude_dirs=EXCLUDE_DIRS, exclude_paths=(), subtrees=1):
+    """
+    Splits a tree into subtrees to scan separately. The top-level subdirectories are
+    split a level further, down to SCAN_SPLIT_DEPTH, while there are fewer than wanted,
+    so one big order directory doesn't end up on a single process.
+    :param root: string. directory to split
+    :param extensions: iterable of extensions to keep
+    :param exclude_dirs: iterable of directory name globs to skip
+    :param exclude_paths: iterable of directory paths to skip
+    :param subtrees: int. subtrees wanted
+    :return: tuple (list of ScannedFile in the directories above the subtrees, sorted
+    list of subtree directories)
+    """
+
+    files = []
+    directories = [root]
+
+    for _ in range(SCAN_SPLIT_DEPTH):
+        subdirectories = []
+        for directory in directories:
+            files.extend(iter_tree(directory, extensions, exclude_dirs, exclude_paths,
+                                   subdirectories=subdirectories))
+        directories = subdirectories
+
+        if len(directories) >= subtrees:
+            break
+
+    return files, sorted(directories)
+
+
+def scan_subtree(root, extensions, exclude_dirs, exclude_paths, shapes, rules=None):
+    """
+    Walks and parses one subtree. Runs in a scan process, so warnings are passed back
+    to be logged by the job.
+    :return: tuple (list of (Dataset, parsed), list of warnings)
+    """
+
+    warnings = []
+    files = iter_tree(root, extensions, exclude_dirs, exclude_paths, warnings.append)
+    return parse_datasets(group_datasets(files), shapes, rules), warnings
+
+
+def parse_datasets(datasets, shapes, rules=None):
+    """
+    Parses the name of each dataset
+    :param datasets: iterable of Dataset
+    :param shapes: bool. get shapefile candidate IDs rather than image IDs and types
+    :param rules: NamingRules to parse the names with, or None for the default rule
+    :return: list of (Dataset, parsed)
+    """
+
+    rules = NAMING_RULES if rules is None else rules
+    parse = rules.shape_candidates if shapes else rules.parse_image
+    return [(dataset, parse(dataset.name)) for dataset in datasets]
+
+
+def scan_into(found, step, root, extensions, exclude_dirs=EXCLUDE_DIRS, exclude_paths=(),
+              stop=None, report=None, scan=None):
+    """
+    Walks a root on its own thread, putting (step, Dataset) on a queue as datasets
+    are found and (step, None) once the walk is done. While the queue is full the walk
+    waits, so it never runs far ahead of whatever is taking datasets off the queue.
+    :param found: queue.Queue, bounded
+    :param step: string. "imagery" or "shape data"
+    :param root: string. directory to scan
+    :param extensions: iterable of extensions to keep
+    :param exclude_dirs: iterable of directory name globs to skip
+    :param exclude_paths: iterable of directory paths to skip
+    :param stop: threading.Event. once set the walk ends early, or None
+    :param report: RunReport to add the walk time to, or None
+    :param scan: callable returning the files from a ScanCache instead of walking the
+    root, or None
+    """
+
+    started = time.perf_counter()
+    count = 0
+
+    try:
+        if scan is None:
+            files = iter_tree(root, extensions, exclude_dirs, exclude_paths)
+        else:
+            files = scan()
+
+        for dataset in group_datasets(files):
+            if (stop is not None and stop.is_set()) or \
+                    not put_until_stopped(found, (step, dataset), stop):
+                return
+            count += len(dataset.files)
+
+    finally:
+        put_until_stopped(found, (step, None), stop)
+        if report is not None:
+            report.add_time('walk', time.perf_counter() - started, count)
+
+
+def put_until_stopped(found, item, stop=None):
+    """
+    Puts an item on a bounded queue, waiting for room unless told to stop
+    :param found: queue.Queue
+    :param item: anything
+    :param stop: threading.Event, or None
+    :return: bool. False if stopped before the item was put
+    """
+
+    while True:
+        try:
+            found.put(item, timeout=PIPELINE_POLL)
+            return True
+        except queue.Full:
+            if stop is not None and stop.is_set():
+                return False
+
+
+class ScanCache:
+    """
+    Scans shared by the jobs of a JobQueue. Each root is walked once however many jobs
+    read it, and the queue starts the next job's walks while the current job copies.
+    Scans are kept until JobQueue drops them with discard. Warnings from a walk are held
+    and logged by whichever job takes the scan, so they land in that job's log.
+    """
+
+    def __init__(self, workers=SCAN_CACHE_WORKERS):
+        """
+        Initialize the cache
+        :param workers: int. roots walked at once
+        """
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.scans = {}  # (root, extensions, exclude dirs, exclude paths) -> Future
+        self.lock = threading.Lock()  # FilePipeline asks from its scanner threads
+
+    def scan(self, root, extensions, exclude_dirs=EXCLUDE_DIRS, exclude_paths=()):
+        """
+        Gets the scan of a root, starting it unless it was asked for before
+        :param root: string. directory to scan
+        :param extensions: iterable of extensions to keep
+        :param exclude_dirs: iterable of directory name globs to skip
+        :param exclude_paths: iterable of directory paths to skip
+        :return: concurrent.futures.Future of the walk result
+        """
+
+        key = (path.normcase(path.abspath(root)), tuple(extensions), tuple(exclude_dirs),
+               frozenset(path.normcase(path.abspath(p)) for p in exclude_paths))
+
+        with self.lock:
+            future = self.scans.get(key)
+            if future is None:
+                future = self.scans[key] = self.executor.submit(
+                    self.walk, root, extensions, exclude_dirs, exclude_paths)
+
+        return future
+
+    def result(self, root, extensions, exclude_dirs=EXCLUDE_DIRS, exclude_paths=()):
+        """
+        Waits for the scan of a root, logging the warnings its walk had
+        :return: list of ScannedFile, see scan_tree
+        """
+
+        files, warnings = self.scan(root, extensions, exclude_dirs, exclude_paths).result()
+
+        for warning in warnings:
+            logging.warning(warning)
+
+        return files
+
+    @staticmethod
+    def walk(root, extensions, exclude_dirs, exclude_paths):
+        """
+        Scans a root on the cache's pool
+        :return: tuple (list of ScannedFile, list of warnings)
+        """
+
+        warnings = []
+        return scan_tree(root, extensions, exclude_dirs, exclude_paths, warnings.append), \
+            warnings
+
+    def discard(self, root):
+        """
+        Forgets the scans of a root
+        :param root: string
+        """
+
+        root = path.normcase(path.abspath(root))
+
+        with self.lock:
+            for key in [key for key in self.scans if key[0] == root]:
+                self.scans.pop(key).cancel()
+
+    def close(self):
+        """
+        Drops every scan and stops the walks not started yet
+        """
+
+        with self.lock:
+            for future in self.scans.values():
+                future.cancel()
+            self.scans.clear()
+
+        self.executor.shutdown()
+
+
+def planned_path(destination, scanned, sid, image_type, shape=False):
+    """
+    Gets the path a matched file is renamed to
+    :param destination: string. output directory of the step (shapes go in <output>/shp)
+    :param scanned: ScannedFile
+    :param sid: string. image ID
+    :param image_type: string. PAN, PSH or UNCATEGORIZED
+    :param shape: bool. the file is a shapefile component
+    :return: string
+    """
+
+    if shape:
+        return join(destination, "{0}_{1}{2}".format(sid, image_type, scanned.extension))
+
+    # Sort images based on pan or psh
+    if image_type in IMAGE_TYPES:
+        return join(destination, image_type,
+                    "{0}_{1}{2}".format(sid, image_type, scanned.extension))
+
+    # Don't rename - just copy. Will have to manually modify name to be sure it's accurate.
+    return join(destination, 'uncategorized_images', scanned.name)
+
+
+class NamingRule:
+    """
+    One naming convention, compiled into token tables and a token pattern. A name is
+    cut into tokens at the separators in one pass and the upper-cased tokens are looked
+    up in the tables, so matching ignores case and only whole tokens count: PAN matches
+    1234_Pan_P001.img but not PANAMA.img.
+    """
+
+    def __init__(self, name='default', match=None, separators='-._', scene_id=None,
+                 types=None, shape_kinds=('PIXEL', ), id_pattern=r'\d{12}'):
+        """
+        :param name: string. shown in errors
+        :param match: string. regex a filename has to contain for the rule to apply, or
+        None to apply to every name
+        :param separators: string. characters between tokens
+        :param scene_id: string. regex whose "id" group, or whole match, is the scene ID
+        of an image. None takes the first token.
+        :param types: dict. PAN or PSH -> list of tokens naming it. When a name has tokens
+        of both, the type listed first wins.
+        :param shape_kinds: iterable of tokens marking a shapefile that is matched to an
+        image by name, like PIXEL in PIXEL_SHAPE
+        :param id_pattern: string. regex a token has to match in full to be a candidate
+        image ID in a shapefile name
+        """
+
+        if types is None:
+            types = {PAN: ('PAN', ), PSH: ('PSH', )}
+
+        if not separators:
+            raise ValueError("rule {}: needs at least one separator".format(name))
+
+        self.name = name
+        self.separator = separators[0]
+        self.other_separators = separators[1:]
+
+        # Token tables are short, so list searches beat hashing every token into a set
+        self.type_tokens = []  # (token, PAN/PSH) in order of precedence
+        for image_type, words in types.items():
+            if image_type.upper() not in IMAGE_TYPES:
+                raise ValueError("rule {0}: image types are {1}".format(
+                    name, ', '.join(IMAGE_TYPES)))
+            if isinstance(words, str):
+                words = [words]
+            self.type_tokens.extend((word.upper(), PAN if image_type.upper() == PAN else PSH)
+                                    for word in words)
+
+        self.shape_kinds = [kind.upper() for kind in shape_kinds]
+
+        # IDs are found in the name with every separator replaced by the first one
+        separator = re.escape(self.separator)
+        try:
+            self.match = re.compile(match, re.IGNORECASE) if match else None
+            self.scene_id = re.compile(scene_id, re.IGNORECASE) if scene_id else None
+            self.ids = re.compile('(?<![^{0}])(?:{1})(?![^{0}])'.format(separator, id_pattern),
+                                  re.IGNORECASE)
+        except re.error as e:
+            raise ValueError("rule {0}: {1}".format(name, e))
+
+    def applies_to(self, filename):
+        """
+        Checks whether a filename follows this rule's convention
+        :return: bool
+        """
+
+        return self.match is None or self.match.search(filename) is not None
+
+    def parse_image(self, filename):
+        """
+        Gets the scene ID and product type of an image
+        :param filename: string. file name, without directory
+        :return: tuple (interned ID, PAN/PSH/UNCATEGORIZED)
+        """
+
+        name = filename.upper()
+        for separator in self.other_separators:
+            name = name.replace(separator, self.separator)
+        tokens = name.split(self.separator)
+
+        if self.scene_id is not None:
+            found = self.scene_id.search(filename)
+            sid = '' if found is None else found.groupdict().get('id') or found.group()
+        elif len(name) == len(filename):
+            sid = filename[:len(tokens[0])]
+        else:  # upper-casing changed the length, like ß -> SS
+            sid = filename
+            for separator in self.other_separators:
+                sid = sid.replace(separator, self.separator)
+            sid = sid.split(self.separator, 1)[0]
+        sid = sys.intern(sid)
+
+        for token, image_type in self.type_tokens:
+            if token in tokens:
+                return sid, image_type
+
+        return sid, UNCATEGORIZED
+
+    def shape_candidates(self, filename):
+        """
+        Gets the image IDs a shapefile component could be matched to by name
+        :param filename: string. file name, without directory
+        :return: list of interned IDs, empty unless the name has a shape kind token
+        """
+
+        for separator in self.other_separators:
+            filename = filename.replace(separator, self.separator)
+        tokens = filename.upper().split(self.separator)
+
+        for kind in self.shape_kinds:
+            if kind in tokens:
+                return [sys.intern(sid) for sid in self.ids.findall(filename)]
+
+        return []
+
+
+class NamingRules:
+    """
+    The naming rules a job parses filenames with: vendor rules from a rules file,
+    tried in order, then the default rule. See NamingRules.load for the file format.
+    """
+
+    def __init__(self, rules=()):
+        """
+        :param rules: iterable of NamingRule, tried before the default rule
+        """
+
+        self.rules = list(rules) + [NamingRule()]
+
+        if len(self.rules) == 1:  # skip rule_for when there's only the default
+            self.parse_image = self.rules[0].parse_image
+            self.shape_candidates = self.rules[0].shape_candidates
+
+    @classmethod
+    def load(cls, rules_file):
+        """
+        Reads vendor rules from a JSON file, a list of rules or an object with the list
+        under "rules". Each rule takes the arguments of NamingRule, for example
+        {"name": "vendor", "match": "^VND", "types": {"PAN": ["PAN", "P1BS"],
+        "PSH": ["PSH", "PS"]}, "shape_kinds": ["PIXEL", "FOOTPRINT"]}
+        :param rules_file: string
+        :return: NamingRules
+        """
+
+        with open(rules_file) as f:
+            rules = json.load(f)
+
+        if isinstance(rules, dict):
+            rules = rules.get('rules')
+        if not isinstance(rules, list):
+            raise ValueError("{} holds no list of rules".format(rules_file))
+
+        try:
+            return cls(NamingRule(**rule) for rule in rules)
+        except TypeError as e:  # unknown or missing keys
+            raise ValueError("{0}: {1}".format(rules_file, e))
+
+    def rule_for(self, filename):
+        """
+        Gets the first rule that applies to a filename
+        :return: NamingRule
+        """
+
+        for rule in self.rules:
+            if rule.applies_to(filename):
+                return rule
+
+        return self.rules[-1]
+
+    def parse_image(self, filename):
+        """
+        Gets the scene ID and product type of an image, see NamingRule.parse_image
+        """
+
+        return self.rule_for(filename).parse_image(filename)
+
+    def shape_candidates(self, filename):
+        """
+        Gets the candidate IDs of a shapefile, see NamingRule.shape_candidates
+        """
+
+        return self.rule_for(filename).shape_candidates(filename)
+
+
+NAMING_RULES = NamingRules()  # the default rule only
+
+
+@lru_cache(maxsize=None)
+def default_naming_rules():
+    """
+    Gets the naming rules jobs use unless they're given others: those in
+    NAMING_RULES_FILE next to the application if there is one, otherwise the default
+    rule
+    :return: NamingRules
+    """
+
+    rules_file = join(get_application_path(), NAMING_RULES_FILE)
+    if not exists(rules_file):
+        return NAMING_RULES
+
+    try:
+        return NamingRules.load(rules_file)
+    except (IOError, OSError, ValueError) as e:
+        print("- WARNING: could not load naming rules from {0}, using the default: {1}"
+              .format(rules_file, e), file=sys.stderr)
+        return NAMING_RULES
+
+
+def shape_candidate_ids(filename, rules=None):
+    """
+    Gets the image IDs a shapefile component could be matched to by name
+    :param filename: string. file name, without directory
+    :param rules: NamingRules, or None for the default rule
+    :return: list of IDs, empty if the name has no shape kind token like PIXEL
+    """
+
+    return (NAMING_RULES if rules is None else rules).shape_candidates(filename)
+
+
+def parse_image_filename(filename, rules=None):
+    """
+    Gets the ID and pansharpening status of an image from its filename
+    :param filename: string. file name, without directory
+    :param rules: NamingRules, or None for the default rule
+    :return: tuple (ID, PAN/PSH/UNCATEGORIZED). The ID is interned, so the files of a
+    scene share one string
+    """
+
+    return (NAMING_RULES if rules is None else rules).parse_image(filename)
+
+
+def intern_id(sid, image_type):
+    """
+    Interns an ID and type passed back by a scan process, like parse_image_filename does
+    :param sid: string. image ID
+    :param image_type: string. PAN, PSH or Uncategorized
+    :return: tuple (ID, type)
+    """
+
+    image_type = {PAN: PAN, PSH: PSH}.get(image_type, UNCATEGORIZED)
+    return sys.intern(sid), image_type
+
+
+def parse_shape_filename(filename, image_index, rules=None):
+    """
+    Matches a shapefile component to an image by the ID in its filename. Only names with
+    a shape kind token, PIXEL_SHAPE files by default, are matched.
+    :param filename: string. file name, without directory
+    :param image_index: ImageIndex built from the image files
+    :param rules: NamingRules, or None for the default rule
+    :return: matched id (string) and image type
+    """
+
+    return match_candidate_ids(shape_candidate_ids(filename, rules), image_index)
+
+
+class ImageIndex:
+    """
+    Lookup table of image IDs built once during the imagery pass, so each shapefile
+    component can be matched to its image in constant time.
+    """
+
+    def __init__(self):
+        """
+        Initialize the index
+        """
+
+        self.ids = {}  # 12-digit scene ID -> (ID, PAN/PSH type)
+        self.ambiguous = {}  # scene ID -> set of conflicting types
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, sid):
+        return sid in self.ids
+
+    def add(self, sid, image_type):
+        """
+        Adds an image ID to the index. An ID seen as both PAN and PSH is flagged as
+        ambiguous instead of silently taking the last type seen.
+        :param sid: string. image ID
+        :param image_type: string. PAN, PSH or Uncategorized
+        :return: bool. False if the ID is now ambiguous
+        """
+
+        existing = self.ids.get(sid)
+
+        if existing is None or existing[1] is UNCATEGORIZED:
+            self.ids[sid] = (sid, image_type)
+
+        elif image_type not in (existing[1], UNCATEGORIZED):
+            types = self.ambiguous.setdefault(sid, {existing[1]})
+            if image_type not in types:
+                types.add(image_type)
+                text = ("- WARNING: image ID {0} found with multiple image types: {1}"
+                        .format(sid, ', '.join(sorted(types))))
+                logging.warning(text)
+
+        return sid not in self.ambiguous
+
+    def lookup(self, sid):
+        """
+        Finds an image ID in the index
+        :param sid: string. image ID
+        :return: tuple (ID, type), or None if the ID is unknown or ambiguous
+        """
+
+        if sid in self.ambiguous:
+            return None
+
+        return self.ids.get(sid)
+
+
+def match_candidate_ids(candidates, image_index):
+    """
+    Matches a shapefile to the first of its candidate IDs that is in the index
+    :param candidates: iterable of candidate IDs from the filename, in order
+    :param image_index: ImageIndex built from the image files
+    :return: matched id (string) and image type
+    """
+
+    for value in candidates:
+        if value in image_index.ambiguous:
+            text = ("- ERROR: image ID {0} is ambiguous ({1}). Not matching "
+                    "shapefile to it.".format(value,
+                                              ', '.join(sorted(image_index.ambiguous[value]))))
+            logging.error(text)
+            return None, None
+
+        image_id = image_index.lookup(value)
+        if image_id:
+            return image_id
+
+    return None, None
+
+
+class ManifestWriter:
+    """
+    List of input/output files. The manifest stays open for the whole run and is
+    written in batches, each one flushed to disk, so a killed run leaves a manifest
+    that is complete up to the last batch. A timer thread writes held records once
+    they are interval seconds old, so they reach the disk even while a long copy means
+    no record follows them.
+    """
+
+    def __init__(self, destination, manifest_format=MANIFEST_FORMAT,
+                 batch_size=MANIFEST_BATCH_SIZE, interval=MANIFEST_INTERVAL):
+        """
+        Opens the manifest in a directory, appending to any earlier one
+        :param destination: string. directory holding the manifest
+        :param manifest_format: string. one of MANIFEST_FORMATS
+        :param batch_size: int. records held before they are written
+        :param interval: float. maximum seconds a record is held before it is written
+        """
+
+        if manifest_format not in MANIFEST_FORMATS:
+            raise ValueError("Unknown manifest format {0}. Choose one of: {1}"
+                             .format(manifest_format, ', '.join(MANIFEST_FORMATS)))
+
+        self.manifest_format = manifest_format
+        self.batch_size = batch_size
+        self.interval = interval
+        self.path = join(destination, 'manifest.{}'.format(manifest_format))
+        self.records = []
+        self.last_flush = time.time()
+        self.lock = threading.RLock()  # records are written from the timer thread too
+        self.closed = threading.Event()
+
+        self.file = open(self.path, 'a', newline='')
+
+        if manifest_format == 'csv' and self.file.tell() == 0:
+            self.records.append(self.format_csv(MANIFEST_FIELDS))
+
+        self.timer = None
+        if interval:
+            self.timer = threading.Thread(target=self.flush_held, name='manifest flush',
+                                          daemon=True)
+            self.timer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def format_csv(values):
+        """
+        Formats one CSV row
+        """
+
+        row = io.StringIO()
+        csv.writer(row).writerow(values)
+        return row.getvalue()
+
+    def write(self, new_file, original_file, method='copy', size=None, checksum=None,
+              elapsed=None):
+        """
+        Adds a record for a placed file
+        :param new_file: string. destination path
+        :param original_file: string. source path
+        :param method: string. how the file was placed, one of OUTPUT_MODES
+        :param size: int. bytes
+        :param checksum: string. checksum of the source, None if no bytes were copied
+        :param elapsed: float. seconds taken to place the file
+        """
+
+        if self.manifest_format == 'txt':
+            record = '- {0}: {1} from {2} written to {3}\n'.format(
+                get_datetime(), MANIFEST_VERBS[method], original_file, new_file)
+
+        else:
+            values = (datetime.datetime.now().isoformat(timespec='seconds'), method,
+                      original_file, new_file, size, checksum,
+                      None if elapsed is None else round(elapsed, 3))
+
+            if self.manifest_format == 'csv':
+                record = self.format_csv(values)
+            else:
+                record = json.dumps(dict(zip(MANIFEST_FIELDS, values))) + '\n'
+
+        with self.lock:
+            self.records.append(record)
+
+            if len(self.records) >= self.batch_size or \
+                    time.time() - self.last_flush >= self.interval:
+                self.flush()
+
+    def flush_held(self):
+        """
+        Writes held records that have waited for the interval, until the manifest is
+        closed. Runs on the timer thread.
+        """
+
+        while not self.closed.wait(self.interval / 2.0):
+            with self.lock:
+                if self.records and time.time() - self.last_flush >= self.interval:
+                    try:
+                        self.flush()
+                    except (IOError, OSError) as e:
+                        logging.error("- ERROR: could not write {0}: {1}".format(self.path, e))
+
+    def flush(self):
+        """
+        Writes held records and makes sure they reach the disk. Records are only
+        written whole, so the file never ends part way through one.
+        """
+
+        with self.lock:
+            if self.records and not self.file.closed:
+                self.file.write(''.join(self.records))
+                self.file.flush()
+                fsync(self.file.fileno())
+                self.records = []
+
+            self.last_flush = time.time()
+
+    def close(self):
+        """
+        Writes what is left and closes the manifest
+        """
+
+        self.closed.set()
+        if self.timer is not None and self.timer is not threading.current_thread():
+            self.timer.join()
+
+        with self.lock:
+            if not self.file.closed:
+                self.flush()
+                self.file.close()
+
+
+class Crc32Hash:
+    """
+    Fast, non-cryptographic checksum with the same interface as the hashlib objects.
+    Good enough to catch a bad copy, not to identify files.
+    """
+
+    name = 'crc32'
+
+    def __init__(self, data=b''):
+        self.value = zlib.crc32(data)
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.value & 0xffffffff)
+
+
+CHECKSUM_ALGORITHMS = {'sha1': sha1,
+                       'sha256': sha256,
+                       'blake2b': blake2b,
+                       'crc32': Crc32Hash}
+
+if xxhash is not None:
+    CHECKSUM_ALGORITHMS['xxh64'] = xxhash.xxh64
+
+
+class ChecksumError(IOError):
+    """
+    Raised when a copy still doesn't match its source after every retry
+    """
+
+
+_buffers = threading.local()  # one reusable copy buffer per copy thread
+
+
+def get_buffer():
+    """
+    Gets this thread's copy buffer, allocating it on first use
+    :return: memoryview over a COPY_BUFFER_SIZE bytearray
+    """
+
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _buffers.buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    return buffer
+
+
+def new_hash(algorithm):
+    """
+    Creates a hash object for a checksum algorithm
+    :param algorithm: string. key of CHECKSUM_ALGORITHMS
+    :return: hash object
+    """
+
+    try:
+        return CHECKSUM_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError("Unknown checksum algorithm {0}. Choose one of: {1}"
+                         .format(algorithm, ', '.join(sorted(CHECKSUM_ALGORITHMS))))
+
+
+def get_checksum(file, algorithm=CHECKSUM_ALGORITHM, throttle=None):
+    """
+    Returns checksum of the whole file
+    :param file: file
+    :param algorithm: string. key of CHECKSUM_ALGORITHMS
+    :param throttle: BandwidthLimiter the reads count against, or None
+    :return: string (checksum)
+    """
+
+    checksum = new_hash(algorithm)
+    buffer = get_buffer()
+
+    with open(file, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            checksum.update(buffer[:size])
+            if throttle is not None:
+                throttle.consume(size, transferred=False)
+
+    return checksum.hexdigest()
+
+
+def get_partial_checksum(file, size):
+    """
+    Hashes the size, start and end of a file. Cheap enough to run on every file whose
+    size matches an indexed one, and enough to rule out nearly every false match
+    before the whole file is read.
+    :param file: string. path
+    :param size: int. its size in bytes
+    :return: string
+    """
+
+    checksum = blake2b(str(size).encode('ascii'), digest_size=16)
+
+    with open(file, 'rb') as f:
+        checksum.update(f.read(CONTENT_SAMPLE))
+        if size > CONTENT_SAMPLE:
+            f.seek(max(CONTENT_SAMPLE, size - CONTENT_SAMPLE))
+            checksum.update(f.read(CONTENT_SAMPLE))
+
+    return checksum.hexdigest()
+
+
+def hashing_copy(original_file, new_file, algorithm=CHECKSUM_ALGORITHM, throttle=None):
+    """
+    Copies a file, hashing the source as it streams through so it is only read once
+    :param original_file: string. source path
+    :param new_file: string. destination path
+    :param algorithm: string. key of CHECKSUM_ALGORITHMS
+    :param throttle: BandwidthLimiter each chunk is counted against, or None
+    :return: string (checksum of the source)
+    """
+
+    checksum = new_hash(algorithm)
+    buffer = get_buffer()
+
+    with open(original_file, 'rb', buffering=0) as source, \
+            open(new_file, 'wb', buffering=0) as target:
+        while True:
+            size = source.readinto(buffer)
+            if not size:
+                break
+            chunk = buffer[:size]
+            checksum.update(chunk)
+            while chunk:  # unbuffered writes may be short
+                chunk = chunk[target.write(chunk):]
+            if throttle is not None:
+                throttle.consume(size)
+
+        fsync(target.fileno())  # on disk before it is renamed into place
+
+    return checksum.hexdigest()
+
+
+def get_volume(file_path):
+    """
+    Finds the mount point that a file lives on
+    :param file_path: string. path to a file or directory
+    :return: string (mount point)
+    """
+
+    return _get_mount_point(path.dirname(path.abspath(file_path)))
+
+
+@lru_cache(maxsize=4096)
+def _get_mount_point(directory):
+    """
+    Walks up from a directory until a mount point is found. Cached per directory, as
+    every file in a delivery shares a handful of parent directories.
+    """
+
+    while not path.ismount(directory):
+        parent = path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+
+    return directory
+
+
+class VolumeLimiter:
+    """
+    Caps the number of copies running at once against any one source or destination
+    volume, so parallel copies don't thrash spinning disks.
+    """
+
+    def __init__(self, limit):
+        """
+        Initialize the limiter
+        :param limit: int. maximum concurrent copies per volume
+        """
+
+        self.limit = max(1, limit)
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def get_semaphore(self, volume):
+        """
+        Gets the semaphore guarding a volume, creating it on first use
+        """
+
+        with self.lock:
+            if volume not in self.semaphores:
+                self.semaphores[volume] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[volume]
+
+    def run(self, original_file, new_file, function, *args):
+        """
+        Runs a copy function once a slot is free on both the source and destination
+        volumes. Semaphores are always taken in sorted order so two copies going
+        opposite ways between the same volumes can't deadlock.
+        :param original_file: string. a source path, to find the source volume
+        :param new_file: string. a destination path, to find the destination volume
+        :param function: callable, called with args
+        """
+
+        volumes = sorted({get_volume(original_file), get_volume(new_file)})
+        semaphores = [self.get_semaphore(volume) for volume in volumes]
+
+        for semaphore in semaphores:
+            semaphore.acquire()
+        try:
+            return function(*args)
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+
+class BandwidthLimiter:
+    """
+    Caps the combined read rate of every copy, so a run doesn't saturate a shared link,
+    and counts the bytes copied for the progress. The cap can be limited to a window of
+    hours, e.g. business hours, and is lifted outside it.
+    """
+
+    def __init__(self, rate=None, hours=None, counter=None):
+        """
+        Initialize the limiter
+        :param rate: float. bytes per second for all copies together, or None for no cap
+        :param hours: tuple (start hour, end hour) in local time when the cap applies, or
+        None for all day. A window may wrap past midnight, e.g. (22, 6).
+        :param counter: callable taking a byte count for every chunk copied, such as
+        JobProgress.add_transferred, or None
+        """
+
+        self.rate = rate
+        self.hours = hours
+        self.counter = counter
+        self.allowance = 0.0  # bytes that may go without waiting; negative is a debt
+        self.checked = time.monotonic()
+        self.lock = threading.Lock()
+
+    def active(self):
+        """
+        Checks whether the cap applies right now
+        :return: bool
+        """
+
+        if not self.rate:
+            return False
+
+        if self.hours is None:
+            return True
+
+        start, end = self.hours
+        hour = datetime.datetime.now().hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def consume(self, count, transferred=True):
+        """
+        Accounts for a chunk read by a copy worker, and sleeps until the chunk fits under
+        the cap. Runs on the copy workers.
+        :param count: int. bytes read
+        :param transferred: bool. the bytes are copy progress, not a verify re-read
+        """
+
+        if transferred and self.counter is not None:
+            self.counter(count)
+
+        if not self.active():
+            return
+
+        # Token bucket. Whoever takes a chunk beyond the allowance sleeps off the debt,
+        # which also holds back the workers behind it.
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.checked) * self.rate)
+            self.checked = now
+            self.allowance -= count
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0.0
+
+        if wait:
+            time.sleep(wait)
+
+
+def copy_file(original_file, new_file, algorithm=CHECKSUM_ALGORITHM, verify=True,
+              retries=COPY_RETRIES, report=None, commit=True, throttle=None):
+    """
+    Copies a single file and verifies the copy against the source checksum. The copy
+    is written under a temporary name and renamed into place once it is complete, so
+    an interrupted copy never leaves a partial file under the final name.
+    :param original_file: string. source path
+    :param new_file: string. destination path
+    :param algorithm: string. key of CHECKSUM_ALGORITHMS
+    :param verify: bool. re-read the destination and compare it to the source checksum
+    :param retries: int. number of copy attempts before giving up
+    :param report: RunReport to add the time spent verifying to, or None
+    :param commit: bool. rename the verified copy into place. If False it is left under
+    its temporary name for the caller to rename.
+    :param throttle: BandwidthLimiter shared by the copies, or None
+    :return: string (checksum of the source)
+    """
+
+    temp_file = new_file + PARTIAL_SUFFIX
+
+    try:
+        for attempt in range(1, max(1, retries) + 1):
+            original_checksum = hashing_copy(original_file, temp_file, algorithm, throttle)
+
+            # Ensure output file is identical to input file
+            verified = not verify
+            if verify:
+                started = time.perf_counter()
+                verified = original_checksum == get_checksum(temp_file, algorithm, throttle)
+                if report is not None:
+                    report.add_time('verify', time.perf_counter() - started, 1)
+
+            if verified:
+                if commit:
+                    replace(temp_file, new_file)
+                return original_checksum
+
+            logging.warning("File checksum mismatch. Attempting copy again ({0} of {1}). {2}"
+                            .format(attempt, retries, new_file))
+
+    except BaseException:
+        if exists(temp_file):
+            remove(temp_file)
+        raise
+
+    remove(temp_file)
+    raise ChecksumError("checksum of {0} does not match {1} after {2} attempts"
+                        .format(new_file, original_file, retries))
+
+
+def same_filesystem(original_file, new_file):
+    """
+    Checks whether a file and the directory it is going to live in are on the same
+    filesystem, so it can be linked or renamed instead of copied
+    :param original_file: string. source path
+    :param new_file: string. destination path
+    :return: bool
+    """
+
+    try:
+        return stat(original_file).st_dev == stat(path.dirname(path.abspath(new_file))).st_dev
+    except OSError:
+        return False
+
+
+def reflink_file(original_file, new_file):
+    """
+    Clones a file's extents on a copy-on-write filesystem (btrfs, XFS). No data is
+    copied, and the clone is independent of the original once either is changed.
+    :param original_file: string. source path
+    :param new_file: string. destination path
+    :return: IO
+    """
+
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+
+    with open(original_file, 'rb') as source, open(new_file, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            remove(new_file)
+            raise
+
+
+def place_file(original_file, new_file, mode=OUTPUT_MODE, algorithm=CHECKSUM_ALGORITHM,
+               verify=True, report=None, commit=True, throttle=None, content=None):
+    """
+    Puts a file in its destination using the requested output mode. Hardlinks,
+    reflinks and renames only apply on the same filesystem; when the fast path can't
+    be used the file is copied and verified instead.
+    :param original_file: string. source path
+    :param new_file: string. destination path
+    :param mode: string. one of OUTPUT_MODES
+    :param algorithm: string. checksum algorithm, key of CHECKSUM_ALGORITHMS
+    :param verify: bool. re-read copies to check them against the source checksum
+    :param report: RunReport for copy_file, or None
+    :param commit: bool. if False the file is only staged under its temporary name and
+    a moved source is left where it is, see place_dataset
+    :param throttle: BandwidthLimiter for copy_file, or None
+    :param content: ContentIndex. before copying, a file identical to one an earlier
+    run placed is linked to that copy instead. Or None.
+    :return: tuple (method used, checksum or None if no bytes were copied)
+    """
+
+    if mode not in OUTPUT_MODES:
+        raise ValueError("Unknown output mode {0}. Choose one of: {1}"
+                         .format(mode, ', '.join(OUTPUT_MODES)))
+
+    target = new_file
+    if not commit:
+        target = new_file + PARTIAL_SUFFIX
+        if path.lexists(target):  # left behind by an interrupted run
+            remove(target)
+
+    if mode != 'copy':
+        try:
+            if mode == 'symlink':
+                symlink(path.abspath(original_file), target)
+                return 'symlink', None
+
+            if same_filesystem(original_file, new_file):
+                if mode == 'hardlink':
+                    link(original_file, target)
+                    return 'hardlink', None
+
+                if mode == 'reflink':
+                    reflink_file(original_file, target)
+                    return 'reflink', None
+
+                if mode == 'move':
+                    if commit:
+                        rename(original_file, new_file)
+                    else:  # staged as a second link; the source goes once the set is placed
+                        link(original_file, target)
+                    return 'move', None
+
+        except OSError as e:
+            logging.info("- INFO: could not {0} {1}, copying instead: {2}"
+                         .format(mode, original_file, e))
+
+    checksum = content.place(original_file, target, stat(original_file).st_size) \
+        if content is not None else None
+
+    if checksum is not None:
+        if mode == 'move' and commit:
+            remove(original_file)
+        return 'dedup', checksum
+
+    checksum = copy_file(original_file, new_file, algorithm, verify, report=report,
+                         commit=commit, throttle=throttle)
+
+    if mode == 'move':  # different filesystem - the source goes once the copy is verified
+        if commit:
+            remove(original_file)
+        return 'move', checksum
+
+    return 'copy', checksum
+
+
+def place_dataset(files, mode=OUTPUT_MODE, algorithm=CHECKSUM_ALGORITHM, verify=True,
+                  report=None, throttle=None, content=None):
+    """
+    Places the files of a dataset as one unit. Each file is staged under its temporary
+    name and verified first; only once every file is ready are they renamed into place,
+    and for moves the sources removed. If any file fails, the files already staged or
+    placed are removed again, so a dataset is never left half copied.
+    :param files: list of (source, destination) pairs
+    :param mode: string. one of OUTPUT_MODES
+    :param algorithm: string. checksum algorithm, key of CHECKSUM_ALGORITHMS
+    :param verify: bool. re-read copies to check them against the source checksum
+    :param report: RunReport for copy_file, or None
+    :param throttle: BandwidthLimiter for copy_file, or None
+    :param content: ContentIndex for place_file, or None
+    :return: list of (method used, checksum or None, seconds taken), one per file
+    """
+
+    placed = []
+    staged = []
+
+    try:
+        for original_file, new_file in files:
+            started = time.time()
+            method, checksum = place_file(original_file, new_file, mode, algorithm, verify,
+                                          report, commit=False, throttle=throttle,
+                                          content=content)
+            staged.append((method, checksum, time.time() - started))
+
+        for original_file, new_file in files:
+            replace(new_file + PARTIAL_SUFFIX, new_file)
+            placed.append(new_file)
+
+    except BaseException:
+        leftovers = [new_file + PARTIAL_SUFFIX for original_file, new_file in files] + placed
+        for leftover in leftovers:
+            if path.lexists(leftover):
+                remove(leftover)
+        raise
+
+    if mode == 'move':
+        for original_file, new_file in files:
+            try:
+                remove(original_file)
+            except OSError as e:
+                logging.warning("- WARNING: placed {0} but could not remove the source: {1}"
+                                .format(new_file, e))
+
+    return staged
+
+
+def file_copier(data, destination, workers=COPY_WORKERS, volume_limit=VOLUME_COPY_LIMIT,
+                algorithm=CHECKSUM_ALGORITHM, verify=True, mode=OUTPUT_MODE, progress=None,
+                cancel_event=None, manifest=None, journal=None, report=None, throttle=None,
+                content=None, executor=None, limiter=None):
+    """
+    Copies files from source to destination. Datasets are handed to the workers largest
+    first, so the big images start straight away and the small files fill in around
+    them at the end instead of one large copy running on its own after the rest.
+    :param data: list of PlannedFile
+    :param destination: string. output directory the manifest is written to
+    :param workers: int. number of copies to run at once
+    :param volume_limit: int. maximum concurrent copies per source or destination volume
+    :param algorithm: string. checksum algorithm, key of CHECKSUM_ALGORITHMS
+    :param verify: bool. re-read each copy to check it against the source checksum
+    :param mode: string. one of OUTPUT_MODES
+    :param progress: JobProgress told about each finished file, or None
+    :param cancel_event: threading.Event. once set, no new copies are started
+    :param manifest: ManifestWriter to record copies in. If None, one is opened in
+    destination for this call
+    :param journal: CopyJournal of the job, or None. With a journal, files verified by
+    an earlier run are skipped without being re-read, and incomplete ones are redone.
+    :param report: RunReport to record each file's latency and verify time in, or None
+    :param throttle: BandwidthLimiter shared by the copies, or None
+    :param content: ContentIndex to link identical earlier copies from and to add the
+    copies to, or None
+    :param executor: ThreadPoolExecutor to run the copies on, or None to start one
+    :param limiter: VolumeLimiter to run the copies through, or None to start one
+    :return: dict. number of files copied, deduplicated, skipped, resumed, failed and
+    cancelled
+    """
+    copied_count = 0
+    counts = {'copied': 0, 'deduplicated': 0, 'skipped': 0, 'resumed': 0, 'failed': 0,
+              'cancelled': 0}
+
+    if exists(destination):
+        claimed = set()  # destinations already queued in this batch
+        to_copy = [file for file in data if triage_copy(file, journal, mode, claimed, counts)]
+
+        if progress is not None:
+            progress.add_copies(len(to_copy), sum(file.size for file in to_copy))
+
+        if journal is not None:
+            for file in to_copy:
+                journal.mark(file, 'in_progress')
+            journal.commit()
+
+        if limiter is None:
+            limiter = VolumeLimiter(volume_limit)
+        task = partial(copy_task, partial(place_dataset, mode=mode, algorithm=algorithm,
+                                          verify=verify, report=report, throttle=throttle,
+                                          content=content),
+                       cancel_event)
+
+        datasets = {}  # the files of a dataset are copied together
+        for file in to_copy:
+            datasets.setdefault(file.dataset, []).append(file)
+        datasets = sorted(datasets.values(), key=dataset_size, reverse=True)
+
+        own_manifest = manifest is None
+        if own_manifest:
+            manifest = ManifestWriter(destination)
+
+        # Copies run on the pool; logging, manifest writes and progress stay on this
+        # thread so they are never interleaved.
+        with shared_pool(executor, workers) as executor:
+            futures = {executor.submit(limiter.run, files[0].source, files[0].destination,
+                                       task, files): files
+                       for files in datasets}
+
+            for future in as_completed(futures):
+                placed = finish_copy(futures[future], future, counts, manifest, journal,
+                                     progress, report, content)
+                if placed:
+                    copied_count += placed
+                    print(" - Copied file {0} of {1}{2}".format(
+                        copied_count, len(data),
+                        '' if progress is None else ', ' + progress.remaining()))
+
+        if own_manifest:
+            manifest.close()
+
+        if journal is not None:
+            journal.commit()
+
+        if counts['cancelled']:
+            logging.warning("- WARNING: cancelled, {} files were not copied"
+                            .format(counts['cancelled']))
+
+    else:
+        text = ("- WARNING: directory {} does not exist and I could "
+                "not create it.".format(destination))
+        logging.warning(text)
+
+    return counts
+
+
+def dataset_size(files):
+    """
+    Gets the bytes to copy for the files of a dataset, which is what the copies are
+    ordered by
+    :param files: list of PlannedFile
+    :return: int
+    """
+
+    return sum(file.size for file in files)
+
+
+def triage_copy(file, journal, mode, claimed, counts):
+    """
+    Decides whether a planned file has to be copied. Files verified by an earlier run
+    are counted as resumed, files already at their destination as skipped.
+    :param file: PlannedFile
+    :param journal: CopyJournal of the job, or None
+    :param mode: string. one of OUTPUT_MODES
+    :param claimed: set of destinations already queued. The file is added if queued
+    :param counts: dict of counts from file_copier, updated
+    :return: bool. True if the file should be copied
+    """
+
+    state = journal.state(file) if journal is not None else None
+    # Only a copy the journal saw start and not finish may be replaced. A 'planned' row
+    # says nothing about a file that was at the destination before the job got to it.
+    incomplete = state in ('in_progress', 'failed')
+
+    if state == 'verified' and exists(file.destination):
+        logging.info("- INFO: {} was verified by an earlier run. Not copying."
+                     .format(file.destination))
+        counts['resumed'] += 1
+
+    elif incomplete and mode == 'move' and not exists(file.source) and \
+            exists(file.destination):  # moved before the last run stopped
+        journal.mark(file, 'verified')
+        counts['resumed'] += 1
+
+    # Files the journal knows are incomplete are copied again over what's there
+    elif (incomplete or not exists(file.destination)) and \
+            file.destination not in claimed:
+        claimed.add(file.destination)
+        return True
+
+    else:
+        text = ("- Warning: File {} already exists in destination. "
+                "Not copying.".format(file.destination))
+        logging.warning(text)
+        counts['skipped'] += 1
+
+    return False
+
+
+def copy_task(copier, cancel_event, files):
+    """
+    Places the files of one dataset. Runs on a copy worker.
+    :param copier: callable taking (source, destination) pairs, such as place_dataset
+    :param cancel_event: threading.Event, or None
+    :param files: list of PlannedFile
+    :return: list of (method, checksum, seconds taken), or None if cancelled first
+    """
+
+    # Checked once a volume slot is free, so a cancel stops everything still queued
+    if cancel_event is not None and cancel_event.is_set():
+        return None
+
+    return copier([(file.source, file.destination) for file in files])
+
+
+def finish_copy(files, future, counts, manifest, journal=None, progress=None, report=None,
+                content=None):
+    """
+    Records the outcome of a copy task in the log, manifest, journal, progress and
+    report. Runs on the thread that owns the manifest, never on a copy worker.
+    :param files: list of PlannedFile, the dataset given to copy_task
+    :param future: finished Future of copy_task
+    :param counts: dict of counts from file_copier, updated
+    :param manifest: ManifestWriter
+    :param content: ContentIndex the placed files are added to, or None
+    :return: int. number of files placed
+    """
+
+    try:
+        placed = future.result()
+    except (IOError, OSError) as e:
+        text = ("- ERROR: could not copy {0} to {1}: {2}"
+                .format(files[0].dataset, path.dirname(files[0].destination), e))
+        logging.error(text)
+        for file in files:
+            counts['failed'] += 1
+            if journal is not None:
+                journal.mark(file, 'failed')
+            if progress is not None:
+                progress.copy_done(file.size, failed=True)
+        return 0
+
+    if placed is None:
+        counts['cancelled'] += len(files)
+        return 0
+
+    for file, (method, checksum, elapsed) in zip(files, placed):
+        original_file, new_file, size = file.source, file.destination, file.size
+        logging.info("- INFO: Placed file {0} at {1} ({2})"
+                     .format(original_file, new_file, method))
+
+        manifest.write(new_file, original_file, method, size, checksum, elapsed)
+        if report is not None:
+            if method == 'dedup':
+                report.add_copy(0, elapsed, method, saved=size)
+            else:
+                report.add_copy(size if checksum is not None else 0, elapsed, method)
+        if journal is not None:
+            journal.mark(file, 'verified', checksum)
+        if content is not None:
+            content.add(new_file, size, checksum)
+        counts['deduplicated' if method == 'dedup' else 'copied'] += 1
+
+        if progress is not None:
+            progress.copy_done(size)
+
+    return len(placed)
+
+
+class JobProgress:
+    """
+    Tracks how far a job has got and passes snapshots to a callback, such as the GUI's
+    progress display. Callbacks are rate limited except when the stage changes.
+
+    Throughput is a moving average over the last THROUGHPUT_WINDOW seconds, and counts
+    bytes as the copy workers stream them rather than when a file is done, so an ETA is
+    there from the start even when the first copies are multi-GB images.
+    """
+
+    def __init__(self, callback=None, interval=0.25):
+        """
+        Initialize the tracker
+        :param callback: callable taking a snapshot dict, or None
+        :param interval: float. minimum seconds between callbacks
+        """
+
+        self.callback = callback
+        self.interval = interval
+        self.stage = None
+        self.started = time.time()
+        self.copy_started = None
+        self.last_report = 0
+        self.files_scanned = 0
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.bytes_transferred = 0  # streamed by the copy workers, done or not
+        self.samples = collections.deque()  # (time, bytes copied) for the moving average
+        self.lock = threading.Lock()
+
+    def set_stage(self, stage):
+        """
+        Marks the start of a new stage, e.g. "scanning" or "copying imagery"
+        """
+
+        self.stage = stage
+        self.report(force=True)
+
+    def add_scanned(self, count):
+        """
+        Counts files found by the scan
+        """
+
+        self.files_scanned += count
+        self.report()
+
+    def add_copies(self, files, size):
+        """
+        Adds files queued for copying to the totals
+        :param files: int. number of files
+        :param size: int. their total size in bytes
+        """
+
+        first = self.copy_started is None
+        if first:
+            self.copy_started = time.time()
+            self.samples.append((self.copy_started, self.bytes_copied()))
+
+        self.files_total += files
+        self.bytes_total += size
+        self.report(force=first)
+
+    def copy_done(self, size, failed=False):
+        """
+        Counts a finished copy. Failed copies leave the totals so the ETA stays honest.
+        """
+
+        if failed:
+            self.files_total -= 1
+            self.bytes_total -= size
+        else:
+            self.files_done += 1
+            self.bytes_done += size
+
+        self.report()
+
+    def add_transferred(self, count):
+        """
+        Counts bytes streamed by a copy. Called on the copy workers, see BandwidthLimiter.
+        """
+
+        with self.lock:
+            self.bytes_transferred += count
+
+    def bytes_copied(self):
+        """
+        Gets how much of the queued bytes are copied, counting the part of each copy
+        streamed so far. Links and renames stream nothing and count once they're done.
+        :return: int. bytes
+        """
+
+        with self.lock:
+            return min(max(self.bytes_transferred, self.bytes_done), self.bytes_total)
+
+    def bytes_remaining(self):
+        """
+        Gets the bytes still to copy
+        :return: int
+        """
+
+        return self.bytes_total - self.bytes_copied()
+
+    def throughput(self):
+        """
+        Gets the copy rate over the last THROUGHPUT_WINDOW seconds
+        :return: float. bytes per second
+        """
+
+        if self.copy_started is None:
+            return 0.0
+
+        now = time.time()
+        copied = self.bytes_copied()
+        samples = self.samples
+
+        if now - samples[-1][0] >= 1.0:  # one sample a second is plenty
+            samples.append((now, copied))
+
+        # Keep the newest sample at least a window old as the start of the average
+        while len(samples) > 1 and samples[1][0] <= now - THROUGHPUT_WINDOW:
+            samples.popleft()
+
+        then, copied_then = samples[0]
+        return (copied - copied_then) / max(now - then, 1e-6)
+
+    def eta(self):
+        """
+        Gets the estimated time left for the copies queued so far
+        :return: float. seconds, or None before anything has been copied
+        """
+
+        rate = self.throughput()
+        if not rate:
+            return None
+
+        return self.bytes_remaining() / rate
+
+    def remaining(self):
+        """
+        Describes the copies left, for the console
+        :return: string. e.g. "1.2 GB left at 80.0 MB/s, ETA 15.36 s"
+        """
+
+        eta = self.eta()
+        return '{0} left at {1}/s, ETA {2}'.format(format_size(self.bytes_remaining()),
+                                                   format_size(self.throughput()),
+                                                   format_duration(eta) if eta is not None
+                                                   else '-')
+
+    def snapshot(self):
+        """
+        Gets the current progress
+        :return: dict
+        """
+
+        return {'stage': self.stage,
+                'elapsed': time.time() - self.started,
+                'files_scanned': self.files_scanned,
+                'files_total': self.files_total,
+                'files_done': self.files_done,
+                'bytes_total': self.bytes_total,
+                'bytes_done': self.bytes_done,
+                'bytes_remaining': self.bytes_remaining(),
+                'throughput': self.throughput(),
+                'eta': self.eta()}
+
+    def report(self, force=False):
+        """
+        Sends a snapshot to the callback
+        :param force: bool. ignore the rate limit
+        """
+
+        if self.callback is None:
+            return
+
+        now = time.time()
+        if force or now - self.last_report >= self.interval:
+            self.last_report = now
+            self.callback(self.snapshot())
+
+
+class RunReport:
+    """
+    Where a run spent its time: wall time per stage, the latency of each placed file
+    and copy throughput. Written as run_report.json and run_report.txt next to
+    renamer.log. Verify time is added up across the copy workers, so it can be more
+    than the copy stage's wall time.
+    """
+
+    def __init__(self):
+        """
+        Starts the report
+        """
+
+        self.lock = threading.Lock()  # copy workers add verify times
+        self.started = datetime.datetime.now()
+        self.finished = None
+        self.elapsed = None
+        self.stages = {}  # stage -> [seconds, items]
+        self.latencies = array('d')  # seconds to place each file
+        self.bytes_copied = 0
+        self.bytes_saved = 0  # linked to identical earlier copies instead of copied
+        self.methods = {}  # placement method -> files
+        self.profile = []  # slowest functions, if the run was profiled
+
+    def add_time(self, stage, seconds, items=0):
+        """
+        Adds time spent in a stage
+        :param stage: string. one of REPORT_STAGES
+        :param seconds: float
+        :param items: int. files handled
+        """
+
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += items
+
+    @contextlib.contextmanager
+    def stage(self, stage, items=0):
+        """
+        Times a block as a stage
+        """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started, items)
+
+    def add_copy(self, size, seconds, method, saved=0):
+        """
+        Records a placed file
+        :param size: int. bytes copied, 0 if the file was linked or renamed
+        :param seconds: float. time to place and verify it
+        :param method: string. how it was placed
+        :param saved: int. bytes not copied because an identical earlier copy was linked
+        """
+
+        self.latencies.append(seconds)
+        self.bytes_copied += size
+        self.bytes_saved += saved
+        self.methods[method] = self.methods.get(method, 0) + 1
+
+    def add_profile(self, profiler, rows=PROFILE_ROWS):
+        """
+        Keeps the functions with the most cumulative time
+        :param profiler: cProfile.Profile, disabled
+        :param rows: int. functions to keep
+        """
+
+        stats = pstats.Stats(profiler).stats
+        slowest = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:rows]
+
+        self.profile = [{'function': '{0}:{1}({2})'.format(path.basename(file_name), line,
+                                                           function),
+                         'calls': calls, 'own_seconds': round(own, 4),
+                         'cumulative_seconds': round(cumulative, 4)}
+                        for (file_name, line, function), (primitive, calls, own, cumulative,
+                                                          callers) in slowest]
+
+    def finish(self, elapsed):
+        """
+        Marks the run finished
+        :param elapsed: float. seconds the whole run took
+        """
+
+        self.finished = datetime.datetime.now()
+        self.elapsed = elapsed
+
+    def histogram(self):
+        """
+        Counts placed files by latency
+        :return: list of (label, files)
+        """
+
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        for seconds in self.latencies:
+            index = 0
+            while index < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[index]:
+                index += 1
+            counts[index] += 1
+
+        labels = ['<= {:g} s'.format(bound) for bound in LATENCY_BUCKETS]
+        labels.append('> {:g} s'.format(LATENCY_BUCKETS[-1]))
+        return list(zip(labels, counts))
+
+    def percentile(self, fraction):
+        """
+        Gets a file latency percentile
+        :param fraction: float. 0.5 for the median
+        :return: float seconds, or None if nothing was placed
+        """
+
+        if not self.latencies:
+            return None
+
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    def ordered_stages(self):
+        """
+        Gets the timed stages in the order they run
+        :return: list of (stage, (seconds, files))
+        """
+
+        order = {stage: index for index, stage in enumerate(REPORT_STAGES)}
+        return sorted(self.stages.items(), key=lambda item: order.get(item[0], len(order)))
+
+    def as_dict(self):
+        """
+        Gets the report as plain data for JSON
+        :return: dict
+        """
+
+        stages = []
+        for stage, (seconds, items) in self.ordered_stages():
+            stages.append({'stage': stage, 'seconds': round(seconds, 4), 'files': items,
+                           'files_per_second': round(items / seconds, 1)
+                           if items and seconds else None})
+
+        copy_seconds = self.stages.get('copy', [0.0])[0]
+
+        return {'started': self.started.isoformat(timespec='seconds'),
+                'finished': self.finished.isoformat(timespec='seconds')
+                if self.finished else None,
+                'elapsed_seconds': self.elapsed,
+                'stages': stages,
+                'copy': {'files': len(self.latencies),
+                         'bytes': self.bytes_copied,
+                         'bytes_saved': self.bytes_saved,
+                         'bytes_per_second': round(self.bytes_copied / copy_seconds, 1)
+                         if copy_seconds else None,
+                         'methods': self.methods,
+                         'latency_p50': self.percentile(0.5),
+                         'latency_p95': self.percentile(0.95),
+                         'latency_max': max(self.latencies) if self.latencies else None,
+                         'latency_histogram': self.histogram()},
+                'profile': self.profile}
+
+    def format_table(self):
+        """
+        Gets the report as a table for people
+        :return: string
+        """
+
+        report = self.as_dict()
+        lines = ["Run started {0}, finished {1}, {2} elapsed".format(
+                     report['started'], report['finished'],
+                     format_duration(report['elapsed_seconds'] or 0.0)),
+                 "",
+                 "{0:<10} {1:>12} {2:>10} {3:>12}".format('stage', 'time', 'files', 'files/s')]
+
+        for row in report['stages']:
+            lines.append("{0:<10} {1:>12} {2:>10} {3:>12}".format(
+                row['stage'], format_duration(row['seconds']), row['files'],
+                '-' if row['files_per_second'] is None else row['files_per_second']))
+
+        copy = report['copy']
+        if copy['files']:
+            lines += ["",
+                      "Placed {0} files, {1:.1f} MB copied at {2:.1f} MB/s".format(
+                          copy['files'], copy['bytes'] / 1048576.0,
+                          (copy['bytes_per_second'] or 0.0) / 1048576.0)]
+            if copy['bytes_saved']:
+                lines.append("Linked {0} files to identical earlier copies, {1:.1f} MB not "
+                             "copied".format(copy['methods'].get('dedup', 0),
+                                             copy['bytes_saved'] / 1048576.0))
+            lines.append("Latency per file: median {0}, 95th percentile {1}, max {2}".format(
+                format_duration(copy['latency_p50']), format_duration(copy['latency_p95']),
+                format_duration(copy['latency_max'])))
+            lines += ["  {0:<10} {1:>8}".format(label, files)
+                      for label, files in copy['latency_histogram']]
+
+        if report['profile']:
+            lines += ["", "{0:>10} {1:>10} {2:>8}  {3}".format('cumulative', 'own', 'calls',
+                                                               'function')]
+            lines += ["{0:>10.3f} {1:>10.3f} {2:>8}  {3}".format(
+                row['cumulative_seconds'], row['own_seconds'], row['calls'], row['function'])
+                for row in report['profile']]
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, base_path):
+        """
+        Writes the report as JSON and as a table
+        :param base_path: string. path without extension
+        :return: string. path of the table
+        """
+
+        with open(base_path + '.json', 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+        with open(base_path + '.txt', 'w') as f:
+            f.write(self.format_table())
+
+        return base_path + '.txt'
 
-import sys
-from hashlib import sha1
-from os import walk, makedirs, path
-from os.path import join, splitext, exists
-from shutil import copyfile
-from sys import exit, argv
-from gui import *
-import logging
-import datetime
 
-TEST = True
+def format_duration(seconds):
+    """
+    Formats a duration with a unit that suits it
+    :param seconds: float, or None
+    :return: string
+    """
 
+    if seconds is None:
+        return '-'
+    if seconds < 1.0:
+        return '{:.1f} ms'.format(seconds * 1000.0)
+    if seconds < 60.0:
+        return '{:.2f} s'.format(seconds)
 
-class GUI(QtWidgets.QMainWindow, Ui_MainWindow):
-    def __init__(self):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
 
-        super(GUI, self).__init__()
 
-        QtWidgets.QMainWindow.__init__(self)
-        Ui_MainWindow.__init__(self)
-        self.setupUi(self)
-        self.setFixedSize(800, 140)  # no resizing
-        self.output_text = ''
-        self.image_root_set = False
-        self.shp_root_set = False
-        self.working_directory_set = False
+def format_size(size):
+    """
+    Formats a byte count with a unit that suits it
+    :param size: number. bytes
+    :return: string
+    """
 
-        self.ProcessButton.setDisabled(True)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024.0:
+            return '{0:.1f} {1}'.format(size, unit) if unit != 'B' else '{} B'.format(int(size))
+        size /= 1024.0
 
-        # Handle button clicks in copy/rename data tab
-        self.ClearButton.clicked.connect(self.handle_tab1_clear_button)
-        self.ProcessButton.clicked.connect(self.handle_tab1_process_button)
-        self.BrowseForImageRoot.clicked.connect(self.handle_img_root_browse)
-        self.BrowseForShapeRoot.clicked.connect(self.handle_shp_root_browse)
-        self.BrowseForOutputDir.clicked.connect(self.handle_output_dir_browse)
+    return '{:.1f} TB'.format(size)
 
-        self.all_files = 0
-        self.total_files = 0
-        self.files_left = 0
-        self.files_processed = 0
 
-    def handle_tab1_clear_button(self):
-        """
-        Handles the clear button clicked event
-        """
+def check_for_duplicates(files_to_check):
+    """
+    Checks for files that would be written to the same new path. The first file
+    planned for a path keeps it.
+    :param files_to_check: iterable of PlannedFile
+    :return: list of the files that duplicate an earlier new path
+    """
 
-        self.ImageRootInputEdit.clear()
-        self.ShapeRootInputEdit.clear()
-        self.OutputDirectoryEdit.clear()
-        self.OutputWindow.clear()
-        self.process_button_enabler()
-        self.ProcessButton.setText("Process")
+    claimed = {}  # new path -> orig path that claimed it
+    duplicates = []
 
-    def handle_tab2_clear_button(self):
-        pass
+    for file in files_to_check:
+        if file.destination in claimed:
+            text = ("- ERROR: Duplicate filename {0}: {1} and {2} would both be written "
+                    "there. Not copying {2}".format(file.destination, claimed[file.destination],
+                                                    file.source))
+            logging.error(text)
+            duplicates.append(file)
 
-    def handle_tab1_process_button(self):
-        """
-        Handles the process button clicked event
-        """
+        else:
+            claimed[file.destination] = file.source
 
-        # Get parameters from GUI
-        image_extension = self.ImageTypeCombo.currentText()
-        image_path = self.ImageRootInputEdit.text()
-        shp_path = self.ShapeRootInputEdit.text()
-        working_directory = self.OutputDirectoryEdit.text()
+    return duplicates
 
-        payload = (image_path, shp_path, working_directory, image_extension)
 
-        self.ProcessButton.setText("Processing")
-        self.ProcessButton.setDisabled(True)
-        if len(self.ImageRootInputEdit.text()) > 0 and len(self.ShapeRootInputEdit.text()) > 0 \
-                and len(self.OutputDirectoryEdit.text()) > 0:
-            self.main(payload)
+def find_existing(new_paths):
+    """
+    Finds which planned paths already exist. Each output directory is listed once
+    rather than checking every file on its own.
+    :param new_paths: iterable of planned paths
+    :return: set of the paths that exist
+    """
 
-    def handle_img_root_browse(self):
-        """
-        Handles user clicking browse for image root path
-        """
+    by_directory = {}
+    for new_path in new_paths:
+        by_directory.setdefault(path.dirname(new_path), []).append(new_path)
 
-        openfile = QtWidgets.QFileDialog.getExistingDirectory(self)
-        self.ImageRootInputEdit.setText(openfile)
+    existing = set()
+    for directory, new_paths in by_directory.items():
+        try:
+            with scandir(directory) as entries:
+                names = {entry.name for entry in entries}
+        except OSError:  # output directory not created yet, so nothing in it exists
+            continue
 
-        if openfile:
-            self.image_root_set = True
-            self.process_button_enabler()
+        existing.update(p for p in new_paths if path.basename(p) in names)
 
-    def handle_shp_root_browse(self):
-        """
-        Handles user clicking browse for shp root path
-        """
-        self.shp_root_set = False
+    return existing
 
-        openfile = QtWidgets.QFileDialog.getExistingDirectory(self)
-        self.ShapeRootInputEdit.setText(openfile)
 
-        if openfile:
-            self.shp_root_set = True
-            self.process_button_enabler()
+def write_plan(plan, actions, plan_file):
+    """
+    Writes the rename plan as CSV, one row per file
+    :param plan: list of (step, step destination, files) from create_new_filenames
+    :param actions: dict. orig path -> planned action, from RenameJob.check_plan
+    :param plan_file: string. path of the CSV file
+    :return: IO
+    """
 
-    def handle_output_dir_browse(self):
-        """
-        Handles user clicking browse for output dir
-        """
-        self.working_directory_set = False
+    with open(plan_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(PLAN_FIELDS)
 
-        openfile = QtWidgets.QFileDialog.getExistingDirectory(self)
-        self.OutputDirectoryEdit.setText(openfile)
+        for step, destination, files in plan:
+            writer.writerows((step, actions.get(file.source, ''), file.source,
+                              file.destination, file.scene_id, file.image_type, file.size)
+                             for file in files)
 
-        if openfile:
-            self.working_directory_set = True
-            self.process_button_enabler()
 
-    def process_button_enabler(self):
+class DatabaseIo:
+    """
+    Methods for storing and reading from spatialite db. Populating a spatialite db will allow for
+    much faster processing if there are multiple iterations.
+    """
+
+    def __init__(self, db_path=None):
         """
-        Checks if all three input text items are set and enabled process button if so
+        Initialize the class
+        :param db_path: string. database file, defaults to STR.db next to the application
         """
 
-        if self.ImageRootInputEdit.text() and self.ShapeRootInputEdit.text() and \
-                self.OutputDirectoryEdit.text():
-            self.ProcessButton.setEnabled(True)
-            self.ProcessButton.setText("Process")
+        # Set the DB path
+        self.db_path = db_path
+        self.session = None
+        self.writers = {}  # step -> CatalogWriter for its table
+        self.catalog_row = None  # CatalogRow
+        self.journal_table = None
+        self.content_table = None
+        self.catalogs = {}  # step -> loaded catalog, shared by the runs of this session
+
+        if self.db_path is None:
+            self.get_db_path()
 
-    def done(self):
+    def get_db_path(self):
         """
-        Updates the output window when finished.
+         Set path for spatialite db storage
         """
-        self.ProcessButton.setEnabled(True)
-        app.processEvents()
 
-    def create_new_filenames(self, paths, destination, image_extension):
+        self.db_path = path.join(get_application_path(), 'STR.db')
+
+        return self.db_path
+
+    def init_db(self):
         """
-        rename image and shape files
-        :param paths: tuple. first is image path, second is shp path
-        :return: Tuple (orig path, new path, id)
+        Create .db file. Without SpatiaLite only the copy journal and content index are
+        opened, and every run is a full scan.
+        :return: bool. False if the database can't be used at all, in which case runs
+        can't be resumed or deduplicated either
         """
 
-        image_ids = []
-        index_counter = 0
-        step = None
-        extensions_to_search = None
-
-        shp_extensions = ('.shp', '.dbf', '.shx', '.prj')
+        try:
+            from models.SpatialiteDb import CATALOG_TABLES, CatalogRow, CatalogWriter, \
+                Content, Journal, get_session
+            from sqlalchemy.exc import SQLAlchemyError
+        except ImportError as e:
+            logging.warning("- WARNING: scan catalog disabled, could not load database "
+                            "support: {}".format(e))
+            return False
+
+        try:
+            self.session = get_session(self.db_path)
+        except (SQLAlchemyError, sqlite3.Error, AttributeError) as e:
+            # AttributeError: this Python's sqlite3 can't load extensions at all
+            logging.warning("- WARNING: scan catalog disabled, could not open {0} with "
+                            "SpatiaLite: {1}".format(self.db_path, e))
+            try:
+                self.session = get_session(self.db_path, spatial=False)
+            except (SQLAlchemyError, sqlite3.Error) as e:
+                logging.error("- ERROR: could not open {0}, so runs can't be resumed or "
+                              "deduplicated: {1}".format(self.db_path, e))
+                return False
+        else:
+            self.writers = {step: CatalogWriter(self.session, table)
+                            for step, table in CATALOG_TABLES.items()}
+            self.catalog_row = CatalogRow
 
-        if exists(destination):  # only run if the destination exists
+        self.journal_table = Journal
+        self.content_table = Content
 
-            for path in paths:  # for image and shape path...
+        return True
 
-                files = []
+    def load_catalog(self, step):
+        """
+        Reads what earlier runs recorded about the files in a scan step. The table is
+        only read once per session; later runs get the same dict, which update_catalog
+        and prune_catalog keep in step with the database.
+        :param step: string. "imagery" or "shape data"
+        :return: dict. path -> catalog row
+        """
 
-                if index_counter == 0:  # image files
-                    step = "imagery"
-                    if image_extension == '.img':
-                        extra_extensions = '.ige', '.rrd', '.rde'
-                        extensions_to_search = [image_extension, '.ige', '.rrd', '.rde']
-                    else:
-                        extensions_to_search = image_extension
+        if step not in self.writers:  # no catalog without SpatiaLite
+            return {}
 
-                if index_counter == 1:  # shapefiles
-                    step = 'shape data'
-                    extensions_to_search = shp_extensions
+        if step not in self.catalogs:
+            self.catalogs[step] = self.writers[step].load()
 
-                    destination = join(destination, 'shp')  # set shp dest path
+        return self.catalogs[step]
 
-                print("\n* Parsing {}...".format(step))
+    def update_catalog(self, step, catalog, scanned, sid, image_type):
+        """
+        Records a new or changed file. It is written with the next batch, see
+        CatalogWriter.
+        :param step: string. "imagery" or "shape data"
+        :param catalog: dict returned by load_catalog
+        :param scanned: ScannedFile found by the scan
+        :param sid: string. image ID, or the matched image ID for shapes
+        :param image_type: string. PAN, PSH or Uncategorized
+        """
 
-                for (dirpath, dirnames, filenames) in walk(path):  # for each path in path tuple...
-                    if "output" not in dirpath:
-                        for file in filenames:  # and for each file found...
-                            sid = None  # sid is the ID value that the file will be named
-                            image_type = None  # pan or psh
-                            type_destination = None  # destination path depending on image_type
-                            extension = splitext(file)[1]
-
-                            # Split old filename to recreate new filename.
-                            if extension in extensions_to_search:  # don't process extra files
-                                if extension in extra_extensions:
-                                    print("Found extra file {}".format(file))
-                                    logging.info("Found extra file {}".format(file))
-
-                                original_file_path = join(dirpath, file)
-                                file = file.replace('-', '_')  # replace hyphens with underscore
-                                file = file.replace('.', '_')  # replace periods with underscore
-                                file = file.split('_')  # split at underscores to create list
-
-                                if index_counter == 0:  # Imagery step
-                                    sid = file[0]
-
-                                    if "PAN" in file or "pan" in file:
-                                        image_type = 'PAN'
-                                        type_destination = join(destination, 'PAN')  # set shp dest path
-
-                                    elif 'PSH' in file or 'psh' in file:
-                                        image_type = 'PSH'
-                                        type_destination = join(destination, 'PSH')  # set shp dest path
-
-                                    else:
-                                        image_type = 'Uncategorized'
-                                        type_destination = "uncategorized_images"
-                                        text = "- WARNING: Could not categorize image {}" \
-                                            .format(original_file_path)
-                                        logging.warning(text)
-
-                                    image_info = (file[0], image_type)
-                                    image_ids.append(image_info)
-
-                                if index_counter == 1:  # shape
-                                    image_ids = tuple(image_ids)  # we don't need this as an array now
-                                    if 'PIXEL' in file or 'pixel' in file:  # only want the PIXEL_SHAPE files
-                                        sid, type = match_shp_to_image(file, image_ids)
-
-                                if sid:
-                                    # Sort images based on pan or psh
-                                    if image_type in ["PSH", "PAN"]:
-                                        new_filename = join(type_destination, "{0}_{1}{2}"
-                                                            .format(sid,
-                                                                    image_type,
-                                                                    splitext(original_file_path)[1]))
-
-                                    # Don't rename - just copy. Will have to manually modify name to
-                                    # be sure it's accurate.
-                                    elif image_type == 'Uncategorized':
-                                        new_filename = join(type_destination, "{0}".format(file))
-
-                                    else:
-                                        new_filename = join(destination, "{0}_{1}{2}"
-                                                            .format(sid, type,
-                                                                    splitext(original_file_path)[1]))
-
-                                    file = (original_file_path, new_filename, sid, image_type)
-                                    files.append(file)
-
-                                else:
-                                    if splitext(original_file_path)[1] == '.shp':
-                                        text = ("- ERROR: could not match image with "
-                                                "filename {}"
-                                                .format(original_file_path))
-                                        logging.error(text)
-
-                                self.files_processed += 1
+        if step not in self.writers:
+            return
 
-                text = "\t - Copying {}".format(step)
+        row = catalog.get(scanned.path)
+        if row is None:
+            row = catalog[scanned.path] = self.catalog_row(scanned.path)
 
-                if len(files) > 0:
-                    # Filter duplicate output files
-                    # seen = set()
-                    # out = []
+        row.size = scanned.size
+        row.mtime = scanned.mtime
+        row.scene_id = sid
+        row.image_type = image_type
+        self.writers[step].put(row)
 
-                    # for a,b,c,d in files:
-                    #    if b not in seen:
-                    #        out.append((a,b,c,d))
-                    #        seen.add(b)
+    def update_dataset(self, step, catalog, dataset, sid, image_type):
+        """
+        Records the files of a dataset that are new, changed or were matched differently
+        :param step: string. "imagery" or "shape data"
+        :param catalog: dict returned by load_catalog
+        :param dataset: Dataset found by the scan
+        :param sid: string. image ID, or the matched image ID for shapes
+        :param image_type: string. PAN, PSH or Uncategorized
+        """
 
-                    # files = out
+        for scanned in dataset.files:
+            row = catalog.get(scanned.path)
+            if row is None or row.size != scanned.size or row.mtime != scanned.mtime or \
+                    (row.scene_id, row.image_type) != (sid, image_type):
+                self.update_catalog(step, catalog, scanned, sid, image_type)
 
-                    file_copier(files, destination)  # copy the files
+    def prune_catalog(self, step, catalog, root, seen):
+        """
+        Removes files under a root that weren't found in this scan
+        :param step: string. "imagery" or "shape data"
+        :param catalog: dict returned by load_catalog
+        :param root: string. directory that was scanned
+        :param seen: set of paths found in this scan
+        """
 
-                index_counter += 1  # increment the counter to begin copying shp
+        if step not in self.writers:
+            return
 
-        else:
-            text = ("- WARNING: destination directory {} does not exist and I "
-                    "couldn't create it for you. "
-                    "Did you enter a valid path?".format(destination))
+        root = join(root, '')  # so /data/img doesn't also prune /data/img2
 
-            logging.warning(text)
+        writer = self.writers[step]
+        for file_path in [p for p in catalog if p.startswith(root) and p not in seen]:
+            del catalog[file_path]
+            writer.remove(file_path)
 
-    def main(self, payload):
+    def commit(self):
         """
-        Runs the entire thing
-        :return:
+        Writes pending catalog changes to the database
         """
 
-        self.ProcessButton.setDisabled(True)
-
-        image_path = payload[0]
-        shp_path = payload[1]
-        working_directory = payload[2]
-        image_extension = payload[3]
+        if self.session is not None:
+            for writer in self.writers.values():
+                writer.flush()
+            self.session.commit()
 
-        text = "--Process began at {} --".format(get_datetime())
 
-        # set up logfile
-        logfile = join(working_directory, 'renamer.log')
-        text = "\n* Setting up logfile: {}".format(logfile)
+class CopyJournal:
+    """
+    Durable record of each planned file's copy state for one job, kept in the
+    spatialite db, so an interrupted job resumes where it stopped. Files go from
+    planned to in_progress to verified (or failed).
+    """
 
-        logging.basicConfig(filename=logfile,
-                            level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%',
-                            filemode="w")
+    def __init__(self, db_io, job_key, batch_size=JOURNAL_BATCH_SIZE):
+        """
+        Loads what earlier runs of the job recorded
+        :param db_io: DatabaseIo with an open session
+        :param job_key: string. identifies the job, see RenameJob.job_key
+        :param batch_size: int. updates held before they are committed
+        """
 
-        logging.info("- INFO: image path: {0}, shp path: {1}, working directory: "
-                     "{2}".format(image_path, shp_path, working_directory))
+        self.session = db_io.session
+        self.table = db_io.journal_table
+        self.job_key = job_key
+        self.batch_size = batch_size
+        self.pending = 0
 
-        paths = (image_path, shp_path)
+        self.rows = {row.destination: row
+                     for row in self.session.query(self.table).filter_by(job=job_key)}
 
-        # Create the directories relative to user's working directory
-        directories = (working_directory, join(working_directory, 'PSH'),
-                       join(working_directory, 'PAN'),
-                       join(working_directory, 'uncategorized_images'),
-                       join(working_directory, 'shp'))
+    def state(self, file):
+        """
+        Gets the recorded state of a planned file
+        :param file: PlannedFile
+        :return: string, or None if the file isn't journalled or its source has changed
+        """
 
-        print("* Creating directories...")
-        for directory in directories:
-            directory_creator(directory)
+        row = self.rows.get(file.destination)
 
-        self.create_new_filenames(paths, working_directory, image_extension)
+        if row is None or row.source != file.source or row.size != file.size:
+            return None
 
-        logging.info("- INFO: Finished at {})".format(get_datetime()))
-        text = "\n-- Image/Shp processing complete at {} --".format(get_datetime())
+        return row.state
 
-        self.ProcessButton.setEnabled(True)
-        self.ProcessButton.setText("Process")
+    def mark(self, file, state, checksum=None):
+        """
+        Records a planned file's state
+        :param file: PlannedFile
+        :param state: string. planned, in_progress, verified or failed
+        :param checksum: string. checksum of the source, if it was copied
+        """
 
-        print("\n** Finished at {} **".format(get_datetime()))
+        row = self.rows.get(file.destination)
+        if row is None:
+            row = self.rows[file.destination] = self.table(job=self.job_key,
+                                                           destination=file.destination)
+            self.session.add(row)
 
+        row.source = file.source
+        row.size = file.size
+        row.state = state
+        row.timestamp = datetime.datetime.now()
+        if checksum is not None:
+            row.checksum = checksum
 
-def match_shp_to_image(shp_filename_values, image_ids):
-    """
-    Finds shapefiles that match image files, by name
-    :param shp_filename_values: array containing split strings in shp filename
-    :param image_ids: tuple of image names
-    :return: matched id (string)
-    """
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
 
-    sid = None
-    type = None
+    def commit(self):
+        """
+        Writes held updates to the database
+        """
 
-    for image_id in image_ids:
-        if 'PIXEL' in shp_filename_values:
-            for value in shp_filename_values:
-                if value.isdigit() and len(value) == 12:
-                    if value == image_id[0]:
-                        sid = value  # try to match shp id to image id
-                        type = image_id[1]
-    return sid, type
+        self.session.commit()
+        self.pending = 0
 
 
-def create_manifest(destination, data):
+class ContentIndex:
     """
-    Create list of input/output files
+    Index of the files earlier runs placed in any output directory, by content, kept in
+    the spatialite db. A file delivered again under another name is found by its size,
+    then by a hash of its start and end, and is only linked to the earlier copy once
+    its full checksum matches too. Entries unused for max_age days are evicted, then
+    the least recently used ones beyond max_entries, so the index stays bounded.
+
+    Lookups run on the copy workers against a plain copy of the index; the database
+    is only touched on the job's thread.
     """
 
-    file = join(destination, 'manifest.txt')
-
-    time = get_datetime()
-
-    with open(file, "a") as manifest_file:
-        manifest_file.write('- {0}: copied from {1} written to {2}\n'.format(time, data[1], data[0]))
+    def __init__(self, db_io, algorithm=CHECKSUM_ALGORITHM, link_mode='hardlink',
+                 max_entries=CONTENT_INDEX_SIZE, max_age=CONTENT_INDEX_AGE):
+        """
+        Loads the index
+        :param db_io: DatabaseIo with an open session
+        :param algorithm: string. checksum algorithm of the job. Entries hashed with
+        another algorithm are ignored.
+        :param link_mode: string. one of DEDUP_MODES
+        :param max_entries: int. entries kept
+        :param max_age: int. days an unused entry is kept
+        """
 
+        if link_mode not in DEDUP_MODES:
+            raise ValueError("Unknown dedup mode {0}. Choose one of: {1}"
+                             .format(link_mode, ', '.join(DEDUP_MODES)))
+
+        self.session = db_io.session
+        self.table = db_io.content_table
+        self.algorithm = algorithm
+        self.link_mode = link_mode
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.used = set()  # paths linked to this run, touched on commit
+        self.missing = set()  # paths found deleted or changed, dropped on commit
+
+        self.rows = {row.path: row for row in
+                     self.session.query(self.table).filter_by(algorithm=algorithm)}
+        self.entries = {}  # size -> {path: (partial hash, checksum, mtime)}
+        for row in self.rows.values():
+            self.entries.setdefault(row.size, {})[row.path] = (row.partial_hash,
+                                                               row.checksum, row.mtime)
+
+    def find(self, original_file, size):
+        """
+        Finds an earlier placed file with the same content. Runs on a copy worker.
+        :param original_file: string. file about to be copied
+        :param size: int. its size
+        :return: tuple (path of the earlier file, checksum), or None
+        """
 
-def get_checksum(file):
-    """
-    Returns sha1 checksum of file
-    :param file: file
-    :return: string (checksum)
-    """
-    # sha1_checksum = sha1()
-    buffer_size = 256
+        with self.lock:
+            candidates = list(self.entries.get(size, {}).items())
 
-    with open(file, 'rb') as f:
-        while True:
-            data = f.read(buffer_size)
-            return sha1(data).hexdigest()
+        if not candidates:  # the usual case, and it costs no reads
+            return None
 
+        partial = get_partial_checksum(original_file, size)
+        checksum = None
 
-def file_copier(data, destination):
-    """
-    Copies files from source to destination
-    :param data: tuple containing source, destination, ID and image type
-    :return: IO
-    """
-    copied_count = 0
+        for earlier, (partial_hash, earlier_checksum, mtime) in candidates:
+            if partial_hash != partial:
+                continue
 
-    if exists(destination):
-        for file in data:  # copy each file
+            try:
+                earlier_stat = stat(earlier)
+            except OSError:
+                earlier_stat = None
 
-            if not exists(file[1]):
+            if earlier_stat is None or earlier_stat.st_size != size or \
+                    earlier_stat.st_mtime != mtime:
+                with self.lock:
+                    self.missing.add(earlier)
+                continue
 
-                original_file = file[0]
-                new_file = file[1]
+            if checksum is None:
+                checksum = get_checksum(original_file, self.algorithm)
 
-                original_checksum = get_checksum(original_file)
-                copyfile(original_file, new_file)
+            if checksum == earlier_checksum:
+                with self.lock:
+                    self.used.add(earlier)
+                return earlier, checksum
 
-                # Ensure output file is identical to input file
-                while original_checksum != get_checksum(new_file):
-                    logging.warning("File checksum mismatch. Attempting copy again. {}"
-                                    .format(new_file))
-                    copyfile(original_file, new_file)
+        return None
 
-                logging.info("- INFO: Copied file {0} to {1}".format(original_file, new_file))
+    def place(self, original_file, new_file, size):
+        """
+        Links a file to an identical earlier copy instead of copying it. Runs on a copy
+        worker.
+        :param original_file: string. source path
+        :param new_file: string. path to place the link at
+        :param size: int. bytes
+        :return: string. checksum of the source, or None if there is no earlier copy
+        or it can't be linked to
+        """
 
-                create_manifest(destination, (new_file, original_file))
-                copied_count += 1
-                print(" - Copied file {0} of {1}".format(copied_count, len(data)))
+        if size < CONTENT_MIN_SIZE:
+            return None
 
-            else:
-                text = ("- Warning: File {} already exists in destination. "
-                        "Not copying.".format(file[1]))
-                # print("\t".format(text))
-                logging.warning(text)
-    else:
-        text = ("- WARNING: directory {} does not exist and I could "
-                "not create it.".format(destination))
-        logging.warning(text)
+        found = self.find(original_file, size)
+        if found is None:
+            return None
 
+        earlier, checksum = found
 
-def check_for_duplicates(files_to_check):
-    """
-    Checks for duplicates
-    :param files_to_check: tuple containing split filenames
-    :return: bool
-    """
+        try:
+            link(earlier, new_file)
+        except OSError as e:
+            if self.link_mode != 'symlink':
+                logging.info("- INFO: {0} is identical to {1} but could not be linked to "
+                             "it, copying instead: {2}".format(original_file, earlier, e))
+                return None
+            symlink(path.abspath(earlier), new_file)
 
-    file_name_list = []
-    count_dict = {}
+        return checksum
 
-    error_status = False
+    def add(self, file_path, size, checksum):
+        """
+        Records a placed file. Symlinks and small files aren't indexed.
+        :param file_path: string. placed file
+        :param size: int. bytes
+        :param checksum: string. full checksum in the index's algorithm
+        """
 
-    for file in files_to_check:
-        file_name_list.append(file[2])
-        count_dict[file[0]] = file_name_list.count(file[2])
+        if size < CONTENT_MIN_SIZE or checksum is None or path.islink(file_path):
+            return
 
-    for filename, count in count_dict.items():
-        if count > 1:
-            text = ("- ERROR: Duplicate filename {}".format(filename))
-            logging.error(text)
+        # The index outlives the run, so it can't hold paths relative to this run's cwd
+        file_path = path.normcase(path.abspath(file_path))
 
-            error_status = True
+        try:
+            mtime = stat(file_path).st_mtime
+            partial = get_partial_checksum(file_path, size)
+        except OSError as e:
+            logging.warning("- WARNING: could not index {0}: {1}".format(file_path, e))
+            return
 
-    return error_status
+        row = self.rows.get(file_path)
+        if row is None:
+            row = self.rows[file_path] = self.table(path=file_path)
+            self.session.add(row)
 
+        row.size = size
+        row.mtime = mtime
+        row.partial_hash = partial
+        row.checksum = checksum
+        row.algorithm = self.algorithm
+        row.last_used = datetime.datetime.now()
 
-class DatabaseIo:
-    """
-    Methods for storing and reading from spatialite db. Populating a spatialite db will allow for
-    much faster processing if there are multiple iterations.
-    """
+        with self.lock:
+            self.entries.setdefault(size, {})[file_path] = (partial, checksum, mtime)
+            self.missing.discard(file_path)
 
-    def __init__(self):
+    def commit(self):
         """
-        Initialize the class
+        Touches the entries used by this run, evicts stale ones and writes the index
         """
 
-        # Set the DB path
-        self.db_path = None
-        self.get_db_path()
+        now = datetime.datetime.now()
+        table = self.table
 
-    def get_db_path(self):
-        """
-         Set path for spatialite db storage
-        """
+        with self.lock:
+            used, self.used = self.used, set()
+            missing, self.missing = self.missing, set()
+            for earlier in missing:
+                self.entries.get(self.rows[earlier].size, {}).pop(earlier, None)
 
-        if getattr(sys, 'frozen', False):  # Determine if running from an executable
-            application_path = path.join(sys.path[0], "str.db")  # Get exe location
-        else:
-            application_path = path.dirname(__file__)  # if not exe, just use python script loc
+        for earlier in used - missing:
+            self.rows[earlier].last_used = now
 
-        self.db_path = path.join(application_path, 'STR.db')
+        for earlier in missing:
+            self.session.delete(self.rows.pop(earlier))
 
-    def init_db(self):
-        """
-        Create .db file
-        """
+        self.session.flush()
+        cutoff = now - datetime.timedelta(days=self.max_age)
+        evicted = self.session.query(table).filter(table.last_used < cutoff) \
+            .delete(synchronize_session=False)
+
+        surplus = self.session.query(table).count() - self.max_entries
+        if surplus > 0:
+            oldest = [row.id for row in self.session.query(table.id)
+                      .order_by(table.last_used).limit(surplus)]
+            evicted += self.session.query(table).filter(table.id.in_(oldest)) \
+                .delete(synchronize_session=False)
+
+        self.session.commit()
+
+        if evicted:
+            logging.info("- INFO: evicted {} entries from the content index".format(evicted))
 
 
 class ShapeReader:
@@ -477,28 +4476,109 @@ class ShapeReader:
 
     def __init__(self, shape_path):
         self.shape_path = shape_path
+        self.shape_type = None
+        self.bounds = None
+        self.polygons = None
+
+    def read_header(self):
+        """
+        Reads the 100 byte .shp header, which holds the shape type and the extent of
+        every shape in the file
+        :return: bool. False if the file isn't a readable shapefile
+        """
+
+        try:
+            with open(self.shape_path, 'rb') as f:
+                header = f.read(SHP_HEADER_SIZE)
+        except (IOError, OSError) as e:
+            logging.warning("- WARNING: could not read {0}: {1}".format(self.shape_path, e))
+            return False
+
+        if len(header) < SHP_HEADER_SIZE or unpack('>i', header[:4])[0] != SHP_FILE_CODE:
+            logging.warning("- WARNING: {} is not a shapefile".format(self.shape_path))
+            return False
+
+        self.shape_type = unpack('<i', header[32:36])[0]
+        self.bounds = unpack('<4d', header[36:68])
+
+        return True
 
     def read_shapefile(self):
         """
-        Reads the shapefile
+        Reads the shapefile's polygons. Only the x/y coordinates are kept.
+        :return: list of polygons, each a list of rings of (x, y) points
         """
 
-        pass
+        self.polygons = []
+
+        if self.shape_type is None and not self.read_header():
+            return self.polygons
+
+        with open(self.shape_path, 'rb') as f:
+            data = f.read()
+
+        offset = SHP_HEADER_SIZE
+        while offset + 8 <= len(data):
+            content_length = unpack('>i', data[offset + 4:offset + 8])[0] * 2  # 16 bit words
+            content = data[offset + 8:offset + 8 + content_length]
+            offset += 8 + content_length
+
+            if len(content) < 44 or unpack('<i', content[:4])[0] not in SHP_POLYGON_TYPES:
+                continue  # null shape or not a polygon
+
+            part_count, point_count = unpack('<2i', content[36:44])
+            parts = unpack('<{}i'.format(part_count), content[44:44 + 4 * part_count])
+            points_start = 44 + 4 * part_count
+            coordinates = unpack('<{}d'.format(2 * point_count),
+                                 content[points_start:points_start + 16 * point_count])
+            points = list(zip(coordinates[0::2], coordinates[1::2]))
+
+            ends = parts[1:] + (point_count, )
+            self.polygons.append([points[start:end] for start, end in zip(parts, ends)])
+
+        return self.polygons
 
     def shapefile_bounds(self):
         """
         Gets the shapefile bounds (actual, not bb)
+        :return: tuple (minx, miny, maxx, maxy), or None if the file can't be read
         """
 
-        pass
+        if self.bounds is None:
+            self.read_header()
+
+        return self.bounds
 
     def shapefile_centroid(self):
         """
-        Gets the shapefile centroid
-
+        Gets the shapefile centroid, weighted by polygon area so holes pull it the
+        right way
+        :return: tuple (x, y), or None if the file can't be read
         """
 
-        pass
+        if self.polygons is None:
+            self.read_shapefile()
+
+        total_area = 0.0
+        x_sum = 0.0
+        y_sum = 0.0
+
+        for polygon in self.polygons:
+            for ring in polygon:
+                for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+                    cross = x1 * y2 - x2 * y1
+                    total_area += cross
+                    x_sum += (x1 + x2) * cross
+                    y_sum += (y1 + y2) * cross
+
+        if abs(total_area) > 1e-12:
+            return x_sum / (3.0 * total_area), y_sum / (3.0 * total_area)
+
+        bounds = self.shapefile_bounds()  # no area, e.g. points or lines
+        if bounds is None:
+            return None
+
+        return (bounds[0] + bounds[2]) / 2.0, (bounds[1] + bounds[3]) / 2.0
 
 
 class ImageReader:
@@ -511,27 +4591,88 @@ class ImageReader:
         Initialize the class
         """
         self.image_path = image_path
+        self.width = None
+        self.height = None
+        self.geotransform = None
+        self.projection = None
 
     def read_image(self):
         """
-        Read the geotiff using GDAL
+        Read the image header. GeoTIFF and Imagine headers are parsed directly from a
+        memory map; anything else is opened with GDAL. Pixels are left on disk.
+        :return: bool. False if the image can't be read
         """
 
-        pass
+        metadata = read_raster_header(self.image_path)
+        if metadata is not None:
+            self.width = metadata.width
+            self.height = metadata.height
+            self.geotransform = metadata.geotransform
+            self.projection = metadata.crs
+
+            return self.geotransform is not None
+
+        if gdal is None:
+            logging.warning("- WARNING: GDAL is not installed, can't read {}"
+                            .format(self.image_path))
+            return False
+
+        dataset = gdal.Open(self.image_path)
+        if dataset is None:
+            logging.warning("- WARNING: GDAL could not open {}".format(self.image_path))
+            return False
+
+        self.width = dataset.RasterXSize
+        self.height = dataset.RasterYSize
+        self.geotransform = dataset.GetGeoTransform(can_return_null=True)
+        self.projection = dataset.GetProjection()
+
+        return self.geotransform is not None
 
     def image_bounds(self):
         """
         Get the geotiff bounding box
+        :return: tuple (minx, miny, maxx, maxy), or None if the image isn't georeferenced
         """
 
-        pass
+        if self.geotransform is None and not self.read_image():
+            return None
+
+        origin_x, pixel_width, row_rotation, origin_y, column_rotation, pixel_height = \
+            self.geotransform
+
+        xs = []
+        ys = []
+        for column, row in ((0, 0), (self.width, 0), (0, self.height),
+                            (self.width, self.height)):
+            xs.append(origin_x + column * pixel_width + row * row_rotation)
+            ys.append(origin_y + column * column_rotation + row * pixel_height)
+
+        return min(xs), min(ys), max(xs), max(ys)
 
     def image_centroid(self):
         """
         Gets the image centroid
+        :return: tuple (x, y), or None if the image isn't georeferenced
         """
 
-        pass
+        bounds = self.image_bounds()
+        if bounds is None:
+            return None
+
+        return (bounds[0] + bounds[2]) / 2.0, (bounds[1] + bounds[3]) / 2.0
+
+
+def get_application_path():
+    """
+    Gets the directory the application runs from, where STR.db and the naming rules live
+    :return: string
+    """
+
+    if getattr(sys, 'frozen', False):  # Determine if running from an executable
+        return path.dirname(sys.executable)  # Get exe location
+
+    return path.dirname(path.abspath(__file__))  # if not exe, just use python script loc
 
 
 def directory_creator(directory_to_create):
@@ -545,6 +4686,62 @@ def directory_creator(directory_to_create):
         makedirs(directory_to_create)
 
 
+def shared_pool(executor, workers):
+    """
+    Gets the pool copies run on
+    :param executor: ThreadPoolExecutor shared by a JobQueue, left running afterwards,
+    or None
+    :param workers: int. threads of the pool started when there is no shared one
+    :return: context manager giving the executor
+    """
+
+    if executor is not None:
+        return contextlib.nullcontext(executor)
+
+    return ThreadPoolExecutor(max_workers=max(1, workers))
+
+
+@contextlib.contextmanager
+def job_log(logfile):
+    """
+    Sends log records to a job's own log file while it runs, so each job of a JobQueue
+    gets its own renamer.log
+    :param logfile: string. path of the log, overwritten
+    """
+
+    handler = logging.FileHandler(logfile, mode='w')
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    logger = logging.getLogger()
+    level = logger.level
+    if logger.getEffectiveLevel() > logging.INFO:
+        logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    try:
+        yield
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+        logger.setLevel(level)
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """
+    Turns the cyclic garbage collector off for a block. Reference counting still frees
+    everything that isn't part of a cycle.
+    """
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
 def get_datetime():
     """
     Gets pretty datetime
@@ -554,8 +4751,282 @@ def get_datetime():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
 
 
+def parse_rate(text):
+    """
+    Parses a transfer rate for --bwlimit
+    :param text: string. bytes per second, e.g. 500K, 50M or 1.5G
+    :return: float. bytes per second
+    """
+
+    multiplier = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}.get(text[-1:].upper())
+
+    try:
+        rate = float(text[:-1] if multiplier else text) * (multiplier or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid rate {!r}, use e.g. 50M".format(text))
+
+    if rate <= 0:
+        raise argparse.ArgumentTypeError("rate must be more than 0")
+
+    return rate
+
+
+def load_naming_rules(rules_file):
+    """
+    Loads the naming rules file for --naming-rules
+    :param rules_file: string. JSON file, see NamingRules.load
+    :return: NamingRules
+    """
+
+    try:
+        return NamingRules.load(rules_file)
+    except (IOError, OSError, ValueError) as e:  # json errors are ValueErrors too
+        raise argparse.ArgumentTypeError("could not load naming rules: {}".format(e))
+
+
+def parse_hours(text):
+    """
+    Parses an hour window for --bwlimit-hours
+    :param text: string. START-END in whole hours, e.g. 8-18
+    :return: tuple (start hour, end hour)
+    """
+
+    try:
+        start, end = (int(hour) for hour in text.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid hours {!r}, use e.g. 8-18".format(text))
+
+    if not (0 <= start <= 23 and 0 <= end <= 24) or start == end:
+        raise argparse.ArgumentTypeError("hours must be two different hours of the day")
+
+    return start, end
+
+
+def parse_args(args):
+    """
+    Parses command line arguments for a headless run
+    :param args: list of strings, without the program name
+    :return: argparse.Namespace
+    """
+
+    parser = argparse.ArgumentParser(
+        prog='ShapeTiffRenamer',
+        description="Rename matching rasters & shapefiles to a common name and sort them "
+                    "by pansharpening status. Run without arguments to open the GUI.")
+
+    parser.add_argument('image_root', nargs='?', help="directory containing the imagery")
+    parser.add_argument('shape_root', nargs='?', help="directory containing the shapefiles")
+    parser.add_argument('output_dir', nargs='?',
+                        help="directory the sorted files are written to")
+    parser.add_argument('--queue', metavar='FILE',
+                        help="run every job in a JSON queue file instead, highest priority "
+                             "first, on one shared copy pool. The other options are the "
+                             "defaults for each job")
+    parser.add_argument('--image-type', choices=('.img', '.tif'), default='.img',
+                        help="image file extension (default: .img)")
+    parser.add_argument('--mode', choices=OUTPUT_MODES, default=OUTPUT_MODE,
+                        help="how files are placed in the output directory (default: copy)")
+    parser.add_argument('--workers', type=int, default=COPY_WORKERS,
+                        help="files copied at once (default: {})".format(COPY_WORKERS))
+    parser.add_argument('--volume-limit', type=int, default=VOLUME_COPY_LIMIT,
+                        help="copies at once per volume (default: {})"
+                        .format(VOLUME_COPY_LIMIT))
+    parser.add_argument('--checksum', choices=sorted(CHECKSUM_ALGORITHMS),
+                        default=CHECKSUM_ALGORITHM,
+                        help="checksum algorithm (default: {})".format(CHECKSUM_ALGORITHM))
+    parser.add_argument('--no-verify', dest='verify', action='store_false',
+                        help="don't re-read copies to verify them")
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help="directory name glob to skip, may be repeated "
+                             "(default: {})".format(' '.join(EXCLUDE_DIRS)))
+    parser.add_argument('--scan-processes', type=int, default=SCAN_PROCESSES, metavar='N',
+                        help="scan and parse the roots on N processes, each taking a share "
+                             "of the subdirectories. Helps on very large roots (default: "
+                             "{}, scan in this process)".format(SCAN_PROCESSES))
+    parser.add_argument('--naming-rules', type=load_naming_rules, metavar='FILE',
+                        help="JSON file of vendor naming rules tried before the default "
+                             "one (default: {} next to the program, if there is one)"
+                             .format(NAMING_RULES_FILE))
+    parser.add_argument('--no-catalog', dest='catalog', action='store_false',
+                        help="don't read or update the scan catalog in STR.db")
+    parser.add_argument('--manifest-format', choices=MANIFEST_FORMATS, default=MANIFEST_FORMAT,
+                        help="manifest.txt as before, or manifest.csv/.jsonl with size, "
+                             "checksum and copy time per file (default: txt)")
+    parser.add_argument('--match', choices=MATCH_MODES, default=MATCH_MODE,
+                        help="match shapefiles to images by the ID in their name, by "
+                             "location, or by name then location (default: name)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="plan the renames and write the plan without copying anything")
+    parser.add_argument('--plan-file', metavar='PATH',
+                        help="where to write the plan (default: plan.csv in the output dir)")
+    parser.add_argument('--stream', action='store_true',
+                        help="start copying while the roots are still being scanned "
+                             "instead of planning everything first (name matching only)")
+    parser.add_argument('--watch', action='store_true',
+                        help="after the first pass, keep running and sort new or changed "
+                             "files as they land under the roots, until Ctrl+C. Uses "
+                             "inotify, and polls roots on network mounts")
+    parser.add_argument('--poll', type=float, metavar='SECONDS',
+                        help="with --watch, walk the roots every SECONDS instead of using "
+                             "inotify (default: only network mounts are polled, every {:g} "
+                             "seconds)".format(POLL_INTERVAL))
+    parser.add_argument('--settle', type=float, default=WATCH_SETTLE, metavar='SECONDS',
+                        help="with --watch, seconds a new file's size must hold before it "
+                             "is sorted (default: {:g})".format(WATCH_SETTLE))
+    parser.add_argument('--dedup', choices=DEDUP_MODES,
+                        help="hardlink files identical to one an earlier run placed instead "
+                             "of copying them again; 'symlink' links across filesystems "
+                             "too. Uses the content index in STR.db")
+    parser.add_argument('--bwlimit', type=parse_rate, metavar='RATE',
+                        help="cap the combined copy rate, in bytes per second with an "
+                             "optional K, M or G suffix, e.g. 50M")
+    parser.add_argument('--bwlimit-hours', type=parse_hours, metavar='START-END',
+                        help="only apply --bwlimit between these hours, local time, "
+                             "e.g. 8-18 (default: all day)")
+    parser.add_argument('--profile', action='store_true',
+                        help="run under cProfile; writes profile.pstats and lists the "
+                             "slowest functions in run_report.txt")
+    parser.add_argument('--json', action='store_true',
+                        help="print run statistics as JSON on stdout; progress goes to stderr")
+
+    options = parser.parse_args(args)
+
+    directories = (options.image_root, options.shape_root, options.output_dir)
+    if options.queue is not None:
+        if any(directories):
+            parser.error("give either --queue or the three directories, not both")
+        if options.plan_file:
+            parser.error("--plan-file can't be used with --queue, each job writes its own "
+                         "plan.csv")
+        if options.watch:
+            parser.error("--watch can't be used with --queue")
+    elif not all(directories):
+        parser.error("image_root, shape_root and output_dir are required without --queue")
+
+    if options.watch and (options.dry_run or options.match != 'name'):
+        parser.error("--watch needs name matching and can't be a dry run")
+    if options.poll is not None and not options.watch:
+        parser.error("--poll only applies with --watch")
+    if (options.poll is not None and options.poll <= 0) or options.settle < 0:
+        parser.error("--poll must be more than 0 and --settle can't be negative")
+
+    return options
+
+
+def run_cli(args):
+    """
+    Runs the renamer without the GUI
+    :param args: list of strings, without the program name
+    :return: int. process exit code
+    """
+
+    options = parse_args(args)
+
+    if options.queue is not None:
+        return run_queue(options)
+
+    for directory in (options.image_root, options.shape_root):
+        if not path.isdir(directory):
+            print("{} is not a directory".format(directory), file=sys.stderr)
+            return EXIT_USAGE
+
+    job = RenameJob(options.image_root, options.shape_root, options.output_dir,
+                    options.image_type, options.mode, options.workers, options.volume_limit,
+                    options.checksum, options.verify, options.exclude or EXCLUDE_DIRS,
+                    use_catalog=options.catalog, dry_run=options.dry_run,
+                    plan_file=options.plan_file, manifest_format=options.manifest_format,
+                    match_mode=options.match, profile=options.profile,
+                    stream=options.stream, bandwidth_limit=options.bwlimit,
+                    bandwidth_hours=options.bwlimit_hours, dedup=options.dedup,
+                    scan_processes=options.scan_processes, naming_rules=options.naming_rules,
+                    watch=options.watch, watch_interval=options.poll,
+                    watch_settle=options.settle)
+
+    def stop(signum, frame):
+        # A watch is stopped gracefully first; stopping again cancels what's queued
+        if job.watch and not job.watch_stopped.is_set():
+            job.stop_watching()
+        else:
+            job.cancel()
+
+    # Ctrl+C stops the job between files instead of killing copies part way through
+    signal.signal(signal.SIGINT, stop)
+    if options.watch:
+        signal.signal(signal.SIGTERM, stop)
+
+    # Keep stdout clean for the JSON summary
+    progress = sys.stderr if options.json else sys.stdout
+    with contextlib.redirect_stdout(progress):
+        stats = job.run()
+
+    code = job.exit_code()
+
+    if options.json:
+        stats['exit_code'] = code
+        print(json.dumps(stats, indent=2))
+
+    return code
+
+
+def run_queue(options):
+    """
+    Runs the jobs of a queue file without the GUI
+    :param options: argparse.Namespace from parse_args
+    :return: int. process exit code
+    """
+
+    job_queue = JobQueue(options.workers, options.volume_limit,
+                         image_extension=options.image_type, output_mode=options.mode,
+                         algorithm=options.checksum, verify=options.verify,
+                         exclude_dirs=options.exclude or EXCLUDE_DIRS,
+                         use_catalog=options.catalog, dry_run=options.dry_run,
+                         manifest_format=options.manifest_format, match_mode=options.match,
+                         profile=options.profile, stream=options.stream,
+                         bandwidth_limit=options.bwlimit,
+                         bandwidth_hours=options.bwlimit_hours, dedup=options.dedup,
+                         scan_processes=options.scan_processes,
+                         naming_rules=options.naming_rules)
+
+    try:
+        job_queue.load(options.queue)
+    except (IOError, OSError, ValueError) as e:  # json errors are ValueErrors too
+        print("could not load {0}: {1}".format(options.queue, e), file=sys.stderr)
+        return EXIT_USAGE
+
+    signal.signal(signal.SIGINT, lambda signum, frame: job_queue.cancel())
+
+    progress = sys.stderr if options.json else sys.stdout
+    with contextlib.redirect_stdout(progress):
+        job_queue.run()
+
+    try:
+        report_file = job_queue.write(splitext(options.queue)[0] + QUEUE_REPORT_SUFFIX)
+        print("\nWrote queue report to {}".format(report_file), file=progress)
+    except (IOError, OSError) as e:
+        print("could not write the queue report: {}".format(e), file=sys.stderr)
+
+    if options.json:
+        print(json.dumps(job_queue.as_dict(), indent=2))
+    else:
+        print("\n" + job_queue.format_table())
+
+    return job_queue.exit_code()
+
+
+def main(args):
+    """
+    Starts the GUI when run without arguments, otherwise does a headless run
+    :param args: list of strings, without the program name
+    :return: int. process exit code
+    """
+
+    if not args:
+        from main_window import run_gui  # Qt is only imported when the GUI is wanted
+        return run_gui(argv)
+
+    return run_cli(args)
+
+
 if __name__ == '__main__':
-    app = QtWidgets.QApplication(argv)
-    window = GUI()
-    window.show()
-    exit(app.exec_())
+    multiprocessing.freeze_support()  # scan processes of the frozen Windows build
+    exit(main(argv[1:]))
@@ -0,0 +1,744 @@
+"""
+Benchmarks for the scan, match and copy stages, run against a generated delivery.
+
+    python benchmark.py generate ROOT --scenes 5000
+    python benchmark.py run --scenes 2000 --repeat 3
+    python benchmark.py run --root ROOT --stages scan-processes
+    python benchmark.py run --stages parse --parse-names 1000000
+    python benchmark.py run --root ROOT --stages catalog
+
+Each run is appended to benchmark_results.jsonl, so runs can be compared over time
+with `python benchmark.py history`.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import logging
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from os import makedirs, path
+from os.path import join
+from sys import argv, exit
+
+import ShapeTiffRenamer as renamer
+
+RESULTS_FILE = join(path.dirname(path.abspath(__file__)), 'benchmark_results.jsonl')
+SCENES = 1000
+DIRECTORY_DEPTH = 2  # directory levels between a root and its files
+DIRECTORY_FANOUT = 8  # subdirectories per level
+SCENES_PER_DIRECTORY = 20
+IMAGE_SIZE = 64 * 1024  # bytes in each .ige, where Imagine keeps the pixels
+HEADER_SIZE = 4 * 1024  # bytes in each .img, .rrd and .rde
+SHAPE_SIZE = 512  # bytes in each shapefile component
+UNCATEGORIZED_FRACTION = 0.01  # images with neither PAN nor PSH in their name
+REPEAT = 3
+SCAN_PROCESS_COUNTS = (1, 2, 4, 8)  # pool sizes the scan-processes stage compares
+PARSE_NAMES = 1000000  # filenames the parse stage generates, half images and half shapes
+IMAGE_EXTENSIONS = ('.img', '.ige', '.rrd', '.rde')
+SHAPE_EXTENSIONS = ('.shp', '.dbf', '.shx', '.prj')
+MEGABYTE = 1024 * 1024
+RATE_COLUMNS = (('scan_files_per_second', 'scan files/s'),  # result key, column title
+                ('matches_per_second', 'matches/s'),
+                ('plan_files_per_second', 'plan files/s'),
+                ('copy_mb_per_second', 'copy MB/s'))
+
+
+def scene_directory(root, index, depth=DIRECTORY_DEPTH, fanout=DIRECTORY_FANOUT):
+    """
+    Spreads scenes over nested order/strip directories like a real delivery
+    :param root: string. image or shape root
+    :param index: int. scene number
+    :return: string. directory the scene's files go in
+    """
+
+    parts = []
+    block = index // SCENES_PER_DIRECTORY
+    for level in range(depth):
+        parts.append('{0}_{1:03d}'.format(('order', 'strip', 'tile')[min(level, 2)],
+                                          block % fanout))
+        block //= fanout
+
+    return join(root, *parts)
+
+
+def generate_delivery(root, scenes=SCENES, depth=DIRECTORY_DEPTH, fanout=DIRECTORY_FANOUT,
+                      image_size=IMAGE_SIZE, seed=0):
+    """
+    Writes a synthetic delivery: for each scene an Imagine set (.img, .ige, .rrd, .rde)
+    named <12-digit ID>_<PAN|PSH>_P001, and a PIXEL_SHAPE shapefile set naming the
+    same ID. A few images are left uncategorized, like real deliveries.
+    :param root: string. directory to write img/ and shp/ under
+    :param scenes: int. number of scenes
+    :param depth: int. directory levels under each root
+    :param fanout: int. subdirectories per level
+    :param image_size: int. bytes in each .ige
+    :param seed: int. seeds IDs and types so deliveries are repeatable
+    :return: dict. image root, shape root and counts
+    """
+
+    rand = random.Random(seed)
+    image_root = join(root, 'img')
+    shape_root = join(root, 'shp')
+    block = bytes(rand.getrandbits(8) for _ in range(MEGABYTE))
+
+    def write(file_path, size):
+        with open(file_path, 'wb') as f:
+            for start in range(0, size, len(block)):
+                f.write(block[:min(len(block), size - start)])
+
+    ids = rand.sample(range(10 ** 11, 10 ** 12), scenes)
+    files = 0
+    size = 0
+
+    for index, sid in enumerate(ids):
+        image_directory = scene_directory(image_root, index, depth, fanout)
+        shape_directory = scene_directory(shape_root, index, depth, fanout)
+        makedirs(image_directory, exist_ok=True)
+        makedirs(shape_directory, exist_ok=True)
+
+        if rand.random() < UNCATEGORIZED_FRACTION:
+            image_name = '{0}_MUL_P001'.format(sid)
+        else:
+            image_name = '{0}_{1}_P001'.format(sid, rand.choice(('PAN', 'PSH')))
+
+        for extension in IMAGE_EXTENSIONS:
+            extension_size = image_size if extension == '.ige' else HEADER_SIZE
+            write(join(image_directory, image_name + extension), extension_size)
+            files += 1
+            size += extension_size
+
+        date = datetime.date(2016, 1, 1) + datetime.timedelta(days=index % 365)
+        shape_name = '{0}-{1}_P001_PIXEL_SHAPE'.format(date.strftime('%d%b%y').upper(), sid)
+        for extension in SHAPE_EXTENSIONS:
+            write(join(shape_directory, shape_name + extension), SHAPE_SIZE)
+            files += 1
+            size += SHAPE_SIZE
+
+    return {'image_root': image_root, 'shape_root': shape_root, 'scenes': scenes,
+            'files': files, 'bytes': size}
+
+
+def best_time(function, repeat=REPEAT, setup=None):
+    """
+    Times a function, keeping the fastest run
+    :param function: callable. returns what is being counted
+    :param repeat: int. runs
+    :param setup: callable run untimed before each run, or None
+    :return: tuple (seconds, last result)
+    """
+
+    best = None
+    result = None
+
+    for _ in range(max(1, repeat)):
+        if setup is not None:
+            setup()
+
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def bench_scan(delivery, repeat=REPEAT):
+    """
+    Scans both roots
+    :return: dict. files and files per second
+    """
+
+    roots = ((delivery['image_root'], IMAGE_EXTENSIONS),
+             (delivery['shape_root'], SHAPE_EXTENSIONS))
+
+    elapsed, scans = best_time(lambda: renamer.scan_roots(roots), repeat)
+    files = sum(len(scan) for scan in scans)
+
+    return {'scan_files': files, 'scan_seconds': elapsed,
+            'scan_files_per_second': files / elapsed}
+
+
+def bench_scan_processes(delivery, repeat=REPEAT, counts=SCAN_PROCESS_COUNTS):
+    """
+    Scans and parses both roots on process pools of each size, and in this process
+    like a plan without --scan-processes
+    :return: dict. files per second in this process and for each pool size, and each
+    pool's speed-up over this process
+    """
+
+    roots = ((delivery['image_root'], IMAGE_EXTENSIONS, False),
+             (delivery['shape_root'], SHAPE_EXTENSIONS, True))
+
+    def serial():
+        scans = renamer.scan_roots((root, extensions) for root, extensions, shapes in roots)
+        return sum(len(dataset.files) for scan, (root, extensions, shapes) in zip(scans, roots)
+                   for dataset, parsed in renamer.parse_datasets(
+                       renamer.group_datasets(scan), shapes))
+
+    def parallel(processes):
+        return sum(len(dataset.files) for scan in renamer.scan_roots_parallel(roots, processes)
+                   for dataset, parsed in scan)
+
+    elapsed, files = best_time(serial, repeat)
+    results = {'scan_parse_files': files, 'scan_parse_seconds': elapsed,
+               'scan_parse_files_per_second': files / elapsed}
+
+    for processes in counts:
+        pool_elapsed, pool_files = best_time(partial(parallel, processes), repeat)
+        key = 'scan_parse_{}_processes'.format(processes)
+        results[key + '_files_per_second'] = pool_files / pool_elapsed
+        results[key + '_speedup'] = elapsed / pool_elapsed
+
+    return results
+
+
+def format_scan_processes(results):
+    """
+    Formats the scan-processes stage as a table
+    :param results: dict. results of a run
+    :return: string, empty if the stage didn't run
+    """
+
+    if 'scan_parse_files_per_second' not in results:
+        return ''
+
+    lines = ['{0:<12} {1:>12} {2:>9}'.format('scan+parse', 'files/s', 'speed-up'),
+             '{0:<12} {1:>12.1f} {2:>9}'.format('in process',
+                                                 results['scan_parse_files_per_second'], '-')]
+
+    counts = sorted(int(key.split('_')[2]) for key in results
+                    if key.startswith('scan_parse_') and key.endswith('_processes_speedup'))
+
+    for processes in counts:
+        key = 'scan_parse_{}_processes_speedup'.format(processes)
+        lines.append('{0:<12} {1:>12.1f} {2:>8.2f}x'.format(
+                '{} processes'.format(processes),
+                results['scan_parse_{}_processes_files_per_second'.format(processes)],
+                results[key]))
+
+    return '\n'.join(lines)
+
+
+def generate_names(count=PARSE_NAMES, seed=0, mixed_case=False):
+    """
+    Makes image and shapefile names like a delivery's
+    :param count: int. names, half of them images and half shapefile components
+    :param seed: int
+    :param mixed_case: bool. write the type and shape kind tokens in upper, lower or
+    title case rather than upper case only
+    :return: tuple (list of image names, list of shapefile names)
+    """
+
+    generator = random.Random(seed)
+    cases = (str.upper, str.lower, str.title) if mixed_case else (str.upper, )
+
+    images = []
+    shapes = []
+    for index in range(count // 2):
+        sid = '{:012d}'.format(100000000000 + index)
+        case = generator.choice(cases)
+        image_type = 'MUL' if generator.random() < UNCATEGORIZED_FRACTION \
+            else generator.choice(('PAN', 'PSH'))
+        images.append('{0}_{1}_P001{2}'.format(sid, case(image_type),
+                                              generator.choice(IMAGE_EXTENSIONS)))
+        shapes.append('16OCT01-{0}-M1BS-{1}_P001_{2}_SHAPE{3}'.format(
+            sid, sid[:6], case('PIXEL'), generator.choice(SHAPE_EXTENSIONS)))
+
+    return images, shapes
+
+
+def legacy_parse_image(filename):
+    """
+    The image name parsing NamingRules replaced, kept to compare against: two
+    replaces, a split and list searches for exact upper and lower case tokens
+    """
+
+    values = filename.replace('-', '_').replace('.', '_').split('_')
+
+    if 'PAN' in values or 'pan' in values:
+        image_type = renamer.PAN
+    elif 'PSH' in values or 'psh' in values:
+        image_type = renamer.PSH
+    else:
+        image_type = renamer.UNCATEGORIZED
+
+    return sys.intern(values[0]), image_type
+
+
+def legacy_shape_candidates(filename):
+    """
+    The shapefile name parsing NamingRules replaced, kept to compare against
+    """
+
+    values = filename.replace('-', '_').replace('.', '_').split('_')
+
+    if 'PIXEL' not in values:
+        return []
+
+    return [sys.intern(value) for value in values if len(value) == 12 and value.isdigit()]
+
+
+def bench_parse(repeat=REPEAT, count=PARSE_NAMES, rules=None):
+    """
+    Parses generated names with the naming rules and with the split-based parsing
+    they replaced. Both are timed on upper case names, which the old parsing handles
+    in full, then run once on mixed case names to count what each leaves
+    uncategorized or without candidate IDs.
+    :param count: int. names to parse
+    :param rules: NamingRules, or None for the rules a job would use
+    :return: dict. names per second both ways, the speed-up and the mixed case names
+    each way misses
+    """
+
+    rules = renamer.default_naming_rules() if rules is None else rules
+
+    def parse(images, shapes, parse_image, shape_candidates):
+        uncategorized = sum(1 for name in images
+                            if parse_image(name)[1] is renamer.UNCATEGORIZED)
+        return uncategorized, sum(1 for name in shapes if not shape_candidates(name))
+
+    images, shapes = generate_names(count)
+    elapsed = best_time(partial(parse, images, shapes, rules.parse_image,
+                                rules.shape_candidates), repeat)[0]
+    legacy_elapsed = best_time(partial(parse, images, shapes, legacy_parse_image,
+                                       legacy_shape_candidates), repeat)[0]
+    names = len(images) + len(shapes)
+
+    images, shapes = generate_names(count, mixed_case=True)
+    uncategorized, unmatched = parse(images, shapes, rules.parse_image,
+                                     rules.shape_candidates)
+    legacy_uncategorized, legacy_unmatched = parse(images, shapes, legacy_parse_image,
+                                                   legacy_shape_candidates)
+
+    return {'parse_names': names, 'parse_seconds': elapsed,
+            'parse_names_per_second': names / elapsed,
+            'parse_legacy_names_per_second': names / legacy_elapsed,
+            'parse_speedup': legacy_elapsed / elapsed,
+            'parse_uncategorized': uncategorized, 'parse_unmatched': unmatched,
+            'parse_legacy_uncategorized': legacy_uncategorized,
+            'parse_legacy_unmatched': legacy_unmatched}
+
+
+def format_parse(results):
+    """
+    Formats the parse stage as a table
+    :param results: dict. results of a run
+    :return: string, empty if the stage didn't run
+    """
+
+    if 'parse_names_per_second' not in results:
+        return ''
+
+    lines = ['{0:<8} {1:>12} {2:>14} {3:>16}'.format('parser', 'names/s', 'uncategorized',
+                                                     'no candidates'),
+             '{0:<8} {1:>12} {2:>31}'.format('', '', '(of the mixed case names)')]
+    for label, prefix in (('rules', 'parse_'), ('legacy', 'parse_legacy_')):
+        lines.append('{0:<8} {1:>12.1f} {2:>14} {3:>16}'.format(
+            label, results[prefix + 'names_per_second'], results[prefix + 'uncategorized'],
+            results[prefix + 'unmatched']))
+    lines.append('{0} names, rules at {1:.2f}x the legacy speed'.format(
+        results['parse_names'], results['parse_speedup']))
+
+    return '\n'.join(lines)
+
+
+def bench_match(delivery, repeat=REPEAT):
+    """
+    Parses every image name into the index, then matches every shapefile to it by
+    name, on an already scanned delivery. Like a real run, each dataset is parsed once
+    for all of its files.
+    :return: dict. matched files and matches per second
+    """
+
+    images, shapes = renamer.scan_roots(((delivery['image_root'], IMAGE_EXTENSIONS),
+                                         (delivery['shape_root'], SHAPE_EXTENSIONS)))
+    image_sets = list(renamer.group_datasets(images))
+    shape_sets = list(renamer.group_datasets(shapes))
+
+    def match():
+        image_index = renamer.ImageIndex()
+        for dataset in image_sets:
+            image_index.add(*renamer.parse_image_filename(dataset.name))
+
+        return sum(len(dataset.files) for dataset in shape_sets
+                   if renamer.parse_shape_filename(dataset.name, image_index)[0])
+
+    elapsed, matches = best_time(match, repeat)
+    files = len(images) + len(shapes)
+
+    return {'match_matches': matches, 'match_seconds': elapsed,
+            'match_files_per_second': files / elapsed, 'matches_per_second': matches / elapsed}
+
+
+def bench_catalog(delivery, output, repeat=REPEAT):
+    """
+    Records every file of a delivery in a new catalog like a first run, and again
+    with every file matched differently like a rerun. The first run is also timed
+    adding one ORM object per file, the way the catalog used to be written.
+    :return: dict. rows per second each way, empty if the database can't be opened
+    """
+
+    files = {'imagery': renamer.scan_tree(delivery['image_root'], IMAGE_EXTENSIONS),
+             'shape data': renamer.scan_tree(delivery['shape_root'], SHAPE_EXTENSIONS)}
+    rows = sum(len(scanned_files) for scanned_files in files.values())
+    numbers = itertools.count()
+    opened = []
+
+    def setup():
+        if opened:
+            opened.pop().session.close()
+        db_io = renamer.DatabaseIo(join(output, 'catalog{}.db'.format(next(numbers))))
+        if db_io.init_db() and db_io.writers:
+            opened.append(db_io)
+
+    def write(scene_id):
+        db_io = opened[-1]
+        for step, scanned_files in files.items():
+            catalog = db_io.load_catalog(step)
+            for scanned in scanned_files:
+                db_io.update_catalog(step, catalog, scanned, scene_id, None)
+        db_io.commit()
+
+    def write_objects():
+        from models.SpatialiteDb import CATALOG_TABLES
+
+        session = opened[-1].session
+        for step, scanned_files in files.items():
+            for scanned in scanned_files:
+                session.add(CATALOG_TABLES[step](
+                    path=scanned.path, timestamp=datetime.datetime.now(), size=scanned.size,
+                    mtime=scanned.mtime, scene_id='0', image_type=None))
+        session.commit()
+
+    makedirs(output, exist_ok=True)
+    setup()
+    if not opened:
+        print("Skipping the catalog stage, the database can't be opened here")
+        return {}
+
+    try:
+        inserted = best_time(partial(write, '0'), repeat, setup)[0]
+        updated = best_time(partial(write, '1'), repeat,
+                            lambda: (setup(), write('0')))[0]
+        objects = best_time(write_objects, repeat, setup)[0]
+    finally:
+        setup()
+
+    return {'catalog_rows': rows, 'catalog_insert_rows_per_second': rows / inserted,
+            'catalog_update_rows_per_second': rows / updated,
+            'catalog_orm_rows_per_second': rows / objects,
+            'catalog_speedup': objects / inserted}
+
+
+def format_catalog(results):
+    """
+    Formats the catalog stage
+    :param results: dict. results of a run
+    :return: string, empty if the stage didn't run
+    """
+
+    if 'catalog_insert_rows_per_second' not in results:
+        return ''
+
+    return '\n'.join((
+        '{0:<24} {1:>12}'.format('catalog writes', 'rows/s'),
+        '{0:<24} {1:>12.1f}'.format('bulk, first run', results['catalog_insert_rows_per_second']),
+        '{0:<24} {1:>12.1f}'.format('bulk, rerun', results['catalog_update_rows_per_second']),
+        '{0:<24} {1:>12.1f}'.format('ORM objects, first run',
+                                    results['catalog_orm_rows_per_second']),
+        '{0} rows, bulk first run at {1:.2f}x the ORM speed'.format(
+            results['catalog_rows'], results['catalog_speedup'])))
+
+
+def bench_plan(delivery, output, repeat=REPEAT):
+    """
+    Runs the whole planning stage, scan included, as a dry run without the catalog
+    :return: dict. planned files and files per second
+    """
+
+    def plan():
+        job = renamer.RenameJob(delivery['image_root'], delivery['shape_root'], output,
+                                use_catalog=False, dry_run=True)
+        with contextlib.redirect_stdout(io.StringIO()), renamer.gc_paused():
+            checked, actions = job.check_plan(job.create_new_filenames(
+                (job.image_path, job.shp_path), output, job.image_extension))
+
+        return sum(len(files) for step, destination, files in checked)
+
+    makedirs(output, exist_ok=True)
+    elapsed, planned = best_time(plan, repeat)
+
+    return {'plan_files': planned, 'plan_seconds': elapsed,
+            'plan_files_per_second': planned / elapsed}
+
+
+def bench_copy(delivery, output, repeat=REPEAT, workers=renamer.COPY_WORKERS,
+               algorithm=renamer.CHECKSUM_ALGORITHM, verify=True):
+    """
+    Copies the imagery with file_copier, checksums and verification included. Each
+    image is copied together with its sidecars, like a real run. The output is removed
+    before each run, so every run copies everything.
+    :return: dict. bytes copied and MB per second
+    """
+
+    images = renamer.scan_tree(delivery['image_root'], IMAGE_EXTENSIONS)
+    copy_root = join(output, 'copy')
+    files = [renamer.PlannedFile(scanned.path, join(copy_root, scanned.name), None, None,
+                                 scanned.size, dataset.base)
+             for dataset in renamer.group_datasets(images) for scanned in dataset.files]
+    size = sum(file.size for file in files)
+
+    def setup():
+        shutil.rmtree(copy_root, ignore_errors=True)
+        makedirs(copy_root)
+
+    def copy():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return renamer.file_copier(files, copy_root, workers, algorithm=algorithm,
+                                       verify=verify)['copied']
+
+    elapsed, copied = best_time(copy, repeat, setup)
+    shutil.rmtree(copy_root, ignore_errors=True)
+
+    return {'copy_files': copied, 'copy_bytes': size, 'copy_seconds': elapsed,
+            'copy_mb_per_second': size / MEGABYTE / elapsed,
+            'copy_files_per_second': copied / elapsed}
+
+
+def git_commit():
+    """
+    Gets the commit the benchmark ran on
+    :return: string, or None outside a git checkout
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=path.dirname(path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(delivery, output, stages, repeat=REPEAT, workers=renamer.COPY_WORKERS,
+                   algorithm=renamer.CHECKSUM_ALGORITHM, scan_processes=SCAN_PROCESS_COUNTS,
+                   parse_names=PARSE_NAMES):
+    """
+    Runs the chosen stages against a delivery
+    :param delivery: dict returned by generate_delivery
+    :param output: string. scratch directory for planning and copies
+    :param stages: iterable of 'scan', 'scan-processes', 'parse', 'match', 'catalog',
+    'plan' and 'copy'
+    :param scan_processes: iterable of pool sizes for the scan-processes stage
+    :param parse_names: int. names the parse stage generates
+    :return: dict. the run, ready to be saved
+    """
+
+    results = {}
+    for stage in stages:
+        logging.info("- INFO: benchmarking {}".format(stage))
+        if stage == 'scan':
+            results.update(bench_scan(delivery, repeat))
+        elif stage == 'scan-processes':
+            results.update(bench_scan_processes(delivery, repeat, scan_processes))
+        elif stage == 'parse':
+            results.update(bench_parse(repeat, parse_names))
+        elif stage == 'match':
+            results.update(bench_match(delivery, repeat))
+        elif stage == 'catalog':
+            results.update(bench_catalog(delivery, join(output, 'catalog'), repeat))
+        elif stage == 'plan':
+            results.update(bench_plan(delivery, output, repeat))
+        elif stage == 'copy':
+            results.update(bench_copy(delivery, output, repeat, workers, algorithm))
+
+    return {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scenes': delivery['scenes'],
+            'files': delivery['files'],
+            'repeat': repeat,
+            'workers': workers,
+            'checksum': algorithm,
+            'results': results}
+
+
+def save_result(run, results_file=RESULTS_FILE):
+    """
+    Appends a run to the results file
+    """
+
+    with open(results_file, 'a') as f:
+        f.write(json.dumps(run, sort_keys=True) + '\n')
+
+
+def load_results(results_file=RESULTS_FILE):
+    """
+    Reads the saved runs, oldest first
+    :return: list of dict
+    """
+
+    if not path.exists(results_file):
+        return []
+
+    with open(results_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def format_runs(runs):
+    """
+    Formats runs as a table of their rates
+    :param runs: list of dict from run_benchmarks
+    :return: string
+    """
+
+    lines = ['{0:<20} {1:<9} {2:>7} '.format('time', 'commit', 'scenes') +
+             ' '.join('{:>14}'.format(title) for key, title in RATE_COLUMNS)]
+
+    for run in runs:
+        rates = ' '.join('{:>14.1f}'.format(run['results'][key]) if key in run['results']
+                         else '{:>14}'.format('-') for key, title in RATE_COLUMNS)
+        lines.append('{0:<20} {1:<9} {2:>7} '.format(run['time'], run['commit'] or '-',
+                                                      run['scenes']) + rates)
+
+    return '\n'.join(lines)
+
+
+def parse_args(args):
+    """
+    Parses command line arguments
+    :param args: list of strings, without the program name
+    :return: argparse.Namespace
+    """
+
+    parser = argparse.ArgumentParser(prog='benchmark.py',
+                                     description="Benchmark scanning, matching and copying "
+                                                 "on a synthetic delivery.")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    generate = commands.add_parser('generate', help="write a synthetic delivery")
+    generate.add_argument('root', help="directory to write img/ and shp/ under")
+
+    run = commands.add_parser('run', help="benchmark, and save the results")
+    run.add_argument('--root', help="existing delivery from 'generate'. Without it, one "
+                                    "is generated in a temporary directory and removed")
+    run.add_argument('--stages', nargs='+', default=['scan', 'match', 'plan', 'copy'],
+                     choices=('scan', 'scan-processes', 'parse', 'match', 'catalog', 'plan',
+                              'copy'),
+                     help="stages to run (default: %(default)s). scan-processes compares "
+                          "process pools for --scan-processes; parse compares the naming "
+                          "rules with the old split-based parsing on generated names; "
+                          "catalog compares bulk catalog writes with ORM objects")
+    run.add_argument('--repeat', type=int, default=REPEAT,
+                     help="runs per stage; the fastest is kept (default %(default)s)")
+    run.add_argument('--workers', type=int, default=renamer.COPY_WORKERS,
+                     help="copy workers (default %(default)s)")
+    run.add_argument('--checksum', default=renamer.CHECKSUM_ALGORITHM,
+                     choices=sorted(renamer.CHECKSUM_ALGORITHMS))
+    run.add_argument('--scan-processes', type=int, nargs='+', default=SCAN_PROCESS_COUNTS,
+                     metavar='N', help="pool sizes for the scan-processes stage "
+                                       "(default: %(default)s)")
+    run.add_argument('--parse-names', type=int, default=PARSE_NAMES, metavar='N',
+                     help="names for the parse stage (default: %(default)s)")
+    run.add_argument('--no-save', action='store_true', help="don't save the results")
+
+    for command in (generate, run):
+        command.add_argument('--scenes', type=int, default=SCENES,
+                             help="scenes to generate (default %(default)s)")
+        command.add_argument('--depth', type=int, default=DIRECTORY_DEPTH,
+                             help="directory levels (default %(default)s)")
+        command.add_argument('--fanout', type=int, default=DIRECTORY_FANOUT,
+                             help="subdirectories per level (default %(default)s)")
+        command.add_argument('--image-size', type=int, default=IMAGE_SIZE,
+                             help="bytes per .ige (default %(default)s)")
+        command.add_argument('--seed', type=int, default=0)
+
+    for command in (run, commands.add_parser('history', help="show saved results")):
+        command.add_argument('--results', default=RESULTS_FILE,
+                             help="results file (default %(default)s)")
+
+    return parser.parse_args(args)
+
+
+def existing_delivery(root):
+    """
+    Describes a delivery written by an earlier 'generate'
+    :param root: string. directory holding img/ and shp/
+    :return: dict like generate_delivery returns
+    """
+
+    image_root = join(root, 'img')
+    shape_root = join(root, 'shp')
+    images = renamer.scan_tree(image_root, IMAGE_EXTENSIONS)
+    shapes = renamer.scan_tree(shape_root, SHAPE_EXTENSIONS)
+
+    return {'image_root': image_root, 'shape_root': shape_root,
+            'scenes': sum(1 for scanned in images if scanned.extension == '.img'),
+            'files': len(images) + len(shapes),
+            'bytes': sum(scanned.size for scanned in images + shapes)}
+
+
+def main(args):
+    """
+    Runs the benchmark command line
+    :param args: list of strings, without the program name
+    :return: int. exit code
+    """
+
+    args = parse_args(args)
+
+    if args.command == 'history':
+        print(format_runs(load_results(args.results)))
+        return 0
+
+    if args.command == 'generate':
+        delivery = generate_delivery(args.root, args.scenes, args.depth, args.fanout,
+                                     args.image_size, args.seed)
+        print("Wrote {0} files ({1:.1f} MB) for {2} scenes under {3}".format(
+            delivery['files'], delivery['bytes'] / float(MEGABYTE), delivery['scenes'],
+            args.root))
+        return 0
+
+    logging.disable(logging.WARNING)  # unmatched files are expected; keep the log quiet
+    scratch = tempfile.mkdtemp(prefix='str-benchmark-')
+    try:
+        if args.root:
+            delivery = existing_delivery(args.root)
+        else:
+            print("Generating {} scenes...".format(args.scenes))
+            delivery = generate_delivery(join(scratch, 'delivery'), args.scenes, args.depth,
+                                         args.fanout, args.image_size, args.seed)
+
+        run = run_benchmarks(delivery, join(scratch, 'output'), args.stages, args.repeat,
+                             args.workers, args.checksum, args.scan_processes,
+                             args.parse_names)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if not args.no_save:
+        save_result(run, args.results)
+
+    previous = [saved for saved in load_results(args.results) if saved != run][-5:]
+    print(format_runs(previous + [run]))
+
+    for table in (format_scan_processes(run['results']), format_parse(run['results']),
+                  format_catalog(run['results'])):
+        if table:
+            print('\n' + table)
+
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(argv[1:]))
@@ -11,7 +11,7 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 class Ui_MainWindow(object):
     def setupUi(self, MainWindow):
         MainWindow.setObjectName("MainWindow")
-        MainWindow.resize(800, 186)
+        MainWindow.resize(800, 220)
         self.centralwidget = QtWidgets.QWidget(MainWindow)
         self.centralwidget.setObjectName("centralwidget")
         self.label = QtWidgets.QLabel(self.centralwidget)
@@ -43,6 +43,21 @@ class Ui_MainWindow(object):
         self.ImageTypeCombo.setObjectName("ImageTypeCombo")
         self.ImageTypeCombo.addItem("")
         self.ImageTypeCombo.addItem("")
+        self.label_5 = QtWidgets.QLabel(self.centralwidget)
+        self.label_5.setGeometry(QtCore.QRect(594, 60, 81, 16))
+        self.label_5.setObjectName("label_5")
+        self.OutputModeCombo = QtWidgets.QComboBox(self.centralwidget)
+        self.OutputModeCombo.setGeometry(QtCore.QRect(700, 58, 69, 22))
+        self.OutputModeCombo.setObjectName("OutputModeCombo")
+        self.OutputModeCombo.addItem("")
+        self.OutputModeCombo.addItem("")
+        self.OutputModeCombo.addItem("")
+        self.OutputModeCombo.addItem("")
+        self.OutputModeCombo.addItem("")
+        self.OutputWindow = QtWidgets.QPlainTextEdit(self.centralwidget)
+        self.OutputWindow.setGeometry(QtCore.QRect(28, 124, 745, 64))
+        self.OutputWindow.setReadOnly(True)
+        self.OutputWindow.setObjectName("OutputWindow")
         self.ProcessButton = QtWidgets.QPushButton(self.centralwidget)
         self.ProcessButton.setGeometry(QtCore.QRect(698, 90, 75, 23))
         self.ProcessButton.setObjectName("ProcessButton")
@@ -59,7 +74,30 @@ class Ui_MainWindow(object):
         self.menubar = QtWidgets.QMenuBar(MainWindow)
         self.menubar.setGeometry(QtCore.QRect(0, 0, 800, 21))
         self.menubar.setObjectName("menubar")
+        self.menuTools = QtWidgets.QMenu(self.menubar)
+        self.menuTools.setObjectName("menuTools")
+        self.menuQueue = QtWidgets.QMenu(self.menubar)
+        self.menuQueue.setObjectName("menuQueue")
         MainWindow.setMenuBar(self.menubar)
+        self.actionProfileRun = QtWidgets.QAction(MainWindow)
+        self.actionProfileRun.setCheckable(True)
+        self.actionProfileRun.setObjectName("actionProfileRun")
+        self.actionAddToQueue = QtWidgets.QAction(MainWindow)
+        self.actionAddToQueue.setObjectName("actionAddToQueue")
+        self.actionLoadQueue = QtWidgets.QAction(MainWindow)
+        self.actionLoadQueue.setObjectName("actionLoadQueue")
+        self.actionRunQueue = QtWidgets.QAction(MainWindow)
+        self.actionRunQueue.setObjectName("actionRunQueue")
+        self.actionClearQueue = QtWidgets.QAction(MainWindow)
+        self.actionClearQueue.setObjectName("actionClearQueue")
+        self.menuTools.addAction(self.actionProfileRun)
+        self.menuQueue.addAction(self.actionAddToQueue)
+        self.menuQueue.addAction(self.actionLoadQueue)
+        self.menuQueue.addSeparator()
+        self.menuQueue.addAction(self.actionRunQueue)
+        self.menuQueue.addAction(self.actionClearQueue)
+        self.menubar.addAction(self.menuTools.menuAction())
+        self.menubar.addAction(self.menuQueue.menuAction())
 
         self.retranslateUi(MainWindow)
         QtCore.QMetaObject.connectSlotsByName(MainWindow)
@@ -74,8 +112,25 @@ class Ui_MainWindow(object):
         self.label_3.setText(_translate("MainWindow", "Output Directory"))
         self.ImageTypeCombo.setItemText(0, _translate("MainWindow", ".img"))
         self.ImageTypeCombo.setItemText(1, _translate("MainWindow", ".tif"))
+        self.label_5.setText(_translate("MainWindow", "Output Mode"))
+        self.OutputModeCombo.setItemText(0, _translate("MainWindow", "copy"))
+        self.OutputModeCombo.setItemText(1, _translate("MainWindow", "hardlink"))
+        self.OutputModeCombo.setItemText(2, _translate("MainWindow", "reflink"))
+        self.OutputModeCombo.setItemText(3, _translate("MainWindow", "symlink"))
+        self.OutputModeCombo.setItemText(4, _translate("MainWindow", "move"))
         self.ProcessButton.setText(_translate("MainWindow", "Process"))
         self.BrowseForShapeRoot.setText(_translate("MainWindow", "Browse"))
         self.label_2.setText(_translate("MainWindow", "Shape Root Directory"))
         self.ClearButton.setText(_translate("MainWindow", "Clear"))
+        self.menuTools.setTitle(_translate("MainWindow", "Tools"))
+        self.actionProfileRun.setText(_translate("MainWindow", "Profile Run"))
+        self.actionProfileRun.setToolTip(_translate("MainWindow", "Run under cProfile and list the slowest functions in run_report.txt"))
+        self.menuQueue.setTitle(_translate("MainWindow", "Queue"))
+        self.actionAddToQueue.setText(_translate("MainWindow", "Add to Queue"))
+        self.actionAddToQueue.setToolTip(_translate("MainWindow", "Queue the directories and options entered above"))
+        self.actionLoadQueue.setText(_translate("MainWindow", "Load Queue File..."))
+        self.actionLoadQueue.setToolTip(_translate("MainWindow", "Add the jobs of a JSON queue file"))
+        self.actionRunQueue.setText(_translate("MainWindow", "Run Queue"))
+        self.actionRunQueue.setToolTip(_translate("MainWindow", "Run every queued job, highest priority first"))
+        self.actionClearQueue.setText(_translate("MainWindow", "Clear Queue"))
 
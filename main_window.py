@@ -0,0 +1,438 @@
+"""
+Main window for ShapeTiffRenamer. Kept apart from the renaming code so that a
+headless run never imports Qt.
+"""
+
+import logging
+from gui import *
+from ShapeTiffRenamer import RenameJob, DatabaseIo, JobQueue
+
+MEGABYTE = 1024 * 1024
+
+
+class ProcessWorker(QtCore.QThread):
+    """
+    Runs a RenameJob off the GUI thread. Progress is passed back through signals, which
+    Qt delivers on the GUI thread.
+    """
+
+    progress = QtCore.pyqtSignal(dict)
+    job_finished = QtCore.pyqtSignal(dict)
+
+    def __init__(self, payload, db_io, parent=None, profile=False):
+        """
+        Initialize the worker
+        :param payload: tuple of RenameJob arguments collected from the GUI
+        :param db_io: DatabaseIo shared between runs
+        :param profile: bool. run the job under cProfile
+        """
+
+        super(ProcessWorker, self).__init__(parent)
+        self.job = RenameJob(*payload, db_io=db_io, progress=self.progress.emit,
+                             profile=profile)
+
+    def run(self):
+        """
+        Runs the job. Called on the worker thread by QThread.start()
+        """
+
+        try:
+            stats = self.job.run()
+        except Exception as e:  # anything escaping here would be lost with the thread
+            logging.exception("- ERROR: processing failed")
+            stats = dict(self.job.stats, errors=self.job.stats['errors'] + [str(e)])
+
+        self.job_finished.emit(stats)
+
+    def cancel(self):
+        """
+        Asks the job to stop between files
+        """
+
+        self.job.cancel()
+
+
+class QueueWorker(QtCore.QThread):
+    """
+    Runs a JobQueue off the GUI thread, the same way ProcessWorker runs one job
+    """
+
+    progress = QtCore.pyqtSignal(dict)
+    queue_finished = QtCore.pyqtSignal(list)
+
+    def __init__(self, job_queue, parent=None, profile=False):
+        """
+        Initialize the worker
+        :param job_queue: JobQueue built in the GUI
+        :param profile: bool. run each job under cProfile
+        """
+
+        super(QueueWorker, self).__init__(parent)
+        self.job_queue = job_queue
+        self.job_queue.progress = self.progress.emit
+        self.job_queue.options['profile'] = profile
+
+    def run(self):
+        """
+        Runs the queue. Called on the worker thread by QThread.start()
+        """
+
+        try:
+            results = self.job_queue.run()
+        except Exception:  # anything escaping here would be lost with the thread
+            logging.exception("- ERROR: queue failed")
+            results = self.job_queue.results
+
+        self.queue_finished.emit(results)
+
+    def cancel(self):
+        """
+        Stops the running job between files and skips the rest
+        """
+
+        self.job_queue.cancel()
+
+
+def format_progress(snapshot):
+    """
+    Builds the progress text shown in the output window
+    :param snapshot: dict from JobProgress.snapshot
+    :return: string
+    """
+
+    lines = ["Stage: {0} ({1} elapsed)".format(snapshot['stage'],
+                                               format_seconds(snapshot['elapsed'])),
+             "Files scanned: {}".format(snapshot['files_scanned'])]
+
+    if 'job' in snapshot:  # running a queue
+        lines.insert(0, "Job {0} of {1}: {2}".format(snapshot['job'], snapshot['jobs'],
+                                                     snapshot['job_name']))
+
+    if snapshot['files_total']:
+        eta = snapshot['eta']
+        lines.append("Copied {0} of {1} files, {2:.1f} of {3:.1f} MB left at {4:.1f} MB/s, "
+                     "ETA {5}".format(snapshot['files_done'], snapshot['files_total'],
+                                      snapshot['bytes_remaining'] / MEGABYTE,
+                                      snapshot['bytes_total'] / MEGABYTE,
+                                      snapshot['throughput'] / MEGABYTE,
+                                      format_seconds(eta) if eta is not None else '--'))
+
+    return '\n'.join(lines)
+
+
+def format_seconds(seconds):
+    """
+    Gets a duration as H:MM:SS
+    :param seconds: float
+    :return: string
+    """
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{0}:{1:02d}:{2:02d}".format(hours, minutes, seconds)
+
+
+class GUI(QtWidgets.QMainWindow, Ui_MainWindow):
+    def __init__(self):
+
+        super(GUI, self).__init__()
+
+        QtWidgets.QMainWindow.__init__(self)
+        Ui_MainWindow.__init__(self)
+        self.setupUi(self)
+        self.setFixedSize(800, 220)  # no resizing
+        self.output_text = ''
+        self.image_root_set = False
+        self.shp_root_set = False
+        self.working_directory_set = False
+
+        self.ProcessButton.setDisabled(True)
+
+        # Handle button clicks in copy/rename data tab
+        self.ClearButton.clicked.connect(self.handle_tab1_clear_button)
+        self.ProcessButton.clicked.connect(self.handle_tab1_process_button)
+        self.BrowseForImageRoot.clicked.connect(self.handle_img_root_browse)
+        self.BrowseForShapeRoot.clicked.connect(self.handle_shp_root_browse)
+        self.BrowseForOutputDir.clicked.connect(self.handle_output_dir_browse)
+
+        # Queue menu
+        self.actionAddToQueue.triggered.connect(self.handle_add_to_queue)
+        self.actionLoadQueue.triggered.connect(self.handle_load_queue)
+        self.actionRunQueue.triggered.connect(self.handle_run_queue)
+        self.actionClearQueue.triggered.connect(self.handle_clear_queue)
+
+        self.all_files = 0
+        self.total_files = 0
+        self.files_left = 0
+        self.files_processed = 0
+
+        self.db_io = DatabaseIo()  # shared between runs so the catalog is opened once
+        self.worker = None
+        self.job_queue = JobQueue(db_io=self.db_io)
+
+    def handle_tab1_clear_button(self):
+        """
+        Handles the clear button clicked event
+        """
+
+        self.ImageRootInputEdit.clear()
+        self.ShapeRootInputEdit.clear()
+        self.OutputDirectoryEdit.clear()
+        self.OutputWindow.clear()
+        self.process_button_enabler()
+        self.ProcessButton.setText("Process")
+
+    def handle_tab2_clear_button(self):
+        pass
+
+    def handle_tab1_process_button(self):
+        """
+        Handles the process button clicked event. While a job is running the button
+        cancels it instead.
+        """
+
+        if self.worker is not None:
+            self.worker.cancel()
+            self.ProcessButton.setText("Cancelling")
+            self.ProcessButton.setDisabled(True)
+            return
+
+        # Get parameters from GUI
+        image_extension = self.ImageTypeCombo.currentText()
+        output_mode = self.OutputModeCombo.currentText()
+        image_path = self.ImageRootInputEdit.text()
+        shp_path = self.ShapeRootInputEdit.text()
+        working_directory = self.OutputDirectoryEdit.text()
+
+        payload = (image_path, shp_path, working_directory, image_extension, output_mode)
+
+        self.ProcessButton.setText("Processing")
+        self.ProcessButton.setDisabled(True)
+        if len(self.ImageRootInputEdit.text()) > 0 and len(self.ShapeRootInputEdit.text()) > 0 \
+                and len(self.OutputDirectoryEdit.text()) > 0:
+            self.main(payload)
+
+    def handle_add_to_queue(self):
+        """
+        Queues the directories and options entered in the window
+        """
+
+        image_path = self.ImageRootInputEdit.text()
+        shp_path = self.ShapeRootInputEdit.text()
+        working_directory = self.OutputDirectoryEdit.text()
+
+        if not (image_path and shp_path and working_directory):
+            self.OutputWindow.setPlainText("Enter the image root, shape root and output "
+                                           "directory to queue a job.")
+            return
+
+        self.job_queue.add(image_path, shp_path, working_directory,
+                           image_extension=self.ImageTypeCombo.currentText(),
+                           output_mode=self.OutputModeCombo.currentText())
+        self.show_queue()
+
+    def handle_load_queue(self):
+        """
+        Adds the jobs of a queue file
+        """
+
+        queue_file = QtWidgets.QFileDialog.getOpenFileName(self, "Load Queue File", "",
+                                                           "Queue files (*.json)")[0]
+        if not queue_file:
+            return
+
+        try:
+            self.job_queue.load(queue_file)
+        except (IOError, OSError, ValueError) as e:
+            self.OutputWindow.setPlainText("Could not load {0}: {1}".format(queue_file, e))
+            return
+
+        self.show_queue()
+
+    def handle_run_queue(self):
+        """
+        Runs the queued jobs on a worker thread. The process button cancels the queue
+        while it runs.
+        """
+
+        if self.worker is not None or not self.job_queue.entries:
+            return
+
+        self.OutputWindow.clear()
+
+        self.worker = QueueWorker(self.job_queue, self, self.actionProfileRun.isChecked())
+        self.worker.progress.connect(self.handle_progress)
+        self.worker.queue_finished.connect(self.handle_queue_finished)
+        self.worker.start()
+
+        self.ProcessButton.setText("Cancel")
+        self.ProcessButton.setEnabled(True)
+
+    def handle_clear_queue(self):
+        """
+        Empties the queue, unless it is running
+        """
+
+        if isinstance(self.worker, QueueWorker):
+            return
+
+        self.job_queue = JobQueue(db_io=self.db_io)
+        self.OutputWindow.clear()
+
+    def show_queue(self):
+        """
+        Lists the queued jobs in the output window, in the order they will run
+        """
+
+        lines = ["{0} jobs queued:".format(len(self.job_queue.entries))]
+        lines += ["{0}. {1} (priority {2}): {3} -> {4}".format(
+                      number, entry.name, entry.priority, entry.image_path,
+                      entry.working_directory)
+                  for number, entry in enumerate(self.job_queue.ordered(), 1)]
+
+        self.OutputWindow.setPlainText('\n'.join(lines))
+
+    def handle_img_root_browse(self):
+        """
+        Handles user clicking browse for image root path
+        """
+
+        openfile = QtWidgets.QFileDialog.getExistingDirectory(self)
+        self.ImageRootInputEdit.setText(openfile)
+
+        if openfile:
+            self.image_root_set = True
+            self.process_button_enabler()
+
+    def handle_shp_root_browse(self):
+        """
+        Handles user clicking browse for shp root path
+        """
+        self.shp_root_set = False
+
+        openfile = QtWidgets.QFileDialog.getExistingDirectory(self)
+        self.ShapeRootInputEdit.setText(openfile)
+
+        if openfile:
+            self.shp_root_set = True
+            self.process_button_enabler()
+
+    def handle_output_dir_browse(self):
+        """
+        Handles user clicking browse for output dir
+        """
+        self.working_directory_set = False
+
+        openfile = QtWidgets.QFileDialog.getExistingDirectory(self)
+        self.OutputDirectoryEdit.setText(openfile)
+
+        if openfile:
+            self.working_directory_set = True
+            self.process_button_enabler()
+
+    def process_button_enabler(self):
+        """
+        Checks if all three input text items are set and enabled process button if so
+        """
+
+        if self.ImageRootInputEdit.text() and self.ShapeRootInputEdit.text() and \
+                self.OutputDirectoryEdit.text():
+            self.ProcessButton.setEnabled(True)
+            self.ProcessButton.setText("Process")
+
+    def done(self):
+        """
+        Updates the output window when finished.
+        """
+        self.ProcessButton.setEnabled(True)
+        QtWidgets.QApplication.processEvents()
+
+    def main(self, payload):
+        """
+        Runs the entire thing on a worker thread, so the window stays responsive
+        :return:
+        """
+
+        self.OutputWindow.clear()
+
+        self.worker = ProcessWorker(payload, self.db_io, self,
+                                    self.actionProfileRun.isChecked())
+        self.worker.progress.connect(self.handle_progress)
+        self.worker.job_finished.connect(self.handle_job_finished)
+        self.worker.start()
+
+        self.ProcessButton.setText("Cancel")
+        self.ProcessButton.setEnabled(True)
+
+    def handle_progress(self, snapshot):
+        """
+        Shows job progress in the output window
+        :param snapshot: dict from JobProgress.snapshot
+        """
+
+        self.all_files = snapshot['files_scanned']
+        self.total_files = snapshot['files_total']
+        self.files_processed = snapshot['files_done']
+        self.files_left = self.total_files - self.files_processed
+
+        self.OutputWindow.setPlainText(format_progress(snapshot))
+
+    def handle_job_finished(self, stats):
+        """
+        Shows the run summary once the worker is done
+        :param stats: dict returned by RenameJob.run
+        """
+
+        self.worker.wait()
+        self.worker = None
+
+        status = "Cancelled" if stats.get('cancelled_by_user') else "Finished"
+        self.OutputWindow.appendPlainText(
+            "{0}: {1} copied, {2} deduplicated, {3} skipped, {4} failed, {5} unmatched "
+            "shapefiles. See renamer.log and run_report.txt for details."
+            .format(status, stats['copied'], stats['deduplicated'], stats['skipped'],
+                    stats['failed'], stats['unmatched_shapes']))
+
+        self.done()
+        self.ProcessButton.setText("Process")
+
+    def handle_queue_finished(self, results):
+        """
+        Shows the summary of each job once the queue is done
+        :param results: list returned by JobQueue.run
+        """
+
+        self.worker.wait()
+        self.worker = None
+
+        self.OutputWindow.setPlainText(self.job_queue.format_table() +
+                                       "See renamer.log and run_report.txt in each output "
+                                       "directory for details.")
+        self.job_queue = JobQueue(db_io=self.db_io)
+
+        self.done()
+        self.ProcessButton.setText("Process")
+
+    def closeEvent(self, event):
+        """
+        Stops a running job cleanly before the window closes
+        """
+
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.wait()
+
+        super(GUI, self).closeEvent(event)
+
+
+def run_gui(argv):
+    """
+    Shows the main window
+    :param argv: list of strings. command line, passed on to Qt
+    :return: int. process exit code
+    """
+
+    app = QtWidgets.QApplication(argv)
+    window = GUI()
+    window.show()
+    return app.exec_()
@@ -4,22 +4,31 @@ __author__ = 'td27097'
 Main db struct
 """
 
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, ForeignKey, create_engine, MetaData
+import datetime
+from os import environ
+from sqlalchemy import Column, Float, Integer, String, ForeignKey, UniqueConstraint, \
+    bindparam, create_engine, delete, event, select, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.types import DateTime
-from ShapeTiffRenamer import DatabaseIo
-import geoalchemy
+from geoalchemy2 import Geometry, load_spatialite
 
-# Set the DB path
-db_io = DatabaseIo()
-db_path = db_io.get_db_path()
+# load_spatialite reads the extension location from here. Point it at the dll in lib/ on
+# Windows; elsewhere the loader finds mod_spatialite on the library path.
+environ.setdefault('SPATIALITE_LIBRARY_PATH', 'mod_spatialite')
+
+CATALOG_BATCH_SIZE = 5000  # catalog changes held before they are written in one go
+# Set on every connection. In WAL mode the catalog can be read while a batch is being
+# written, and NORMAL sync can only lose the last commits on a power cut, never corrupt
+# the file. cache_size is in KiB when negative.
+PRAGMAS = (('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('temp_store', 'MEMORY'),
+           ('cache_size', -64000), ('busy_timeout', 5000))
 
-# init the db
-engine = create_engine('sqlite:///.{}'.format(db_path))
-metadata = MetaData(engine)
 Base = declarative_base()
 
-__all__ = ['imagery', 'shapedata']
+__all__ = ['Imagery', 'Shapes', 'Journal', 'Content', 'CATALOG_TABLES', 'CatalogRow',
+           'CatalogWriter', 'get_session']
+
 
 class Imagery(Base):
     """
@@ -29,9 +38,14 @@ class Imagery(Base):
     __tablename__ = "imagery"
     id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime)  # Store this for validation
-    path = Column(String)
+    path = Column(String, unique=True)  # the unique index is also the lookup index
+    size = Column(Integer)  # size and mtime tell us if the file changed since the last scan
+    mtime = Column(Float)
+    scene_id = Column(String, index=True)
+    image_type = Column(String)  # PAN, PSH or Uncategorized
     matched_to = Column(Integer, ForeignKey('shapedata.id'))  # Store matches for later use
-    geom = geoalchemy.GeometryColumn(geoalchemy.Polygon(2))  # We will store bounding boxes here
+    geom = Column(Geometry('POLYGON', spatial_index=True))  # We will store bounding boxes here
+
 
 class Shapes(Base):
     """
@@ -41,8 +55,218 @@ class Shapes(Base):
     __tablename__ = "shapedata"
     id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime)  # Store this for validation
-    path = Column(String)
-    geom = geoalchemy.GeometryColumn(geoalchemy.Polygon(2))  # Actual polygon from filesystem
+    path = Column(String, unique=True)
+    size = Column(Integer)
+    mtime = Column(Float)
+    scene_id = Column(String, index=True)  # ID of the matched image, None if unmatched
+    image_type = Column(String)  # type of the matched image
+    geom = Column(Geometry('POLYGON', spatial_index=True))  # Actual polygon from filesystem
+
+
+class Journal(Base):
+    """
+    Table for the copy state of each planned file, so interrupted jobs can resume
+    """
+
+    __tablename__ = "journal"
+    __table_args__ = (UniqueConstraint('job', 'destination'), )
+    id = Column(Integer, primary_key=True)
+    job = Column(String, index=True)  # hash of the image root, shape root and output dir
+    timestamp = Column(DateTime)
+    source = Column(String)
+    destination = Column(String)
+    size = Column(Integer)  # a source that changed size is copied again
+    state = Column(String)  # planned, in_progress, verified or failed
+    checksum = Column(String)
+
+
+class Content(Base):
+    """
+    Table of the files earlier runs placed, by content, so identical files delivered
+    again can be linked instead of copied
+    """
+
+    __tablename__ = "content"
+    id = Column(Integer, primary_key=True)
+    path = Column(String, unique=True)  # placed file
+    size = Column(Integer, index=True)
+    mtime = Column(Float)  # a placed file that changed since is no longer trusted
+    partial_hash = Column(String)  # hash of the start and end of the file
+    checksum = Column(String)  # full checksum, confirms a match
+    algorithm = Column(String)  # of the full checksum
+    last_used = Column(DateTime, index=True)  # entries are evicted oldest first
+
+
+# Scan steps and the tables their files are catalogued in
+CATALOG_TABLES = {'imagery': Imagery,
+                  'shape data': Shapes}
+
+
+class CatalogRow:
+    """
+    What the catalog holds about a file. Loaded and updated as plain objects rather
+    than through the session, which would track every one of them.
+    """
+
+    __slots__ = ('path', 'size', 'mtime', 'scene_id', 'image_type')
+
+    def __init__(self, path, size=None, mtime=None, scene_id=None, image_type=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.scene_id = scene_id
+        self.image_type = image_type
+
+
+class CatalogWriter:
+    """
+    Reads and writes one catalog table in bulk. Changes are held, then written
+    batch_size at a time with one prepared statement each through executemany, inside
+    the session's transaction: new and changed files as an upsert on path, removed
+    files as a delete by path. Nothing is committed here.
+    """
+
+    def __init__(self, session, table, batch_size=CATALOG_BATCH_SIZE):
+        """
+        :param session: sqlalchemy session the statements run in
+        :param table: Imagery or Shapes
+        :param batch_size: int. changes held before they are written
+        """
+
+        self.session = session
+        self.table = table.__table__
+        self.batch_size = batch_size
+        self.changed = {}  # path -> column values to write
+        self.removed = set()  # paths to delete
+
+        columns = self.table.c
+        upsert = insert(self.table)
+        self.upsert = upsert.on_conflict_do_update(
+            index_elements=[columns.path],
+            set_={name: upsert.excluded[name] for name in ('timestamp', 'size', 'mtime',
+                                                           'scene_id', 'image_type')})
+        self.delete = delete(self.table).where(columns.path == bindparam('file_path'))
+
+    def load(self):
+        """
+        Reads the table, leaving out the geometries
+        :return: dict. path -> CatalogRow
+        """
+
+        columns = self.table.c
+        query = select(columns.path, columns.size, columns.mtime, columns.scene_id,
+                       columns.image_type)
+
+        return {row[0]: CatalogRow(*row) for row in self.session.execute(query)}
+
+    def put(self, row):
+        """
+        Records a new or changed file
+        :param row: CatalogRow
+        """
+
+        self.removed.discard(row.path)
+        self.changed[row.path] = {'path': row.path, 'timestamp': datetime.datetime.now(),
+                                  'size': row.size, 'mtime': row.mtime,
+                                  'scene_id': row.scene_id, 'image_type': row.image_type}
+
+        if len(self.changed) >= self.batch_size:
+            self.flush()
+
+    def remove(self, file_path):
+        """
+        Records a file that is gone
+        :param file_path: string
+        """
+
+        self.changed.pop(file_path, None)
+        self.removed.add(file_path)
+
+        if len(self.removed) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the held changes, in the session's transaction
+        """
+
+        if self.removed:
+            self.session.execute(self.delete, [{'file_path': file_path}
+                                               for file_path in self.removed])
+            self.removed = set()
+
+        if self.changed:
+            self.session.execute(self.upsert, list(self.changed.values()))
+            self.changed = {}
+
+
+def set_pragmas(dbapi_connection, connection_record):
+    """
+    Applies PRAGMAS to a new connection
+    """
+
+    cursor = dbapi_connection.cursor()
+    for name, value in PRAGMAS:
+        cursor.execute('PRAGMA {0} = {1}'.format(name, value))
+    cursor.close()
+
+
+def add_missing_indexes(connection, tables=None):
+    """
+    Adds the indexes a database written by an older version lacks. create_all only
+    indexes the tables it creates.
+    :param connection: sqlalchemy connection
+    :param tables: list of the Table objects opened, or None for all of them
+    """
+
+    for table in Base.metadata.sorted_tables if tables is None else tables:
+        for index in table.indexes:
+            if not any(isinstance(column.type, Geometry) for column in index.columns):
+                index.create(connection, checkfirst=True)
+
+    if tables is not None:  # SpatiaLite isn't loaded
+        return
+
+    for table in CATALOG_TABLES.values():
+        name = table.__tablename__
+        geometry = table.__table__.c.geom.type
+        enabled = connection.execute(text(
+            "SELECT spatial_index_enabled FROM geometry_columns "
+            "WHERE f_table_name = :name AND f_geometry_column = 'geom'"), {'name': name}) \
+            .scalar()
+
+        if enabled:
+            continue
+        if enabled is None:  # a plain blob column, not yet registered with SpatiaLite
+            connection.execute(text("SELECT RecoverGeometryColumn(:name, 'geom', :srid, "
+                                    ":geometry_type, 'XY')"),
+                               {'name': name, 'srid': geometry.srid,
+                                'geometry_type': geometry.geometry_type})
+        connection.execute(text("SELECT CreateSpatialIndex(:name, 'geom')"), {'name': name})
+
+
+def get_session(db_path, spatial=True):
+    """
+    Opens the database, creating the tables and indexes on first use
+    :param db_path: string. path to the .db file
+    :param spatial: bool. load SpatiaLite for the catalog tables. Without it only the
+    journal and content tables are opened, which are plain SQLite.
+    :return: sqlalchemy session
+    """
+
+    # The GUI runs jobs on a worker thread, so connections may move between threads
+    engine = create_engine('sqlite:///{}'.format(db_path),
+                           connect_args={'check_same_thread': False})
+    event.listen(engine, 'connect', set_pragmas)
+    tables = None
+    if spatial:
+        event.listen(engine, 'connect', load_spatialite)
+    else:
+        tables = [Journal.__table__, Content.__table__]
+    Base.metadata.create_all(engine, tables=tables)
+    with engine.begin() as connection:
+        add_missing_indexes(connection, tables)
 
-geoalchemy.GeometryDDL(Imagery.__table__)
-geoalchemy.GeometryDDL(Shapes.__table__)
+    # Nothing else writes the database while a session is open, so rows stay valid after a
+    # commit. DatabaseIo keeps the catalog loaded between the jobs of a queue.
+    return sessionmaker(bind=engine, expire_on_commit=False)()
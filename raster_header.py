@@ -0,0 +1,295 @@
+"""
+Header-only raster metadata for GeoTIFF and ERDAS Imagine (.img) files. The file is
+memory mapped and only the few kilobytes of header are parsed, so scanning thousands of
+multi-GB scenes never reads pixel data or needs a GDAL open per file.
+"""
+
+import logging
+import mmap
+from struct import Struct, error as StructError
+
+HFA_HEADER_TAG = b'EHFA_HEADER_TAG\x00'
+USER_DEFINED = 32767  # GeoKey value for a CRS that has no EPSG code
+
+# TIFF field type -> (struct code, size in bytes)
+TIFF_TYPES = {1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1),
+              7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8),
+              16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+
+# TIFF tags
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+SAMPLES_PER_PIXEL = 277
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+MODEL_TRANSFORMATION = 34264
+GEO_KEY_DIRECTORY = 34735
+GEO_DOUBLE_PARAMS = 34736
+GEO_ASCII_PARAMS = 34737
+
+# GeoKeys
+GT_RASTER_TYPE = 1025
+GT_CITATION = 1026
+GEOGRAPHIC_TYPE = 2048
+PROJECTED_CS_TYPE = 3072
+RASTER_PIXEL_IS_POINT = 2
+
+_uint32 = Struct('<I')
+_hfa_file = Struct('<iIIhI')  # version, free list, root entry, entry header length, dictionary
+_hfa_entry = Struct('<6I64s32sI')  # next, prev, parent, child, data, data size, name, type, time
+_hfa_layer = Struct('<2i')  # width, height
+_hfa_coordinate = Struct('<2d')
+
+
+class RasterMetadata:
+    """
+    What the scan needs to know about a raster, without its pixels
+    """
+
+    __slots__ = ('path', 'format', 'width', 'height', 'bands', 'geotransform', 'crs')
+
+    def __init__(self, path, format, width, height, bands, geotransform=None, crs=None):
+        """
+        :param path: string. raster path
+        :param format: string. GTiff or HFA, as GDAL names them
+        :param width: int. pixels
+        :param height: int. lines
+        :param bands: int
+        :param geotransform: tuple of six floats in GDAL order, or None if not georeferenced
+        :param crs: string. EPSG:<code> where known, otherwise the projection name
+        """
+
+        self.path = path
+        self.format = format
+        self.width = width
+        self.height = height
+        self.bands = bands
+        self.geotransform = geotransform
+        self.crs = crs
+
+    def __repr__(self):
+        return 'RasterMetadata({0!r}, {1}, {2}x{3}x{4}, {5})'.format(
+            self.path, self.format, self.width, self.height, self.bands, self.crs)
+
+
+def read_raster_header(file_path):
+    """
+    Reads the metadata of a GeoTIFF or ERDAS Imagine file from its header
+    :param file_path: string. raster path
+    :return: RasterMetadata, or None if the file isn't a raster this can read
+    """
+
+    try:
+        with open(file_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):
+                return read_tiff(file_path, data)
+
+            if data[:16] == HFA_HEADER_TAG:
+                return read_hfa(file_path, data)
+
+    except (IOError, OSError, ValueError) as e:  # ValueError: empty files can't be mapped
+        logging.debug("could not map {0}: {1}".format(file_path, e))
+        return None
+
+    except (StructError, IndexError, KeyError) as e:
+        logging.warning("- WARNING: corrupt raster header in {0}: {1}".format(file_path, e))
+        return None
+
+    return None
+
+
+def read_tiff(file_path, data):
+    """
+    Parses the first IFD of a classic or Big TIFF and its GeoTIFF keys
+    :param file_path: string. raster path
+    :param data: mmap of the file
+    :return: RasterMetadata
+    """
+
+    order = '<' if data[:2] == b'II' else '>'
+    big = data[2:4] in (b'+\x00', b'\x00+')
+
+    if big:
+        offset = Struct(order + 'Q').unpack_from(data, 8)[0]
+        count_format, entry_format, inline_size = Struct(order + 'Q'), Struct(order + 'HHQ'), 8
+    else:
+        offset = Struct(order + 'I').unpack_from(data, 4)[0]
+        count_format, entry_format, inline_size = Struct(order + 'H'), Struct(order + 'HHI'), 4
+
+    entry_count = count_format.unpack_from(data, offset)[0]
+    position = offset + count_format.size
+
+    tags = {}
+    for _ in range(entry_count):
+        tag, field_type, count = entry_format.unpack_from(data, position)
+        value_position = position + entry_format.size
+        position = value_position + inline_size
+
+        if field_type not in TIFF_TYPES:
+            continue
+
+        code, size = TIFF_TYPES[field_type]
+        if size * count > inline_size:  # value doesn't fit in the entry, so it's an offset
+            value_position = Struct(order + ('Q' if big else 'I')).unpack_from(
+                data, value_position)[0]
+
+        if field_type == 2:
+            tags[tag] = bytes(data[value_position:value_position + count])
+        else:
+            values = Struct(order + code * count).unpack_from(data, value_position)
+            if field_type in (5, 10):  # rationals come as numerator, denominator pairs
+                values = tuple(n / float(d) if d else 0.0
+                               for n, d in zip(values[0::2], values[1::2]))
+            tags[tag] = values
+
+    geo_keys = read_geo_keys(tags)
+    return RasterMetadata(file_path, 'GTiff', tags[IMAGE_WIDTH][0], tags[IMAGE_LENGTH][0],
+                          tags.get(SAMPLES_PER_PIXEL, (1, ))[0],
+                          tiff_geotransform(tags, geo_keys), tiff_crs(tags, geo_keys))
+
+
+def read_geo_keys(tags):
+    """
+    Reads the GeoKey directory
+    :param tags: dict. TIFF tag -> values
+    :return: dict. GeoKey -> value
+    """
+
+    directory = tags.get(GEO_KEY_DIRECTORY)
+    if not directory:
+        return {}
+
+    keys = {}
+    for index in range(4, 4 + 4 * directory[3], 4):  # header is 4 shorts, then 4 per key
+        key, location, count, value = directory[index:index + 4]
+
+        if location == 0:
+            keys[key] = value
+        elif location == GEO_DOUBLE_PARAMS and location in tags:
+            keys[key] = tags[location][value:value + count]
+        elif location == GEO_ASCII_PARAMS and location in tags:
+            keys[key] = tags[location][value:value + count].decode('latin-1').rstrip('|\x00')
+
+    return keys
+
+
+def tiff_geotransform(tags, geo_keys):
+    """
+    Builds a GDAL-style geotransform from the model transformation or from the
+    tiepoint and pixel scale
+    :return: tuple of six floats, or None if the TIFF isn't georeferenced
+    """
+
+    if MODEL_TRANSFORMATION in tags:
+        matrix = tags[MODEL_TRANSFORMATION]
+        geotransform = [matrix[3], matrix[0], matrix[1], matrix[7], matrix[4], matrix[5]]
+
+    elif MODEL_TIEPOINT in tags and MODEL_PIXEL_SCALE in tags:
+        column, row, _, x, y, _ = tags[MODEL_TIEPOINT][:6]
+        scale_x, scale_y = tags[MODEL_PIXEL_SCALE][:2]
+        geotransform = [x - column * scale_x, scale_x, 0.0, y + row * scale_y, 0.0, -scale_y]
+
+    else:
+        return None
+
+    # Coordinates refer to pixel centres; move the origin to the corner like GDAL does
+    if geo_keys.get(GT_RASTER_TYPE) == RASTER_PIXEL_IS_POINT:
+        geotransform[0] -= 0.5 * geotransform[1] + 0.5 * geotransform[2]
+        geotransform[3] -= 0.5 * geotransform[4] + 0.5 * geotransform[5]
+
+    return tuple(geotransform)
+
+
+def tiff_crs(tags, geo_keys):
+    """
+    Gets the CRS from the GeoKeys
+    :return: string. EPSG:<code>, a citation for user defined systems, or None
+    """
+
+    for key in (PROJECTED_CS_TYPE, GEOGRAPHIC_TYPE):
+        code = geo_keys.get(key)
+        if code and code != USER_DEFINED:
+            return 'EPSG:{}'.format(code)
+
+    return geo_keys.get(GT_CITATION)
+
+
+def read_hfa(file_path, data):
+    """
+    Walks the ERDAS Imagine (HFA) node tree for the band layers and map info. Pixels
+    live in the layers' blocks or in the .ige spill file and are never touched.
+    :param file_path: string. raster path
+    :param data: mmap of the file
+    :return: RasterMetadata
+    """
+
+    file_pointer = _uint32.unpack_from(data, 16)[0]
+    root = _hfa_file.unpack_from(data, file_pointer)[2]
+
+    layers = []
+    map_info = None
+
+    # Depth first walk. Each entry points to its first child and its next sibling.
+    stack = [root]
+    visited = set()
+    while stack:
+        pointer = stack.pop()
+        if not pointer or pointer in visited:  # 0 ends a list; guard against loops
+            continue
+        visited.add(pointer)
+
+        next_entry, _, _, child, data_pointer, _, name, node_type, _ = \
+            _hfa_entry.unpack_from(data, pointer)
+        node_type = node_type.split(b'\x00', 1)[0]
+
+        if node_type == b'Eimg_Layer':
+            layers.append(_hfa_layer.unpack_from(data, data_pointer))
+        elif node_type == b'Eprj_MapInfo' and map_info is None:
+            map_info = read_hfa_map_info(data, data_pointer)
+
+        stack.append(next_entry)
+        stack.append(child)
+
+    if not layers:
+        return None
+
+    geotransform = None
+    crs = None
+    if map_info is not None:
+        crs, (upper_left_x, upper_left_y), (pixel_width, pixel_height) = map_info
+        # Map info gives the centre of the upper left pixel
+        geotransform = (upper_left_x - pixel_width / 2.0, pixel_width, 0.0,
+                        upper_left_y + pixel_height / 2.0, 0.0, -pixel_height)
+
+    width, height = layers[0]
+    return RasterMetadata(file_path, 'HFA', width, height, len(layers), geotransform, crs)
+
+
+def read_hfa_map_info(data, position):
+    """
+    Reads an Eprj_MapInfo node: projection name, upper left centre, lower right centre,
+    pixel size and units. Pointer fields hold a count and an offset followed by their
+    data inline.
+    :return: tuple (projection name, (upper left x, y), (pixel width, height))
+    """
+
+    def read_pointer(position):
+        count = _uint32.unpack_from(data, position)[0]
+        return count, position + 8
+
+    count, position = read_pointer(position)
+    projection = bytes(data[position:position + count]).split(b'\x00', 1)[0].decode('latin-1')
+    position += count
+
+    count, position = read_pointer(position)
+    upper_left = _hfa_coordinate.unpack_from(data, position)
+    position += _hfa_coordinate.size
+
+    count, position = read_pointer(position)  # lower right centre, implied by the size
+    position += _hfa_coordinate.size
+
+    count, position = read_pointer(position)
+    pixel_size = _hfa_coordinate.unpack_from(data, position)
+
+    return projection or None, upper_left, pixel_size
@@ -0,0 +1,159 @@
+"""
+In-memory spatial index for matching shapefiles to image footprints
+"""
+
+from math import ceil, sqrt
+
+NODE_CAPACITY = 16  # entries per tree node
+
+
+class STRTree:
+    """
+    Static R-tree, bulk loaded with Sort-Tile-Recursive packing. Building is one sort
+    per level and a query only visits nodes whose boxes overlap the query box, so
+    matching n shapes against m images takes about (n + m) log m.
+    """
+
+    def __init__(self, items, node_capacity=NODE_CAPACITY):
+        """
+        Builds the tree
+        :param items: iterable of (bounds, value). bounds is (minx, miny, maxx, maxy)
+        :param node_capacity: int. entries per node
+        """
+
+        self.node_capacity = max(2, node_capacity)
+        self.size = 0
+
+        # Leaf entries and nodes share one layout: (minx, miny, maxx, maxy, payload)
+        level = [(bounds[0], bounds[1], bounds[2], bounds[3], value)
+                 for bounds, value in items]
+        self.size = len(level)
+        self.height = 1
+
+        while len(level) > self.node_capacity:
+            level = self.pack(level)
+            self.height += 1
+
+        self.root = self.make_node(level) if level else None
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def make_node(entries):
+        """
+        Wraps entries in a node covering all of them
+        """
+
+        return (min(entry[0] for entry in entries), min(entry[1] for entry in entries),
+                max(entry[2] for entry in entries), max(entry[3] for entry in entries),
+                entries)
+
+    def pack(self, entries):
+        """
+        Groups one level of entries into the nodes of the level above. Entries are
+        sorted into vertical slices by x center, then each slice is cut into nodes by
+        y center, which keeps nodes square and overlap low.
+        """
+
+        capacity = self.node_capacity
+        node_count = int(ceil(len(entries) / float(capacity)))
+        slice_count = int(ceil(sqrt(node_count)))
+        slice_size = slice_count * capacity
+
+        entries = sorted(entries, key=lambda entry: entry[0] + entry[2])
+
+        nodes = []
+        for start in range(0, len(entries), slice_size):
+            vertical_slice = sorted(entries[start:start + slice_size],
+                                    key=lambda entry: entry[1] + entry[3])
+
+            for node_start in range(0, len(vertical_slice), capacity):
+                nodes.append(self.make_node(vertical_slice[node_start:node_start + capacity]))
+
+        return nodes
+
+    def query(self, bounds):
+        """
+        Finds the items whose bounds intersect a box
+        :param bounds: tuple (minx, miny, maxx, maxy)
+        :return: list of (item bounds, value)
+        """
+
+        if self.root is None:
+            return []
+
+        minx, miny, maxx, maxy = bounds
+        found = []
+        stack = [(self.root, self.height)]
+
+        while stack:
+            node, depth = stack.pop()
+
+            for entry in node[4]:
+                if entry[0] > maxx or entry[2] < minx or entry[1] > maxy or entry[3] < miny:
+                    continue
+
+                if depth == 1:
+                    found.append((entry[:4], entry[4]))
+                else:
+                    stack.append((entry, depth - 1))
+
+        return found
+
+
+def overlap_area(first, second):
+    """
+    Gets the area two boxes share
+    :param first: tuple (minx, miny, maxx, maxy)
+    :param second: tuple (minx, miny, maxx, maxy)
+    :return: float
+    """
+
+    width = min(first[2], second[2]) - max(first[0], second[0])
+    height = min(first[3], second[3]) - max(first[1], second[1])
+
+    if width <= 0 or height <= 0:
+        return 0.0
+
+    return width * height
+
+
+def box_area(bounds):
+    """
+    Gets the area of a box
+    """
+
+    return max(bounds[2] - bounds[0], 0.0) * max(bounds[3] - bounds[1], 0.0)
+
+
+def best_match(tree, bounds, centroid=None):
+    """
+    Finds the item that best covers a box: the largest overlap relative to the union
+    of the two boxes. When a centroid is given, items that contain it are preferred,
+    which settles shapes lying where two footprints overlap.
+    :param tree: STRTree
+    :param bounds: tuple (minx, miny, maxx, maxy)
+    :param centroid: tuple (x, y), or None
+    :return: tuple (value, score), or (None, 0.0) if nothing overlaps
+    """
+
+    best = (None, 0.0, False)
+
+    for item_bounds, value in tree.query(bounds):
+        shared = overlap_area(bounds, item_bounds)
+
+        if shared == 0.0:
+            if box_area(bounds) > 0.0:  # only touching along an edge
+                continue
+            shared = 1e-12  # degenerate (point or line) shape inside the footprint
+
+        score = shared / (box_area(bounds) + box_area(item_bounds) - shared)
+        contains = centroid is not None and \
+            item_bounds[0] <= centroid[0] <= item_bounds[2] and \
+            item_bounds[1] <= centroid[1] <= item_bounds[3]
+
+        if (contains, score) > (best[2], best[1]):
+            best = (value, score, contains)
+
+    return best[0], best[1]
@@ -0,0 +1,348 @@
+"""
+Watches directory trees for files that are created, written or moved in. inotify is
+used on Linux; trees on network mounts, where inotify never hears about writes made by
+other machines, and systems without inotify are polled instead. The watchers only say
+which files may have changed. Deciding when a file is complete is left to the caller.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import re
+import select
+import time
+from os import scandir, path
+from struct import Struct
+
+# Filesystem types that inotify can't see remote writes on, as named in /proc/mounts
+NETWORK_FILESYSTEMS = frozenset(('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', 'ceph',
+                                 'glusterfs', 'lustre', 'gpfs', 'fuse.sshfs', 'davfs',
+                                 'fuse.rclone', '9p'))
+POLL_INTERVAL = 5.0  # seconds between walks of a polled tree
+READ_SIZE = 64 * 1024  # bytes of inotify events read at once
+
+# inotify event masks, from <sys/inotify.h>
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# Writes in progress aren't watched; a file is looked at again when it's closed
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | \
+    IN_MOVE_SELF
+
+_event = Struct('iIII')  # watch descriptor, mask, cookie, name length
+
+
+class WatchError(Exception):
+    """
+    A tree can't be watched with inotify
+    """
+
+
+def network_filesystem(directory):
+    """
+    Finds out whether a directory is on a network mount, going by /proc/mounts
+    :param directory: string
+    :return: string. the filesystem type if it is a network one, otherwise None
+    """
+
+    directory = path.realpath(directory)
+    mount_point, fs_type = '', None
+
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces and other odd characters are octal escaped
+                point = re.sub(r'\\([0-7]{3})', lambda found: chr(int(found.group(1), 8)),
+                               fields[1])
+                if len(point) > len(mount_point) and \
+                        (directory == point or directory.startswith(point.rstrip('/') + '/')):
+                    mount_point, fs_type = point, fields[2]
+    except (IOError, OSError):  # not Linux
+        return None
+
+    return fs_type if fs_type in NETWORK_FILESYSTEMS else None
+
+
+def walk_files(root, skip_directory=None, wanted_file=None, warn=logging.warning):
+    """
+    Lists the files under a directory with their size and mtime
+    :param root: string
+    :param skip_directory: callable taking a directory path, True to leave it out
+    :param wanted_file: callable taking a file name, True to list it. None lists all.
+    :param warn: callable taking the warning for a directory that can't be read
+    :return: dict. path -> (size, mtime)
+    """
+
+    files = {}
+    directories = [root]
+
+    while directories:
+        directory = directories.pop()
+
+        try:
+            entries = scandir(directory)
+        except OSError as e:
+            warn("- WARNING: could not scan {0}: {1}".format(directory, e))
+            continue
+
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if skip_directory is None or not skip_directory(entry.path):
+                            directories.append(entry.path)
+                    elif wanted_file is None or wanted_file(entry.name):
+                        entry_stat = entry.stat()
+                        files[entry.path] = (entry_stat.st_size, entry_stat.st_mtime)
+                except OSError:  # removed while the directory was being read
+                    continue
+
+    return files
+
+
+class InotifyWatcher:
+    """
+    Watches trees with inotify. Every directory gets its own watch; directories created
+    or moved in later are watched as they appear, and the files already in them are
+    reported, since they may have landed before the watch was added.
+    """
+
+    libc = None
+
+    def __init__(self, roots, skip_directory=None, wanted_file=None):
+        """
+        Adds watches to every directory under the roots
+        :param roots: iterable of directories
+        :param skip_directory: callable taking a directory path, True to leave it out
+        :param wanted_file: callable taking a file name, True to report it. None
+        reports all.
+        """
+
+        if InotifyWatcher.libc is None:
+            name = ctypes.util.find_library('c')
+            libc = ctypes.CDLL(name, use_errno=True) if name else None
+            if libc is None or not hasattr(libc, 'inotify_init1'):
+                raise WatchError("inotify isn't available on this system")
+            InotifyWatcher.libc = libc
+
+        self.roots = list(roots)
+        self.skip_directory = skip_directory
+        self.wanted_file = wanted_file
+        self.directories = {}  # watch descriptor -> directory
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError("could not start inotify: {}".format(
+                os.strerror(ctypes.get_errno())))
+
+        try:
+            for root in self.roots:
+                self.watch_tree(root, report=False)
+        except WatchError:
+            self.close()
+            raise
+
+    def watch_tree(self, root, report=True):
+        """
+        Watches a directory and everything under it
+        :param root: string
+        :param report: bool. list the files already in the tree
+        :return: dict. path -> None for each wanted file already in the tree
+        """
+
+        files = {}
+        directories = [root]
+
+        while directories:
+            directory = directories.pop()
+
+            descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                                     WATCH_MASK)
+            if descriptor < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise WatchError("out of inotify watches at {}. Raise "
+                                     "fs.inotify.max_user_watches or poll instead"
+                                     .format(directory))
+                if error in (errno.ENOENT, errno.ENOTDIR):  # gone already
+                    continue
+                raise WatchError("could not watch {0}: {1}".format(directory,
+                                                                  os.strerror(error)))
+            self.directories[descriptor] = directory
+
+            try:
+                entries = scandir(directory)
+            except OSError:
+                continue
+
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.skip_directory is None or \
+                                    not self.skip_directory(entry.path):
+                                directories.append(entry.path)
+                        elif report and (self.wanted_file is None or
+                                         self.wanted_file(entry.name)):
+                            files[entry.path] = None
+                    except OSError:
+                        continue
+
+        return files
+
+    def changes(self, timeout):
+        """
+        Waits for files to be created, written or moved in
+        :param timeout: float. seconds to wait for the first event
+        :return: dict. path -> None for each file that may have changed. Sizes aren't
+        known, so the caller stats them.
+        """
+
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return {}
+
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return {}
+
+        changed = {}
+        position = 0
+
+        while position < len(data):
+            descriptor, mask, cookie, length = _event.unpack_from(data, position)
+            name = data[position + _event.size:position + _event.size + length] \
+                .rstrip(b'\x00')
+            position += _event.size + length
+
+            if mask & IN_Q_OVERFLOW:  # events were lost, so look at everything again
+                logging.warning("- WARNING: inotify queue overflowed, rescanning")
+                for root in self.roots:
+                    changed.update(walk_files(root, self.skip_directory, self.wanted_file))
+                continue
+
+            if mask & IN_IGNORED:
+                self.directories.pop(descriptor, None)
+                continue
+
+            directory = self.directories.get(descriptor)
+            if directory is None or not name:  # events on the directory itself
+                continue
+
+            entry_path = path.join(directory, os.fsdecode(name))
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and \
+                        (self.skip_directory is None or not self.skip_directory(entry_path)):
+                    try:
+                        changed.update(self.watch_tree(entry_path))
+                    except WatchError as e:
+                        logging.error("- ERROR: {}".format(e))
+            elif self.wanted_file is None or self.wanted_file(path.basename(entry_path)):
+                changed[entry_path] = None
+
+        return changed
+
+    def close(self):
+        """
+        Removes the watches
+        """
+
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    """
+    Watches trees by walking them every interval and comparing each file's size and
+    mtime with the last walk. The first walk reports every file.
+    """
+
+    def __init__(self, roots, skip_directory=None, wanted_file=None, interval=POLL_INTERVAL):
+        """
+        :param roots: iterable of directories
+        :param skip_directory: callable taking a directory path, True to leave it out
+        :param wanted_file: callable taking a file name, True to report it. None
+        reports all.
+        :param interval: float. seconds between walks
+        """
+
+        self.roots = list(roots)
+        self.skip_directory = skip_directory
+        self.wanted_file = wanted_file
+        self.interval = interval
+        self.snapshot = {}  # path -> (size, mtime) at the last walk
+        self.next_walk = time.monotonic()
+
+    def changes(self, timeout):
+        """
+        Walks the trees once the interval is up
+        :param timeout: float. seconds to wait at most
+        :return: dict. path -> (size, mtime) for each new or changed file
+        """
+
+        wait = self.next_walk - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return {}
+        if wait > 0:
+            time.sleep(wait)
+
+        files = {}
+        for root in self.roots:
+            files.update(walk_files(root, self.skip_directory, self.wanted_file))
+        self.next_walk = time.monotonic() + self.interval
+
+        changed = {file_path: version for file_path, version in files.items()
+                   if self.snapshot.get(file_path) != version}
+        self.snapshot = files
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(roots, skip_directory=None, wanted_file=None, poll_interval=None):
+    """
+    Watches trees with inotify where it works, otherwise by polling
+    :param roots: iterable of directories
+    :param skip_directory: callable taking a directory path, True to leave it out
+    :param wanted_file: callable taking a file name, True to report it
+    :param poll_interval: float. always poll, this many seconds apart. None uses
+    inotify unless a root is on a network mount or inotify can't be used.
+    :return: InotifyWatcher or PollingWatcher
+    """
+
+    roots = list(roots)
+
+    if poll_interval is None:
+        network = [(root, network_filesystem(root)) for root in roots]
+        network = [(root, fs_type) for root, fs_type in network if fs_type is not None]
+
+        if network:
+            logging.info("- INFO: {0} is on a {1} mount, polling it every {2:g} seconds"
+                         .format(network[0][0], network[0][1], POLL_INTERVAL))
+        else:
+            try:
+                return InotifyWatcher(roots, skip_directory, wanted_file)
+            except WatchError as e:
+                logging.warning("- WARNING: {0}. Polling every {1:g} seconds instead"
+                                .format(e, POLL_INTERVAL))
+
+    return PollingWatcher(roots, skip_directory, wanted_file,
+                          POLL_INTERVAL if poll_interval is None else poll_interval)